@@ -2,6 +2,8 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 from spire_data_utils import *
+from multichain import gelman_rubin_rhat
+from chain_io import ChainReader
 import pickle
 import corner
 # from pcat_spire import *
@@ -58,7 +60,9 @@ def gather_posteriors(timestr_list, inject_sz_frac=None, tail_name='6_4_20', ban
             if i==0:
                 print('gdat file name is ', gdat.tail_name, ' and injected sz frac is ', gdat.inject_sz_frac)
             # print('inject sz frac is ', inject_sz_frac, ' while in gdat it is ', gdat.inject_sz_frac)
-            chain = np.load(filepath+'/chain.npz')
+            burn_in = int(gdat.nsamp*gdat.burn_in_frac)
+            # burn_in = int(gdat.nsamp*0.75)
+            chain = ChainReader(filepath, burn_in=burn_in)
 
             band=band_dict[gdat.bands[i]]
             sim_idxs.append(gdat.tail_name[-8:-5])
@@ -72,14 +76,10 @@ def gather_posteriors(timestr_list, inject_sz_frac=None, tail_name='6_4_20', ban
             else:
                 label = None
 
-            burn_in = int(gdat.nsamp*gdat.burn_in_frac)
-            # burn_in = int(gdat.nsamp*0.75)
-
-            
             if dust:
-                template_amplitudes = chain['template_amplitudes'][burn_in:, 1, i]
+                template_amplitudes = chain['template_amplitudes'][:, 1, i]
             else:
-                template_amplitudes = chain['template_amplitudes'][burn_in:, 0, i]/flux_density_conversion_facs[i]
+                template_amplitudes = chain['template_amplitudes'][:, 0, i]/flux_density_conversion_facs[i]
 
             indiv_sigmas.append(np.std(template_amplitudes))
             
@@ -337,18 +337,18 @@ def aggregate_posterior_corner_plot(timestr_list, temp_amplitudes=True, bkgs=Tru
 	samples = []
 
 	for i, timestr in enumerate(timestr_list):
-		chain = np.load('spire_results/'+timestr+'/chain.npz')
+		chain = ChainReader('spire_results/'+timestr, burn_in=n_burn_in)
 
 		if nsrcs:
-			nsrc.extend(chain['n'][n_burn_in:])
+			nsrc.extend(chain['n'])
 		
 		for b in bkg_bands:
 			if bkgs:
-				bkgs[b].extend(chain['bkg'][n_burn_in:,b].ravel()/flux_density_conversion_facs[b])
+				bkgs[b].extend(chain['bkg'][:,b].ravel()/flux_density_conversion_facs[b])
 		
 		for b in temp_bands:
 			if temp_amplitudes:
-				temp_amps[b].extend(chain['template_amplitudes'][n_burn_in:,b].ravel()/flux_density_conversion_facs[b])
+				temp_amps[b].extend(chain['template_amplitudes'][:,b].ravel()/flux_density_conversion_facs[b])
 
 
 	corner_labels = []
@@ -394,19 +394,7 @@ def compute_gelman_rubin_diagnostic(list_of_chains):
     
     print('n=',n,' m=',m)
         
-    B = (n/(m-1))*np.sum((np.mean(list_of_chains, axis=1)-np.mean(list_of_chains))**2)
-    
-    W = 0.
-    for j in range(m):
-        
-        sumsq = np.sum((list_of_chains[j]-np.mean(list_of_chains[j]))**2)
-        
-        W += (1./m)*(1./(n-1.))*sumsq
-    
-    var_th = ((n-1.)/n)*W + (B/n)
-    
-    
-    Rhat = np.sqrt(var_th/W)
+    Rhat = gelman_rubin_rhat(list_of_chains)
     
     print("rhat = ", Rhat)
     
@@ -462,7 +450,7 @@ def gather_posteriors_different_amps(timestr_list, label_dict):
 		for j, timestr in enumerate(timestr_list):
 			gdat, filepath, result_path = load_param_dict(timestr, result_path='spire_results/')
 
-			chain = np.load(filepath+'/chain.npz')
+			chain = ChainReader(filepath)
 
 			band=band_dict[gdat.bands[i+1]]
 
@@ -0,0 +1,302 @@
+import numpy as np
+import numpy.ctypeslib as npct
+import ctypes
+from ctypes import c_int, c_double
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import warnings
+from image_eval import image_model_eval, make_pixel_hash, EvalBufferPool
+from numpy_backend import NumpyBackend
+from numba_backend import NumbaBackend, numba_available
+
+''' This module is the registry of kernel backends. Compiled backends are located or compiled on first use into a per-user cache
+directory, keyed by a hash of the kernel source and compiler flags, so PCAT can be launched from any directory and stale libraries
+are never loaded. select_backend() runs a short micro-benchmark of every available backend on the actual image size and returns
+the fastest one. The choice is stored in the cache directory for each image size, so later runs with the same setup use the same
+backend without benchmarking again. '''
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+# kernel source, compiler, compiler flags, linker flags and whether the library uses the pcat_* (rather than clib_*) kernel names
+compiled_backends = dict({'mkl':('pcat-lion.c', 'icc', ['-mkl', '-shared', '-static-intel', '-liomp5', '-qopenmp', '-fPIC', '-O2'], [], True), \
+						'openblas':('blas-open.c', 'gcc', ['-shared', '-fPIC', '-O2', '-fopenmp'], ['-lopenblas'], False), \
+						'blas':('blas.c', 'gcc', ['-shared', '-fPIC', '-O2', '-fopenmp'], [], False)})
+
+# libraries built in the source directory with the Makefile
+makefile_libs = dict({'mkl':'pcat-lion.so', 'openblas':'blas-open.so', 'blas':'blas.so'})
+
+backend_names = ['mkl', 'openblas', 'blas', 'numba', 'numpy']
+
+openmp_flags = ['-fopenmp', '-qopenmp', '-liomp5']
+
+
+def get_cache_dir():
+	''' Per-user directory for compiled kernels, $PCAT_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/pcat or ~/.cache/pcat. '''
+	cache_dir = os.environ.get('PCAT_CACHE_DIR')
+	if cache_dir is None:
+		cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'pcat')
+	if not os.path.isdir(cache_dir):
+		os.makedirs(cache_dir)
+	return cache_dir
+
+def uses_pcat_names(name):
+	''' True if the backend exposes the pcat-lion.c kernel names, False if it uses the blas.c (clib_*) names. '''
+	if name in compiled_backends:
+		return compiled_backends[name][4]
+	return False
+
+def library_key(srcpath, compiler, flags):
+	''' Hash of the kernel source, compiler and flags, used to name cached libraries. '''
+	sha = hashlib.sha256()
+	with open(srcpath, 'rb') as f:
+		sha.update(f.read())
+	sha.update((compiler+' '+' '.join(flags)).encode())
+	return sha.hexdigest()[:16]
+
+def locate_or_build(name, build=True):
+	'''
+	Returns the path to a compiled library for backend name, or None if it is not available. A library in the cache directory
+	matching the current source and flags is used first, then an up to date library built in the source directory with the Makefile.
+	Otherwise, if build is True, the kernel is compiled into the cache directory, retrying without OpenMP if that fails.
+	'''
+	srcfile, compiler, flags, ldflags, _ = compiled_backends[name]
+	srcpath = os.path.join(src_dir, srcfile)
+	cache_dir = get_cache_dir()
+
+	flag_options = [flags+ldflags, [flag for flag in flags+ldflags if flag not in openmp_flags]]
+
+	for flagset in flag_options:
+		cached = os.path.join(cache_dir, name+'-'+library_key(srcpath, compiler, flagset)+'.so')
+		if os.path.isfile(cached):
+			return cached
+
+	local = os.path.join(src_dir, makefile_libs[name])
+	if os.path.isfile(local) and os.path.getmtime(local) >= os.path.getmtime(srcpath):
+		return local
+
+	if not build or shutil.which(compiler) is None:
+		return None
+
+	for flagset in flag_options:
+		cached = os.path.join(cache_dir, name+'-'+library_key(srcpath, compiler, flagset)+'.so')
+		# compile to a temporary file and move it into place, so concurrent runs never load a partially written library
+		fd, tmppath = tempfile.mkstemp(suffix='.so', dir=cache_dir)
+		os.close(fd)
+		cmd = [compiler]+[flag for flag in flagset if flag not in ldflags]+[srcpath, '-o', tmppath]+[flag for flag in flagset if flag in ldflags]
+		result = subprocess.run(cmd, cwd=src_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		if result.returncode == 0:
+			os.replace(tmppath, cached)
+			return cached
+		os.remove(tmppath)
+
+	warnings.warn('Could not compile '+srcfile+': '+result.stderr.decode(errors='replace')[-500:], Warning)
+	return None
+
+def declare_kernels(libmmult, cblas):
+	''' Declares the ctypes argument and return types of the kernels in a compiled library. '''
+	array_2d_float = npct.ndpointer(dtype=np.float32, ndim=2, flags="C_CONTIGUOUS")
+	array_1d_int = npct.ndpointer(dtype=np.int32, ndim=1, flags="C_CONTIGUOUS")
+	array_2d_double = npct.ndpointer(dtype=np.float64, ndim=2, flags="C_CONTIGUOUS")
+	array_2d_int = npct.ndpointer(dtype=np.int32, ndim=2, flags="C_CONTIGUOUS")
+	array_1d_float = npct.ndpointer(dtype=np.float32, ndim=1, flags="C_CONTIGUOUS")
+	array_3d_float = npct.ndpointer(dtype=np.float32, ndim=3, flags="C_CONTIGUOUS")
+	array_1d_double = npct.ndpointer(dtype=np.float64, ndim=1, flags="C_CONTIGUOUS")
+	array_1d_ptr = npct.ndpointer(dtype=np.uintp, ndim=1, flags="C_CONTIGUOUS") # per-band array addresses, see fused_pointers()
+
+	# fused multiband kernel, absent from libraries built before it was added
+	fused_argtypes = [c_int, c_int, c_int, c_int, array_1d_float, array_1d_float, array_2d_float, array_1d_float, array_1d_double, array_1d_int, \
+					array_2d_float, array_3d_float, array_2d_float, array_1d_int, array_1d_int, array_2d_float, array_2d_float, \
+					array_1d_ptr, array_1d_ptr, array_1d_ptr, array_1d_ptr, array_2d_double, array_2d_double, \
+					array_1d_int, array_1d_int, array_1d_int, array_1d_int, array_1d_int]
+
+	if cblas:
+		if hasattr(libmmult, 'pcat_multiband_eval'):
+			libmmult.pcat_multiband_eval.restype = None
+			libmmult.pcat_multiband_eval.argtypes = fused_argtypes
+		libmmult.pcat_model_eval.restype = None
+		libmmult.pcat_model_eval.argtypes = [c_int, c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_1d_int, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
+		libmmult.pcat_imag_acpt.restype = None
+		libmmult.pcat_imag_acpt.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_int, c_int, c_int, c_int, c_int]
+		libmmult.pcat_like_eval.restype = None
+		libmmult.pcat_like_eval.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
+		libmmult.pcat_imag_acpt_sparse.restype = c_double
+		libmmult.pcat_imag_acpt_sparse.argtypes = [c_int, c_int, c_int, c_int, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_float, array_2d_int, array_2d_double, array_2d_int, c_int, c_int, c_int, c_int]
+		libmmult.pcat_set_num_threads.restype = None
+		libmmult.pcat_set_num_threads.argtypes = [c_int, c_int]
+
+	else:
+		# the clib_* kernels take a trailing booltile argument, which sets the region layout. PCAT always passes 1, i.e. 
+		# (imsz // regsize + 1) regions along each axis, as in pcat-lion.c and the python backends
+		if hasattr(libmmult, 'clib_eval_modl_mult'):
+			libmmult.clib_eval_modl_mult.restype = None
+			libmmult.clib_eval_modl_mult.argtypes = fused_argtypes+[c_int]
+		libmmult.clib_eval_modl.restype = None
+		libmmult.clib_eval_modl.argtypes = [c_int, c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_1d_int, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int, c_int]
+		libmmult.clib_updt_modl.restype = None
+		libmmult.clib_updt_modl.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_int, c_int, c_int, c_int, c_int, c_int]
+		libmmult.clib_eval_llik.restype = None
+		libmmult.clib_eval_llik.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int, c_int]
+		libmmult.clib_updt_modl_sprs.restype = c_double
+		libmmult.clib_updt_modl_sprs.argtypes = [c_int, c_int, c_int, c_int, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_float, array_2d_int, array_2d_double, array_2d_int, c_int, c_int, c_int, c_int, c_int]
+		libmmult.clib_set_numb_thrd.restype = None
+		libmmult.clib_set_numb_thrd.argtypes = [c_int, c_int]
+
+def get_model_kernel(libmmult, cblas):
+	''' Returns the model evaluation kernel of a library with the arguments of pcat_model_eval, i.e. clib_eval_modl with booltile set. '''
+	if cblas:
+		return libmmult.pcat_model_eval
+	return lambda *args: libmmult.clib_eval_modl(*(args+(1,)))
+
+def get_fused_kernel(libmmult, cblas):
+	'''
+	Returns the fused multiband kernel of a compiled library (pcat_multiband_eval, or clib_eval_modl_mult with booltile set),
+	or None for the python backends and for libraries built without it.
+	'''
+	if libmmult is None or isinstance(libmmult, NumpyBackend):
+		return None
+	if cblas:
+		if hasattr(libmmult, 'pcat_multiband_eval'):
+			return libmmult.pcat_multiband_eval
+		return None
+	if hasattr(libmmult, 'clib_eval_modl_mult'):
+		return lambda *args: libmmult.clib_eval_modl_mult(*(args+(1,)))
+	return None
+
+def fused_pointers(arrays):
+	''' Addresses of a list of per-band C-contiguous arrays, passed to the fused multiband kernel as an array of pointers. '''
+	return np.array([arr.ctypes.data for arr in arrays], dtype=np.uintp)
+
+def set_kernel_threads(libmmult, cblas, n_threads, deterministic=True):
+	''' Sets the number of kernel threads. omp_set_num_threads() and numba.set_num_threads() only apply to the calling thread, 
+	so this has to be called from every thread that runs kernels, e.g. as the initializer of a thread pool. '''
+	if cblas:
+		libmmult.pcat_set_num_threads(n_threads, int(deterministic))
+	else:
+		libmmult.clib_set_numb_thrd(n_threads, int(deterministic))
+
+def load_backend(name, build=True):
+	''' Returns the kernel library for backend name, with its kernels declared, or None if it is not available. '''
+	if name not in backend_names:
+		raise ValueError('backend should be one of '+str(backend_names)+', got '+str(name))
+	if name == 'numpy':
+		return NumpyBackend()
+	if name == 'numba':
+		if numba_available:
+			return NumbaBackend()
+		return None
+
+	path = locate_or_build(name, build=build)
+	if path is None:
+		return None
+	try:
+		libmmult = ctypes.CDLL(path)
+	except OSError as err:
+		warnings.warn('Could not load '+path+': '+str(err), Warning)
+		return None
+
+	declare_kernels(libmmult, uses_pcat_names(name))
+	return libmmult
+
+def benchmark_backend(libmmult, cblas, imsz, nc, cf, regsize=None, nsrc=100, budget=1.):
+	'''
+	Times the model evaluation kernel of a backend on an image of size imsz with nsrc randomly placed sources,
+	repeating calls for roughly budget seconds after one warm-up call. Returns the median time per call in seconds.
+	'''
+	rng = np.random.RandomState(0)
+	x = rng.uniform(1, imsz[0]-2, nsrc).astype(np.float32)
+	y = rng.uniform(1, imsz[1]-2, nsrc).astype(np.float32)
+	f = rng.uniform(0.001, 0.1, nsrc).astype(np.float32)
+	ref = np.zeros((imsz[0], imsz[1]), dtype=np.float32)
+	weights = np.ones((imsz[0], imsz[1]), dtype=np.float32)
+	pixel_hash = make_pixel_hash(imsz)
+	pool = EvalBufferPool()
+
+	lib = get_model_kernel(libmmult, cblas)
+
+	def call():
+		image_model_eval(x, y, f, 0., imsz, nc, cf, regsize=regsize, weights=weights, ref=ref, lib=lib, pixel_hash=pixel_hash, pool=pool)
+
+	call() # includes any just-in-time compilation
+	dts = []
+	t0 = time.time()
+	while time.time() - t0 < budget or len(dts) < 3:
+		t1 = time.time()
+		call()
+		dts.append(time.time()-t1)
+
+	return np.median(dts)
+
+def backend_choice_key(imsz, nc, regsize, candidates, n_threads):
+	'''
+	Key of a backend choice in backend_choices.json, the benchmark setup that the choice depends on. Compiled candidates are 
+	identified by the hash of their source and flags (see library_key()), so the choice is made again after a kernel is edited.
+	'''
+	candidate_keys = []
+	for name in candidates:
+		if name in compiled_backends:
+			srcfile, compiler, flags, ldflags, _ = compiled_backends[name]
+			name += ':'+library_key(os.path.join(src_dir, srcfile), compiler, flags+ldflags)
+		candidate_keys.append(name)
+	return 'imsz='+str(imsz[0])+'x'+str(imsz[1])+',nc='+str(nc)+',regsize='+str(regsize)+',n_threads='+str(n_threads)+',candidates='+'+'.join(candidate_keys)
+
+def load_backend_choices():
+	''' Backend choices of earlier calls to select_backend(), stored in the cache directory. '''
+	path = os.path.join(get_cache_dir(), 'backend_choices.json')
+	if not os.path.isfile(path):
+		return dict()
+	try:
+		with open(path, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return dict()
+
+def save_backend_choice(key, name, timings):
+	''' Adds a backend choice to backend_choices.json, replacing the file atomically so concurrent runs never read a partial file. '''
+	cache_dir = get_cache_dir()
+	choices = load_backend_choices()
+	choices[key] = dict({'backend':name, 'timings':timings})
+	fd, tmppath = tempfile.mkstemp(suffix='.json', dir=cache_dir)
+	with os.fdopen(fd, 'w') as f:
+		json.dump(choices, f, indent=1, sort_keys=True)
+	os.replace(tmppath, os.path.join(cache_dir, 'backend_choices.json'))
+
+def select_backend(imsz, nc, cf, regsize=None, candidates=None, n_threads=1, deterministic=True, budget=1., build=True, use_cache=True):
+	'''
+	Loads every available backend in candidates (by default all of them), benchmarks each for budget seconds on the actual
+	image size and returns the name and library of the fastest, along with a dictionary of median times per call in milliseconds.
+	If use_cache is True, the choice is saved to the cache directory and reused by later calls with the same image size, PSF
+	stamp size, region size, candidates and number of threads, as long as the chosen backend is still available. Remove 
+	backend_choices.json from the cache directory (see get_cache_dir()) to benchmark again, e.g. after installing a library.
+	'''
+	if candidates is None:
+		candidates = backend_names
+
+	key = backend_choice_key(imsz, nc, regsize, candidates, n_threads)
+	if use_cache:
+		choice = load_backend_choices().get(key)
+		if choice is not None and choice['backend'] in candidates:
+			libmmult = load_backend(choice['backend'], build=build)
+			if libmmult is not None:
+				set_kernel_threads(libmmult, uses_pcat_names(choice['backend']), n_threads, deterministic)
+				return choice['backend'], libmmult, choice['timings']
+
+	libs, timings = dict(), dict()
+	for name in candidates:
+		libmmult = load_backend(name, build=build)
+		if libmmult is None:
+			continue
+		cblas = uses_pcat_names(name)
+		set_kernel_threads(libmmult, cblas, n_threads, deterministic)
+		libs[name] = libmmult
+		timings[name] = float(1e3*benchmark_backend(libmmult, cblas, imsz, nc, cf, regsize=regsize, budget=budget))
+
+	best = min(timings, key=timings.get)
+	if use_cache:
+		save_backend_choice(key, best, timings)
+
+	return best, libs[best], timings
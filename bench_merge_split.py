@@ -0,0 +1,94 @@
+import numpy as np
+import argparse
+import time
+from spatial_index import neighbours, neighbour_cutoff, neighbour_pairs, gaussian_adjacency
+
+''' Benchmark of the adjacency computations of the merge and split proposals. The "per-pair" mode calls neighbours() against the
+whole catalog for every pair, as Model.merge_split_stars() used to, and the "neighbour list" mode computes the candidate neighbours
+of all sources at once with spatial_index.neighbour_pairs(), as it does now. Both give the same adjacency sums. Run e.g.
+
+	python bench_merge_split.py --nsrc 2000 --imsz 600
+
+'''
+
+def merge_per_pair(x, y, idx_reg, nms, kickrange, rng):
+	invpairs = np.zeros(nms)
+	for k in range(nms):
+		i = rng.choice(idx_reg)
+		invpairs[k], j = neighbours(x, y, kickrange, i, generate=True, rng=rng)
+		invpairs[k] = 1./invpairs[k] + 1./neighbours(x, y, kickrange, j)
+	return invpairs
+
+def merge_neighbour_list(x, y, idx_reg, nms, kickrange, rng):
+	pair_q, pair_j = neighbour_pairs(x, y, x[idx_reg], y[idx_reg], neighbour_cutoff(x.dtype)*kickrange)
+	adjacency = gaussian_adjacency(x, y, x[idx_reg], y[idx_reg], pair_q, pair_j, kickrange)
+	adjacency[pair_j == idx_reg[pair_q]] = 0.
+	pair_offsets = np.searchsorted(pair_q, np.arange(idx_reg.size+1))
+	neighsum = np.bincount(pair_q, weights=adjacency, minlength=idx_reg.size)
+	region_idx = np.full(x.size, -1)
+	region_idx[idx_reg] = np.arange(idx_reg.size)
+	uniforms = rng.uniform(size=(nms, 2))
+	invpairs = np.zeros(nms)
+	for k in range(nms):
+		q = int(uniforms[k,0]*idx_reg.size)
+		cdf = np.cumsum(adjacency[pair_offsets[q]:pair_offsets[q+1]])
+		j = pair_j[pair_offsets[q] + min(np.searchsorted(cdf, uniforms[k,1]*cdf[-1], side='right'), cdf.size-1)]
+		# partners outside the region are rejected in merge_split_stars(), so only region sums are needed
+		if region_idx[j] >= 0:
+			invpairs[k] = 1./neighsum[q] + 1./neighsum[region_idx[j]]
+	return invpairs
+
+def split_per_pair(x, y, idx_move, xp, yp, xb, yb, kickrange):
+	invpairs = np.zeros(idx_move.size)
+	for k in range(idx_move.size):
+		xtemp, ytemp = x.copy(), y.copy()
+		xtemp[idx_move[k]], ytemp[idx_move[k]] = xp[k], yp[k]
+		xtemp = np.concatenate([xtemp, xb[k:k+1]])
+		ytemp = np.concatenate([ytemp, yb[k:k+1]])
+		invpairs[k] = 1./neighbours(xtemp, ytemp, kickrange, idx_move[k]) + 1./neighbours(xtemp, ytemp, kickrange, x.size)
+	return invpairs
+
+def split_neighbour_list(x, y, idx_move, xp, yp, xb, yb, kickrange):
+	xq, yq = np.concatenate([xp, xb]), np.concatenate([yp, yb])
+	pair_q, pair_j = neighbour_pairs(x, y, xq, yq, neighbour_cutoff(x.dtype)*kickrange)
+	adjacency = gaussian_adjacency(x, y, xq, yq, pair_q, pair_j, kickrange)
+	adjacency[pair_j == np.tile(idx_move, 2)[pair_q]] = 0.
+	neighsum = np.bincount(pair_q, weights=adjacency, minlength=2*idx_move.size)
+	split_adjacency = np.exp(-((xp-xb)**2 + (yp-yb)**2)/(2.*kickrange*kickrange))
+	return 1./(neighsum[:idx_move.size] + split_adjacency) + 1./(neighsum[idx_move.size:] + split_adjacency)
+
+def time_call(fn, args, ncall):
+	dts = np.zeros(ncall)
+	for i in range(ncall):
+		t0 = time.time()
+		out = fn(*args)
+		dts[i] = time.time()-t0
+	return np.median(dts), out
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Time per merge/split proposal of the per-pair and neighbour list adjacency computations.')
+	parser.add_argument('--nsrc', type=int, nargs='+', default=[500, 2000, 10000], help='number of sources in the catalog')
+	parser.add_argument('--imsz', type=int, default=600, help='image side length in pixels')
+	parser.add_argument('--regsize', type=int, default=20, help='region size in pixels, which sets the number of pairs per proposal')
+	parser.add_argument('--kickrange', type=float, default=1., help='merge/split scale in pixels')
+	parser.add_argument('--ncall', type=int, default=10, help='number of calls per configuration')
+	args = parser.parse_args()
+
+	nms = (args.imsz//args.regsize)**2//4
+	for nsrc in args.nsrc:
+		rng = np.random.RandomState(0)
+		x = rng.uniform(1, args.imsz-2, nsrc).astype(np.float32)
+		y = rng.uniform(1, args.imsz-2, nsrc).astype(np.float32)
+		idx_reg = np.arange(nsrc)[:max(nsrc//4, 2)]
+		idx_move = rng.choice(nsrc, size=min(nms, nsrc), replace=False)
+		dx, dy = (rng.normal(size=(2, idx_move.size))*args.kickrange).astype(np.float32)
+		xp, yp, xb, yb = x[idx_move]-0.5*dx, y[idx_move]-0.5*dy, x[idx_move]+0.5*dx, y[idx_move]+0.5*dy
+
+		dt_merge_ref, _ = time_call(merge_per_pair, (x, y, idx_reg, min(nms, idx_reg.size//2), args.kickrange, np.random.RandomState(1)), args.ncall)
+		dt_merge, _ = time_call(merge_neighbour_list, (x, y, idx_reg, min(nms, idx_reg.size//2), args.kickrange, np.random.RandomState(1)), args.ncall)
+		dt_split_ref, inv_ref = time_call(split_per_pair, (x, y, idx_move, xp, yp, xb, yb, args.kickrange), args.ncall)
+		dt_split, inv = time_call(split_neighbour_list, (x, y, idx_move, xp, yp, xb, yb, args.kickrange), args.ncall)
+
+		print('nsrc = '+str(nsrc)+', '+str(nms)+' pairs per proposal')
+		print('\tmerge: per-pair '+str(np.round(1e3*dt_merge_ref, 3))+' ms, neighbour list '+str(np.round(1e3*dt_merge, 3))+' ms')
+		print('\tsplit: per-pair '+str(np.round(1e3*dt_split_ref, 3))+' ms, neighbour list '+str(np.round(1e3*dt_split, 3))+' ms, max relative difference of pair factors '+str(np.max(np.abs(inv/inv_ref-1.))))
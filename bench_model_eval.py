@@ -0,0 +1,151 @@
+import numpy as np
+import numpy.ctypeslib as npct
+import ctypes
+from ctypes import c_int
+import argparse
+import time
+from image_eval import image_model_eval, make_pixel_hash
+from spire_data_utils import get_gaussian_psf_template_3_5_20
+from backends import load_backend, uses_pcat_names, get_model_kernel
+
+''' Benchmark of per-call latency for the compiled model evaluation kernel. The "fresh" mode allocates and initializes
+a full-image pixel hash on every call, which is what the kernels used to do internally with a stack array, while the
+"persistent" mode reuses one workspace per band as the sampler now does. Run from the repository directory after compiling, e.g.
+
+	python bench_model_eval.py --lib blas --imsz 2000 --nstar 200
+
+With --parity, it instead checks that the model evaluation, likelihood and sparse acceptance kernels of the backends in the
+registry (see backends.py) give the same images and per-region chi2, with margins and region offsets, e.g.
+
+	python bench_model_eval.py --parity blas numpy numba --imsz 100 --regsize 20 --margin 5 --offsets 3 7
+
+'''
+
+def load_model_eval(libname):
+	array_2d_float = npct.ndpointer(dtype=np.float32, ndim=2, flags="C_CONTIGUOUS")
+	array_1d_int = npct.ndpointer(dtype=np.int32, ndim=1, flags="C_CONTIGUOUS")
+	array_2d_double = npct.ndpointer(dtype=np.float64, ndim=2, flags="C_CONTIGUOUS")
+
+	libmmult = ctypes.cdll['./'+libname+'.so']
+	if libname == 'blas' or libname == 'blas-open':
+		lib = libmmult.clib_eval_modl
+		extra = [c_int] # booltile
+	else:
+		lib = libmmult.pcat_model_eval
+		extra = []
+
+	lib.restype = None
+	lib.argtypes = [c_int, c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_1d_int, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]+extra
+
+	if len(extra) > 0:
+		return lambda *args: lib(*(args+(1,)))
+	return lib
+
+def time_calls(lib, x, y, f, imsz, nc, cf, ref, weights, regsize, ncall, persistent):
+	pixel_hash = make_pixel_hash(imsz)
+	dts = np.zeros(ncall)
+	for i in range(ncall):
+		t0 = time.time()
+		if not persistent:
+			pixel_hash = make_pixel_hash(imsz)
+		image_model_eval(x, y, f, 0., imsz, nc, cf, regsize=regsize, weights=weights, ref=ref, lib=lib, pixel_hash=pixel_hash)
+		dts[i] = time.time()-t0
+	return dts
+
+def kernel_outputs(libmmult, cblas, x, y, f, imsz, nc, cf, data, weights, acceptreg, regsize, margin, offsetx, offsety):
+	''' Outputs of the model evaluation, likelihood and sparse acceptance kernels of one backend, on the same inputs. '''
+	lib = get_model_kernel(libmmult, cblas)
+	model, diff2_modl = image_model_eval(x, y, f, 0., imsz, nc, cf, regsize=regsize, margin=margin, offsetx=offsetx, offsety=offsety, \
+										weights=weights, ref=data, lib=lib)
+
+	diff2_llik = np.zeros(acceptreg.shape, dtype=np.float64)
+	if cblas:
+		libmmult.pcat_like_eval(imsz[0], imsz[1], model, data, weights, diff2_llik, regsize, margin, offsetx, offsety)
+	else:
+		libmmult.clib_eval_llik(imsz[0], imsz[1], model, data, weights, diff2_llik, regsize, margin, offsetx, offsety, 1)
+
+	# accept the model as the delta model of the regions in acceptreg, starting from the data as residual
+	resid, model_acpt = data.copy(), np.zeros_like(data)
+	diff2_acpt = np.zeros(acceptreg.shape, dtype=np.float64)
+	boxes = np.zeros((acceptreg.size, 4), dtype=np.int32)
+	ix, iy = np.ceil(x).astype(np.int32), np.ceil(y).astype(np.int32)
+	args = (imsz[0], imsz[1], x.size, nc, ix, iy, model, resid, model_acpt, weights, acceptreg, diff2_acpt, boxes, regsize, margin, offsetx, offsety)
+	if cblas:
+		dchi2 = libmmult.pcat_imag_acpt_sparse(*args)
+	else:
+		dchi2 = libmmult.clib_updt_modl_sprs(*(args+(1,)))
+
+	return dict({'model':model, 'diff2_modl':diff2_modl, 'diff2_llik':diff2_llik, 'resid_acpt':resid, 'diff2_acpt':diff2_acpt, 'dchi2_acpt':np.array(dchi2)})
+
+def check_parity(names, side, nstar, regsize, margin, offsetx, offsety, seed=0):
+	'''
+	Runs kernel_outputs() for each available backend in names on a random catalog, with weights and data drawn at random and 
+	sparse acceptance over regions of one parity, and returns the largest relative difference of each output from the first backend.
+	'''
+	rng = np.random.RandomState(seed)
+	psf, cf, nc, nbin = get_gaussian_psf_template_3_5_20(pixel_fwhm=3.)
+	cf = np.ascontiguousarray(cf, dtype=np.float32)
+	imsz = (side, side)
+	x = rng.uniform(1, side-2, nstar).astype(np.float32)
+	y = rng.uniform(1, side-2, nstar).astype(np.float32)
+	f = rng.uniform(1, 100, nstar).astype(np.float32)
+	data = rng.normal(size=imsz).astype(np.float32)
+	weights = rng.uniform(0.5, 2., imsz).astype(np.float32)
+
+	# same-parity regions, so that the footprints of accepted regions do not overlap
+	acceptreg = np.zeros((side//regsize + 1, side//regsize + 1), dtype=np.int32)
+	acceptreg[1::2, 0::2] = rng.randint(2, size=acceptreg[1::2, 0::2].shape)
+
+	outputs = dict()
+	for name in names:
+		libmmult = load_backend(name)
+		if libmmult is None:
+			print('Backend '+name+' is not available, skipping')
+			continue
+		outputs[name] = kernel_outputs(libmmult, uses_pcat_names(name), x, y, f, imsz, nc, cf, data, weights, acceptreg, regsize, margin, offsetx, offsety)
+
+	ref = outputs[list(outputs)[0]]
+	diffs = dict()
+	for name, out in outputs.items():
+		diffs[name] = dict({key:np.max(np.abs(out[key]-ref[key]))/max(np.max(np.abs(ref[key])), 1.) for key in ref})
+	return diffs
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Per-call latency of the model evaluation kernel with fresh vs. persistent pixel hash workspaces.')
+	parser.add_argument('--lib', default='blas', help='compiled library to load (blas, blas-open, pcat-lion, pcat-lion-openblas)')
+	parser.add_argument('--imsz', type=int, nargs='+', default=[500, 1000, 2000, 4000], help='image side lengths in pixels')
+	parser.add_argument('--nstar', type=int, default=100, help='number of sources per proposal')
+	parser.add_argument('--regsize', type=int, default=20, help='region size in pixels')
+	parser.add_argument('--ncall', type=int, default=200, help='number of calls per configuration')
+	parser.add_argument('--parity', nargs='+', default=None, help='check that these backends give the same outputs instead of timing')
+	parser.add_argument('--margin', type=int, default=5, help='region margin in pixels, for --parity')
+	parser.add_argument('--offsets', type=int, nargs=2, default=[3, 7], help='region offsets in x and y, for --parity')
+	parser.add_argument('--tol', type=float, default=1e-5, help='largest relative difference accepted by --parity')
+	args = parser.parse_args()
+
+	if args.parity is not None:
+		ok = True
+		for side in args.imsz:
+			diffs = check_parity(args.parity, side, args.nstar, args.regsize, args.margin, args.offsets[0], args.offsets[1])
+			for name, diff in diffs.items():
+				print('%5d    %-8s    ' % (side, name) + '    '.join([key+' %.2e' % val for key, val in diff.items()]))
+				ok = ok and all([val <= args.tol for val in diff.values()])
+		print('Backends agree' if ok else 'Backends DISAGREE')
+		raise SystemExit(0 if ok else 1)
+
+	lib = load_model_eval(args.lib)
+	psf, cf, nc, nbin = get_gaussian_psf_template_3_5_20(pixel_fwhm=3.)
+	cf = np.ascontiguousarray(cf, dtype=np.float32)
+
+	print('imsz    nstar    fresh [ms]    persistent [ms]    speedup')
+	for side in args.imsz:
+		imsz = (side, side)
+		x = np.random.uniform(1, side-2, args.nstar).astype(np.float32)
+		y = np.random.uniform(1, side-2, args.nstar).astype(np.float32)
+		f = np.random.uniform(1, 100, args.nstar).astype(np.float32)
+		ref = np.zeros((side, side), dtype=np.float32)
+		weights = np.ones((side, side), dtype=np.float32)
+
+		dt_fresh = np.median(time_calls(lib, x, y, f, imsz, nc, cf, ref, weights, args.regsize, args.ncall, persistent=False))
+		dt_pers = np.median(time_calls(lib, x, y, f, imsz, nc, cf, ref, weights, args.regsize, args.ncall, persistent=True))
+		print('%5d    %5d    %10.3f    %15.3f    %7.2f' % (side, args.nstar, 1e3*dt_fresh, 1e3*dt_pers, dt_fresh/dt_pers))
@@ -1,5 +1,9 @@
 #include <stdlib.h>
+#include <math.h>
 #include <stdbool.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 #include "OpenBLAS/cblas.h"
 #include "i_malloc.h"
 //#include "mkl_cblas.h"
@@ -7,6 +11,15 @@
 #define max(a,b) ({ typeof (a) _a = (a); typeof (b) _b = (b); _a > _b ? _a : _b; })
 #define min(a,b) ({ typeof (a) _a = (a); typeof (b) _b = (b); _a < _b ? _a : _b; })
 
+// sets the number of OpenMP threads (of the calling thread only, so call it from each thread that runs kernels) used by the region and row band loops. if booldete > 0 the OpenBLAS matrix product is 
+// kept single-threaded, so results match the serial kernels bit for bit (the OpenMP loops are deterministic by construction)
+void clib_set_numb_thrd(int numbthrd, int booldete){
+#ifdef _OPENMP
+    omp_set_num_threads(numbthrd);
+#endif
+    openblas_set_num_threads(booldete > 0 ? 1 : numbthrd);
+}
+
 void clib_updt_modl(int numbsidexpos, int numbsideypos,
                     float* cntpmodl, float* cntpmodlacpt, int* regiacpt,
                     int sizeregi, int marg, int offsxpos, int offsypos, int booltile){
@@ -37,6 +50,109 @@ void clib_updt_modl(int numbsidexpos, int numbsideypos,
 }
 
 
+// range [*lo, *hi) of the margin-extended regions along one axis that overlap the pixels [p0, p1). region k covers
+// [k*regsize-offset-margin, (k+1)*regsize-offset+margin), and negative numerators (which truncate towards zero) are clamped to 0
+static void region_range(int p0, int p1, int regsize, int margin, int offset, int nreg, int* lo, int* hi){
+    *lo = max((p0 + offset - margin) / regsize, 0);
+    *hi = min((p1 + offset + margin + regsize - 1) / regsize, nreg);
+}
+
+
+double clib_updt_modl_sprs(int numbsidexpos, int numbsideypos, int numbphon, int numbpixlpsfnside, int* x, int* y,
+                           float* cntpmodl, float* cntpresi, float* cntpmodltotl, float* weig, int* regiacpt, double* chi2, int* boxs,
+                           int sizeregi, int marg, int offsxpos, int offsypos, int booltile){
+    
+    // sparse version of clib_updt_modl, which only visits the bounding box of the PSF stamps in each accepted region and updates
+    // the residual, the total model and the chi2 of each region (with margins) in place. assumes the footprints of accepted regions
+    // do not overlap. returns the change in the full-image chi2.
+    int NREGY, NREGX;
+    if (booltile > 0){
+        NREGX = (numbsidexpos / sizeregi) + 1;
+        NREGY = (numbsideypos / sizeregi) + 1;
+    }
+    else {
+        NREGX = (numbsidexpos / sizeregi);
+        NREGY = (numbsideypos / sizeregi);
+    }
+    int rad = numbpixlpsfnside / 2;
+    int i, j, ii, jj, r, p, regi, x0, x1, y0, y1, bx0, bx1, by0, by1;
+    int i0, i1, j0, j1;
+    double dchi2 = 0., dm;
+
+    for (r=0 ; r < NREGX*NREGY ; r++){
+        boxs[4*r] = numbsidexpos; boxs[4*r+1] = 0; boxs[4*r+2] = numbsideypos; boxs[4*r+3] = 0;
+    }
+
+    // bounding box of the phonion stamps within each accepted region
+    for (p = 0 ; p < numbphon ; p++){
+        bx0 = max(x[p]-rad, 0);
+        bx1 = min(x[p]+rad+1, numbsidexpos);
+        by0 = max(y[p]-rad, 0);
+        by1 = min(y[p]+rad+1, numbsideypos);
+        region_range(by0, by1, sizeregi, marg, offsypos, NREGY, &j0, &j1);
+        region_range(bx0, bx1, sizeregi, marg, offsxpos, NREGX, &i0, &i1);
+        for (j=j0 ; j < j1 ; j++){
+            y0 = max(max(j*sizeregi-offsypos-marg, 0), by0);
+            y1 = min(min((j+1)*sizeregi-offsypos+marg, numbsideypos), by1);
+            if (y0 >= y1) continue;
+            for (i=i0 ; i < i1 ; i++){
+                if (regiacpt[j*NREGX+i] <= 0) continue;
+                x0 = max(max(i*sizeregi-offsxpos-marg, 0), bx0);
+                x1 = min(min((i+1)*sizeregi-offsxpos+marg, numbsidexpos), bx1);
+                if (x0 >= x1) continue;
+                regi = 4*(j*NREGX+i);
+                boxs[regi] = min(boxs[regi], x0);
+                boxs[regi+1] = max(boxs[regi+1], x1);
+                boxs[regi+2] = min(boxs[regi+2], y0);
+                boxs[regi+3] = max(boxs[regi+3], y1);
+            }
+        }
+    }
+
+    // change in chi2 of every region overlapping a box, using the residual before the update
+    for (r=0 ; r < NREGX*NREGY ; r++){
+        bx0 = boxs[4*r]; bx1 = boxs[4*r+1]; by0 = boxs[4*r+2]; by1 = boxs[4*r+3];
+        if (bx0 >= bx1 || by0 >= by1) continue;
+        for (jj=by0 ; jj<by1; jj++){
+            for (ii=bx0 ; ii<bx1; ii++){
+                dm = cntpmodl[jj*numbsidexpos+ii];
+                dchi2 += (dm - 2.*cntpresi[jj*numbsidexpos+ii]) * dm * weig[jj*numbsidexpos+ii];
+            }
+        }
+        region_range(by0, by1, sizeregi, marg, offsypos, NREGY, &j0, &j1);
+        region_range(bx0, bx1, sizeregi, marg, offsxpos, NREGX, &i0, &i1);
+        for (j=j0 ; j < j1 ; j++){
+            y0 = max(max(j*sizeregi-offsypos-marg, 0), by0);
+            y1 = min(min((j+1)*sizeregi-offsypos+marg, numbsideypos), by1);
+            if (y0 >= y1) continue;
+            for (i=i0 ; i < i1 ; i++){
+                x0 = max(max(i*sizeregi-offsxpos-marg, 0), bx0);
+                x1 = min(min((i+1)*sizeregi-offsxpos+marg, numbsidexpos), bx1);
+                if (x0 >= x1) continue;
+                for (jj=y0 ; jj<y1; jj++){
+                    for (ii=x0 ; ii<x1; ii++){
+                        dm = cntpmodl[jj*numbsidexpos+ii];
+                        chi2[j*NREGX+i] += (dm - 2.*cntpresi[jj*numbsidexpos+ii]) * dm * weig[jj*numbsidexpos+ii];
+                    }
+                }
+            }
+        }
+    }
+
+    // implement the accepted delta model
+    for (r=0 ; r < NREGX*NREGY ; r++){
+        bx0 = boxs[4*r]; bx1 = boxs[4*r+1]; by0 = boxs[4*r+2]; by1 = boxs[4*r+3];
+        for (jj=by0 ; jj<by1; jj++){
+            for (ii=bx0 ; ii<bx1; ii++){
+                cntpresi[jj*numbsidexpos+ii] -= cntpmodl[jj*numbsidexpos+ii];
+                cntpmodltotl[jj*numbsidexpos+ii] += cntpmodl[jj*numbsidexpos+ii];
+            }
+        }
+    }
+
+    return dchi2;
+}
+
 void clib_eval_llik(int numbsidexpos, int numbsideypos, 
                     float* cntpmodl, float* cntpresi, float* weig, double* chi2,
                     int sizeregi, int marg, int offsxpos, int offsypos, int booltile){
@@ -53,6 +169,8 @@ void clib_eval_llik(int numbsidexpos, int numbsideypos,
     //printf("offsxpos, offsypos: %d %d\n", offsxpos, offsypos);
     
     int y0, y1, x0, x1, i, j, ii, jj;
+    // regions are independent, so each one is summed by a single thread in the same order as the serial loop
+    #pragma omp parallel for private(y0, y1, x0, x1, i, ii, jj) schedule(static)
     for (j=0 ; j < NREGY ; j++){
         y0 = max(j*sizeregi-offsypos-marg, 0);
         y1 = min((j+1)*sizeregi-offsypos+marg, numbsideypos);
@@ -80,7 +198,7 @@ void clib_eval_llik(int numbsidexpos, int numbsideypos,
 
 void clib_eval_modl(int numbsidexpos, int numbsideypos, int numbphon, int numbpixlpsfnside, int numbparaspix,
                      float* A, float* B, float* C,
-                     int* x, int* y, 
+                     int* x, int* y, int* hash,
                      float* cntpmodl, float* cntpresi, float* weig, double* chi2, 
                      int sizeregi, int marg, int offsxpos, int offsypos, int booltile)
 {
@@ -94,9 +212,7 @@ void clib_eval_modl(int numbsidexpos, int numbsideypos, int numbphon, int numbpi
     alpha = 1.; beta = 0.;
 
     // save time if there are many phonions per pixel by overwriting and shorting the A matrix
-    int hash[numbsideypos*numbsidexpos];
-    for (i=0; i<numbsideypos*numbsidexpos; i++)
-        hash[i] = -1;
+    // hash is a caller-owned workspace of numbsideypos*numbsidexpos entries that must be -1 on entry. only the touched entries are reset
 
     int numbphonshrt = 0;
     for (p = 0; p < numbphon; p++){
@@ -118,6 +234,8 @@ void clib_eval_modl(int numbsidexpos, int numbsideypos, int numbphon, int numbpi
         }
     }
     numbphon = numbphonshrt;
+    for (p = 0; p < numbphon; p++)
+        hash[y[p]*numbsidexpos+x[p]] = -1;
     
     //  matrix multiplication
     cblas_sgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans, 
@@ -136,18 +254,114 @@ void clib_eval_modl(int numbsidexpos, int numbsideypos, int numbphon, int numbpi
     // }
     
     //  loop over phonions, insert psfs into cntpmodl    
+    // with OpenMP each thread owns a band of rows and inserts the rows of every stamp that fall in it, in phonion order, 
+    // so there are no write conflicts and every pixel is summed in the same order as in the serial loop
+    #pragma omp parallel private(i, m, imax, j, r, jmax, p, xposthis, yposthis)
+    {
+    int rowmini = 0, rowmaxm = numbsideypos;
+#ifdef _OPENMP
+    rowmini = (numbsideypos*omp_get_thread_num())/omp_get_num_threads();
+    rowmaxm = (numbsideypos*(omp_get_thread_num()+1))/omp_get_num_threads();
+#endif
     for (p = 0 ; p < numbphon ; p++){
 	    xposthis = x[p];
 	    yposthis = y[p];
 	    imax = min(xposthis+rad, numbsidexpos-1);
-	    jmax = min(yposthis+rad, numbsideypos-1);
-	    for (j = max(yposthis-rad, 0), r = (p*numbpixlpsfnside+j-yposthis+rad)*numbpixlpsfnside ; j <= jmax ; j++, r+=numbpixlpsfnside){
+	    jmax = min(min(yposthis+rad, numbsideypos-1), rowmaxm-1);
+	    for (j = max(max(yposthis-rad, 0), rowmini), r = (p*numbpixlpsfnside+j-yposthis+rad)*numbpixlpsfnside ; j <= jmax ; j++, r+=numbpixlpsfnside){
 	        for (i = max(xposthis - rad, 0), m = i-xposthis+rad ; i <= imax ; i++, m++){
                 cntpmodl[j*numbsidexpos+i] += C[m+r];
             }
         }
     }
+    }
      
     //printf("sizeregi offsypos marg numbsideypos numbsidexpos: %d %d %d %d %d\n", sizeregi, sizeregi, marg, numbsideypos, numbsidexpos);
     clib_eval_llik(numbsidexpos, numbsideypos, cntpmodl, cntpresi, weig, chi2, sizeregi, marg, offsxpos, offsypos, booltile);
-}
\ No newline at end of file
+}
+
+// fused multiband evaluation: transforms the pivot band positions xpos, ypos to every band with the fast astrometry tables, 
+// builds the design matrix and evaluates each band model and its region chi2 with clib_eval_modl, summing the chi2 over bands.
+// astr holds, for each band b > 0 in turn, the 6 x AH x AW tables of fast_astrom.fit_astrom_arrays (xtrans, ytrans, dxpdx, dypdx,
+// dxpdy, dypdy), with astrdims[2*(b-1)] = AW and astrdims[2*(b-1)+1] = AH, or AW = 0 if band b shares the pivot band astrometry.
+// flux (numbband x numbphon) holds the band fluxes already scaled to pixel units, B (numbband x numbparaspix x numbpixlpsfn) the 
+// PSF coefficients, and xposband, yposband (numbband x numbphon) receive the transformed positions. cntpmodl, cntpresi, weig and 
+// hash are arrays of per-band pointers. the images are filled with the band backgrounds bacp first.
+void clib_eval_modl_mult(int numbband, int numbphon, int numbpixlpsfnside, int numbparaspix, float* xpos, float* ypos, float* flux,
+                     float* bacp, double* astr, int* astrdims, float* A, float* B, float* C, int* x, int* y, 
+                     float* xposband, float* yposband, int** hash, float** cntpmodl, float** cntpresi, float** weig,
+                     double* chi2band, double* chi2, int* imszs, int* sizeregi, int* marg, int* offsxpos, int* offsypos, int booltile)
+{
+    int b, p, r, xint, yint, numbphonband, numbsidexpos, numbsideypos, AW, AH, numbregi;
+    long indx, numbpixlastr, offs = 0;
+    float xposthis, yposthis, xposrond, yposrond, dx, dy, fluxthis;
+    double* tabl;
+    int numbpixlpsfn = numbpixlpsfnside*numbpixlpsfnside;
+
+    for (b = 0; b < numbband; b++){
+        numbsidexpos = imszs[2*b];
+        numbsideypos = imszs[2*b+1];
+        AW = 0; AH = 0;
+        if (b > 0){
+            AW = astrdims[2*(b-1)];
+            AH = astrdims[2*(b-1)+1];
+        }
+        tabl = astr + offs;
+        numbpixlastr = (long)AW*AH;
+
+        numbphonband = 0;
+        for (p = 0; p < numbphon; p++){
+            if (AW == 0){
+                xposthis = xpos[p];
+                yposthis = ypos[p];
+            }
+            else{
+                // same nearest-pixel linearization as fast_astrom.transform_q
+                xposrond = floorf(xpos[p]+0.5f);
+                yposrond = floorf(ypos[p]+0.5f);
+                xint = min(max((int)xposrond, 0), AW-1);
+                yint = min(max((int)yposrond, 0), AH-1);
+                indx = (long)yint*AW+xint;
+                xposthis = (float)(tabl[indx] + (xpos[p]-xposrond)*tabl[2*numbpixlastr+indx] + (ypos[p]-yposrond)*tabl[4*numbpixlastr+indx]);
+                yposthis = (float)(tabl[numbpixlastr+indx] + (xpos[p]-xposrond)*tabl[3*numbpixlastr+indx] + (ypos[p]-yposrond)*tabl[5*numbpixlastr+indx]);
+            }
+            xposband[b*numbphon+p] = xposthis;
+            yposband[b*numbphon+p] = yposthis;
+
+            // phonions outside the band image are dropped, as in image_model_eval
+            if (xposthis > 0 && xposthis < numbsidexpos-1 && yposthis > 0 && yposthis < numbsideypos-1){
+                x[numbphonband] = (int)ceilf(xposthis);
+                y[numbphonband] = (int)ceilf(yposthis);
+                dx = x[numbphonband] - xposthis;
+                dy = y[numbphonband] - yposthis;
+                fluxthis = flux[b*numbphon+p];
+                A[numbphonband*numbparaspix+0] = fluxthis;
+                A[numbphonband*numbparaspix+1] = fluxthis*dx;
+                A[numbphonband*numbparaspix+2] = fluxthis*dy;
+                A[numbphonband*numbparaspix+3] = fluxthis*dx*dx;
+                A[numbphonband*numbparaspix+4] = fluxthis*dx*dy;
+                A[numbphonband*numbparaspix+5] = fluxthis*dy*dy;
+                A[numbphonband*numbparaspix+6] = fluxthis*dx*dx*dx;
+                A[numbphonband*numbparaspix+7] = fluxthis*dx*dx*dy;
+                A[numbphonband*numbparaspix+8] = fluxthis*dx*dy*dy;
+                A[numbphonband*numbparaspix+9] = fluxthis*dy*dy*dy;
+                numbphonband++;
+            }
+        }
+
+        for (r = 0; r < numbsidexpos*numbsideypos; r++)
+            cntpmodl[b][r] = bacp[b];
+
+        clib_eval_modl(numbsidexpos, numbsideypos, numbphonband, numbpixlpsfnside, numbparaspix, A, B+(long)b*numbparaspix*numbpixlpsfn, C, \
+                       x, y, hash[b], cntpmodl[b], cntpresi[b], weig[b], chi2band, sizeregi[b], marg[b], offsxpos[b], offsypos[b], booltile);
+
+        if (booltile > 0)
+            numbregi = (numbsidexpos/sizeregi[b]+1)*(numbsideypos/sizeregi[b]+1);
+        else
+            numbregi = (numbsidexpos/sizeregi[b])*(numbsideypos/sizeregi[b]);
+        for (r = 0; r < numbregi; r++)
+            chi2[r] = (b == 0) ? chi2band[r] : chi2[r] + chi2band[r];
+
+        offs += 6*numbpixlastr;
+    }
+}
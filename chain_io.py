@@ -0,0 +1,394 @@
+import numpy as np
+import json
+import os
+import struct
+import zipfile
+
+''' This module writes the thinned samples of a PCAT run to an append-only directory store as they are produced (lion(chain_format='stream')),
+rather than holding them in preallocated arrays until the end of the run. Every field is a raw binary file of C-ordered rows, one per
+sample. Catalogs are stored as ragged fields, i.e. the source records of all samples concatenated in one file with the number of
+records per sample in a second file, so there is no max_nsrc padding. The number of complete rows of each field is kept in
+meta.json, which is replaced atomically after every sample, so the store can be read while the run is still going.
+
+Both chain.npz and the store save catalogs in the same ragged layout: float32 (x, y, f_0, ..., f_{nbands-1}) records of all samples
+concatenated in one array, with offsets such that sample j is records[offsets[j]:offsets[j+1]]. RaggedCatalog wraps that layout and
+returns per-sample views. ChainReader gives lazy, memory-mapped access to either a chain.npz or a store with the field names of
+chain.npz, as well as the zero-padded (nsamp, max_nsrc) x, y and f arrays of older chains. '''
+
+
+class RaggedCatalog():
+	'''
+	Catalog samples of a chain stored as concatenated source records and offsets.
+
+	Parameters
+	----------
+
+	records : '~numpy.ndarray' of shape (nrecord, ncolumn)
+		Source records of all samples, columns being (x, y, f_0, ..., f_{nbands-1}).
+
+	offsets : '~numpy.ndarray' of shape (nsamp+1,)
+		Index of the first record of each sample, followed by the total number of records.
+	'''
+	def __init__(self, records, offsets):
+		self.records = records
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+
+	@classmethod
+	def from_catalogs(cls, catalogs, ncolumn):
+		''' Concatenates a list of (nsrc, ncolumn) catalogs. '''
+		lengths = np.array([len(catalog) for catalog in catalogs], dtype=np.int64)
+		offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths)])
+		records = np.zeros((offsets[-1], ncolumn), dtype=np.float32)
+		for j, catalog in enumerate(catalogs):
+			records[offsets[j]:offsets[j+1]] = catalog
+		return cls(records, offsets)
+
+	@classmethod
+	def from_padded(cls, n, x, y, f):
+		''' Converts the zero-padded arrays of older chains, x and y of shape (nsamp, max_nsrc) and f of shape (nbands, nsamp, max_nsrc). '''
+		f = np.asarray(f)
+		return cls.from_catalogs([np.column_stack([x[j,:n[j]], y[j,:n[j]]]+[f[b,j,:n[j]] for b in range(f.shape[0])]) for j in range(len(n))], 2+f.shape[0])
+
+	def __len__(self):
+		return len(self.offsets)-1
+
+	def __getitem__(self, j):
+		''' Returns a view of the (nsrc, ncolumn) records of sample j, or a RaggedCatalog of a contiguous slice of samples. '''
+		if isinstance(j, slice):
+			start, stop, step = j.indices(len(self))
+			if step != 1:
+				raise ValueError('only contiguous slices of a RaggedCatalog are supported')
+			stop = max(start, stop)
+			return RaggedCatalog(self.records[self.offsets[start]:self.offsets[stop]], self.offsets[start:stop+1]-self.offsets[start])
+		if j < 0:
+			j += len(self)
+		return self.records[self.offsets[j]:self.offsets[j+1]]
+
+	@property
+	def lengths(self):
+		return np.diff(self.offsets)
+
+	def column(self, column):
+		''' List of per-sample views of one column of the records, e.g. column(0) for the x positions of each sample. '''
+		return [self.records[self.offsets[j]:self.offsets[j+1], column] for j in range(len(self))]
+
+	def padded(self, column, max_nsrc):
+		''' Column of the records as a zero-padded (nsamp, max_nsrc) array. '''
+		sample_idx = np.repeat(np.arange(len(self)), self.lengths)
+		padded = np.zeros((len(self), max_nsrc), dtype=self.records.dtype)
+		padded[sample_idx, np.arange(len(sample_idx))-self.offsets[sample_idx]] = self.records[self.offsets[0]:self.offsets[-1], column]
+		return padded
+
+
+class ChainWriter():
+	'''
+	Appends samples to a chain store in directory dirpath.
+
+	Parameters
+	----------
+
+	dirpath : str
+		Directory of the store, created if needed.
+
+	fields : dict
+		Shape and dtype (shape, dtype) of a single row of each field.
+
+	ragged_fields : dict, optional
+		Shape and dtype of a single record of each ragged field. Any number of records can be appended per sample.
+
+	attrs : dict, optional
+		JSON serializable attributes saved in meta.json.
+
+	counts : dict, optional
+		Number of rows of each field (and of records and samples of each ragged field) to keep from an existing store, as returned by
+		get_state(). Data written after that point is truncated, which is used when resuming a run from a checkpoint. If None,
+		the store is started from scratch.
+	'''
+	def __init__(self, dirpath, fields, ragged_fields=None, attrs=None, counts=None):
+		self.dirpath = dirpath
+		if not os.path.isdir(dirpath):
+			os.makedirs(dirpath)
+
+		if ragged_fields is None:
+			ragged_fields = dict()
+		self.specs = dict()
+		for name, (shape, dtype) in fields.items():
+			self.specs[name] = dict({'shape':list(shape), 'dtype':np.dtype(dtype).str, 'ragged':False})
+		for name, (shape, dtype) in ragged_fields.items():
+			self.specs[name] = dict({'shape':list(shape), 'dtype':np.dtype(dtype).str, 'ragged':True})
+
+		self.attrs = dict() if attrs is None else attrs
+
+		# bytes per row of each file, ragged fields having a second file with the number of records of each sample
+		row_nbytes = dict()
+		for name, spec in self.specs.items():
+			row_nbytes[name] = int(np.prod(spec['shape']))*np.dtype(spec['dtype']).itemsize
+			if spec['ragged']:
+				row_nbytes[name+'_lengths'] = np.dtype(np.int64).itemsize
+
+		self.counts = dict()
+		self.files = dict()
+		for key, nbytes in row_nbytes.items():
+			path = self.dirpath+'/'+key+'.bin'
+			nrow = 0 if counts is None else counts[key]
+			with open(path, 'ab') as file:
+				file.truncate(nrow*nbytes)
+			self.counts[key] = nrow
+			self.files[key] = open(path, 'ab')
+
+		self.write_meta()
+
+	def write_rows(self, key, rows):
+		self.files[key].write(np.ascontiguousarray(rows).tobytes())
+		self.counts[key] += len(rows)
+
+	def append(self, values):
+		'''
+		Appends one row to each field in values. Ragged fields take an array of shape (nrecord,)+record shape, fields of
+		the store that are not in values are left unchanged. The rows are visible to readers once this returns.
+		'''
+		for name, value in values.items():
+			spec = self.specs[name]
+			value = np.asarray(value, dtype=spec['dtype'])
+			if spec['ragged']:
+				value = value.reshape([-1]+spec['shape'])
+				self.write_rows(name, value)
+				self.write_rows(name+'_lengths', np.array([value.shape[0]], dtype=np.int64))
+			else:
+				self.write_rows(name, value.reshape([1]+spec['shape']))
+
+		for name in values:
+			self.files[name].flush()
+			if self.specs[name]['ragged']:
+				self.files[name+'_lengths'].flush()
+		self.write_meta()
+
+	def write_meta(self):
+		meta = dict({'fields':self.specs, 'counts':self.counts, 'attrs':self.attrs})
+		path = self.dirpath+'/meta.json'
+		with open(path+'.tmp', 'w') as file:
+			json.dump(meta, file)
+		os.replace(path+'.tmp', path)
+
+	def get_state(self):
+		''' Syncs the files of the store to disk and returns the number of rows of each file, to be passed back as counts on resuming. '''
+		for file in self.files.values():
+			file.flush()
+			os.fsync(file.fileno())
+		return dict(self.counts)
+
+	def close(self):
+		for file in self.files.values():
+			file.close()
+		self.write_meta()
+
+
+class ChainStore():
+	'''
+	Read access to a chain store written by ChainWriter. Fields are returned as read-only memory maps of the rows that were complete
+	when the store was opened (or last refreshed with refresh()), so reading a store during a run does not interfere with the writer.
+	'''
+	def __init__(self, dirpath):
+		self.dirpath = dirpath
+		self.refresh()
+
+	def refresh(self):
+		with open(self.dirpath+'/meta.json', 'r') as file:
+			meta = json.load(file)
+		self.specs = meta['fields']
+		self.counts = meta['counts']
+		self.attrs = meta['attrs']
+
+	def __contains__(self, name):
+		return name in self.specs
+
+	def memmap(self, key, dtype, shape):
+		if self.counts[key] == 0:
+			return np.zeros([0]+list(shape), dtype=dtype)
+		return np.memmap(self.dirpath+'/'+key+'.bin', dtype=dtype, mode='r', shape=tuple([self.counts[key]]+list(shape)))
+
+	def field(self, name):
+		''' Array of shape (nrow,)+row shape of a field, or the concatenated records of a ragged field. '''
+		spec = self.specs[name]
+		return self.memmap(name, spec['dtype'], spec['shape'])
+
+	def offsets(self, name):
+		''' Offsets of the records of each sample of a ragged field, so that sample j is records offsets[j]:offsets[j+1]. '''
+		lengths = self.memmap(name+'_lengths', np.int64, [])
+		return np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths)])
+
+	def nsamp(self, name):
+		if self.specs[name]['ragged']:
+			return self.counts[name+'_lengths']
+		return self.counts[name]
+
+
+# fields of a chain with one entry per sample along this axis, which burn-in is applied to. Other fields (residuals, model images) are not sliced
+sample_axes = dict({'n':0, 'catalog':0, 'source_ids':0, 'x':0, 'y':0, 'f':1, 'chi2':0, 'times':0, 'accept':0, 'swap_accept':0, 'diff2s':0, 'rtypes':0, 'accepts':0, \
+					'bkg':0, 'template_amplitudes':0, 'fourier_coeffs':0, 'fc_rel_amps':0})
+
+# fields read by ChainReader in this process, per chain file or store, as ((modification time, size), dict of fields)
+field_cache = dict()
+
+
+def clear_field_cache():
+	field_cache.clear()
+
+
+def npz_member_memmap(path, name):
+	''' Read-only memory map of member name of an npz file, or None if the member is compressed, empty or holds objects. '''
+	with zipfile.ZipFile(path) as zfile:
+		info = zfile.getinfo(name+'.npy')
+	if info.compress_type != zipfile.ZIP_STORED:
+		return None
+	with open(path, 'rb') as file:
+		# the array starts after the local file header, whose size depends on the lengths of the file name and extra field
+		file.seek(info.header_offset)
+		local_header = struct.unpack('<4s5H3I2H', file.read(30))
+		file.seek(info.header_offset+30+local_header[-2]+local_header[-1])
+		version = np.lib.format.read_magic(file)
+		if version == (1, 0):
+			shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+		else:
+			shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+		offset = file.tell()
+	if dtype.hasobject or int(np.prod(shape)) == 0:
+		return None
+	return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+class ChainReader():
+	'''
+	Lazy read access to the chain of a run, saved either as chain.npz or as a chain store (lion(chain_format='stream')), with the 
+	field names of chain.npz. Fields are only read when accessed. Uncompressed arrays of chain.npz and all fields of a store are 
+	memory-mapped, so that reading a few samples of a large field does not load all of it. Fields are cached in the process and
+	shared by all readers of the same chain until it is modified.
+
+	Besides the saved fields, 'catalog' returns the catalog samples as a RaggedCatalog and x, y and f return them as zero-padded
+	arrays, for chains saved in either the ragged or the older padded layout. 'source_ids' returns the stable identifiers of the 
+	sources of each sample, in the order of the catalog records, as a RaggedCatalog of one-dimensional records.
+
+	Parameters
+	----------
+
+	path : str
+		Run directory, or path to a chain.npz file.
+
+	burn_in : int, optional
+		Number of initial samples dropped from every per-sample field. Fields are returned as views of the cached arrays.
+		Default is 0.
+	'''
+	def __init__(self, path, burn_in=0):
+		if os.path.isfile(path+'/chain.npz'):
+			path = path+'/chain.npz'
+		elif os.path.isdir(path+'/chain'):
+			path = path+'/chain'
+		self.path = os.path.realpath(path)
+		self.burn_in = burn_in
+
+		if os.path.isdir(self.path):
+			self.store = ChainStore(self.path)
+			self.files = list(self.store.specs.keys())
+			self.attrs = self.store.attrs
+			stat = os.stat(self.path+'/meta.json')
+		else:
+			self.store = None
+			with zipfile.ZipFile(self.path) as zfile:
+				self.files = [name[:-len('.npy')] for name in zfile.namelist()]
+			stat = os.stat(self.path)
+
+		version = (stat.st_mtime_ns, stat.st_size)
+		if self.path not in field_cache or field_cache[self.path][0] != version:
+			field_cache[self.path] = (version, dict())
+		self.cache = field_cache[self.path][1]
+
+	def __contains__(self, key):
+		return key in self.files or key in ['catalog', 'x', 'y', 'f']
+
+	def keys(self):
+		return list(self.files)
+
+	@property
+	def nsamp(self):
+		''' Number of samples after burn-in. '''
+		return len(self['n'])
+
+	def __getitem__(self, key):
+		if key not in self.cache:
+			self.cache[key] = self.read(key)
+		value = self.cache[key]
+		if self.burn_in == 0 or key not in sample_axes or value is None:
+			return value
+		if sample_axes[key] == 1:
+			return value[:, self.burn_in:]
+		return value[self.burn_in:]
+
+	def read(self, key):
+		if key in ['x', 'y', 'f'] and (self.store is not None or 'catalog' in self.files):
+			return self.padded_catalog(key)
+		if self.store is not None:
+			return self.read_store(key)
+		return self.read_npz(key)
+
+	def read_npz(self, key):
+		if key == 'catalog':
+			if 'catalog' in self.files:
+				return RaggedCatalog(self.read_npz_member('catalog'), self.read_npz_member('catalog_offsets'))
+			return RaggedCatalog.from_padded(self.read_npz_member('n'), self.read_npz_member('x'), self.read_npz_member('y'), self.read_npz_member('f'))
+		if key == 'source_ids' and key in self.files:
+			return RaggedCatalog(self.read_npz_member('source_ids'), self.read_npz_member('catalog_offsets'))
+		if key not in self.files:
+			raise KeyError(key)
+		return self.read_npz_member(key)
+
+	def read_npz_member(self, key):
+		value = npz_member_memmap(self.path, key)
+		if value is None:
+			# placeholders saved as None, e.g. the residuals of missing bands, are stored as object arrays
+			with np.load(self.path, allow_pickle=True) as npz:
+				value = npz[key]
+			if value.dtype.hasobject and value.shape == ():
+				value = value.item()
+		return value
+
+	def read_store(self, key):
+		nsamp = self.store.nsamp('n')
+		if key == 'catalog':
+			return RaggedCatalog(self.store.field('catalog'), self.store.offsets('catalog'))[:nsamp]
+		if key == 'source_ids' and key in self.store:
+			return RaggedCatalog(self.store.field('source_ids'), self.store.offsets('source_ids'))[:nsamp]
+		if key == 'swap_accept':
+			swap_accept = np.full(nsamp, np.nan, dtype=np.float32)
+			values = self.store.field('swap_accept')[:nsamp]
+			swap_accept[:len(values)] = values
+			return swap_accept
+		if key in self.store:
+			return self.store.field(key)[:nsamp]
+		# fields that were not written are returned as the defaults saved by Samples.save_samples()
+		if key.startswith('residuals') or key.startswith('model_images'):
+			return None
+		if key == 'fourier_coeffs':
+			nterms = self.attrs['n_fourier_terms']
+			return np.zeros((nsamp, nterms, nterms, 4))
+		if key == 'fc_rel_amps':
+			return np.zeros((nsamp, self.attrs['nbands']))
+		raise KeyError(key)
+
+	def padded_catalog(self, key):
+		if self.store is not None:
+			max_nsrc, nbands = self.attrs['max_nsrc'], self.attrs['nbands']
+		else:
+			max_nsrc, nbands = int(self.read_npz_member('max_nsrc')), int(self.read_npz_member('nbands'))
+		if 'catalog' not in self.cache:
+			self.cache['catalog'] = self.read('catalog')
+		catalog = self.cache['catalog']
+		if key == 'x':
+			return catalog.padded(0, max_nsrc)
+		if key == 'y':
+			return catalog.padded(1, max_nsrc)
+		return np.array([catalog.padded(2+b, max_nsrc) for b in range(nbands)])
+
+
+def load_chain(run_dir, burn_in=0):
+	''' Returns a ChainReader of the chain of the run in directory run_dir, saved either as chain.npz or as a chain store in run_dir/chain. '''
+	return ChainReader(run_dir, burn_in=burn_in)
@@ -5,87 +5,228 @@ from astropy.io import fits
 import matplotlib.pyplot as plt
 from astropy.stats import sigma_clipped_stats
 from image_eval import psf_poly_fit, image_model_eval
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, gaussian_filter1d
+from scipy.linalg import cho_factor, cho_solve
+import hashlib
+import os
+import tempfile
+from backends import get_cache_dir
 
 
+def noise_weights(error, mean_sig=True):
+    '''
+    Inverse variance weights of the pixels of a noise map. Pixels with zero, infinite or NaN noise get zero weight.
+    If mean_sig is True, every pixel is given unit weight, and the mean noise variance is applied to the solution instead.
+    '''
+    if mean_sig:
+        return np.ones(error.size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = error.astype(np.float64).ravel()**(-2)
+    weights[~np.isfinite(weights)] = 0.
+    return weights
+
+def normal_matrix(ravel_temps, weights):
+    '''
+    Noise-weighted normal matrix B W B^T of a set of raveled templates B, with the diagonal W given as a weight vector.
+
+    Parameters
+    ----------
+
+    ravel_temps : `~numpy.ndarray' of shape (ntemp, npix), or list of them
+        Raveled templates. For a list, e.g. one entry per band of a joint fit, the normal matrices of the entries are summed.
+
+    weights : `~numpy.ndarray' of shape (npix,), or list of them
+
+    Returns
+    -------
+
+    bt_siginv_b : `~numpy.ndarray' of shape (ntemp, ntemp)
+
+    '''
+    if isinstance(ravel_temps, list):
+        return np.sum([normal_matrix(temps, w) for temps, w in zip(ravel_temps, weights)], axis=0)
+    return np.dot(ravel_temps*weights, ravel_temps.transpose())
+
+def normal_matrix_key(ravel_temps, fourier_templates, weights, n_terms, ridge_fac):
+    ''' Hash of the templates, pixel weights (and so the mask), expansion order and ridge factor, used to name cached factorizations. '''
+    sha = hashlib.sha256()
+    if isinstance(fourier_templates, FourierBasis):
+        # the 1D factors fix the image size, PSF and field of view of the templates
+        sha.update(np.ascontiguousarray(fourier_templates.rows[:, :n_terms]).tobytes())
+        sha.update(np.ascontiguousarray(fourier_templates.cols[:, :n_terms]).tobytes())
+    else:
+        sha.update(np.ascontiguousarray(ravel_temps).tobytes())
+    sha.update(np.ascontiguousarray(weights).tobytes())
+    sha.update(repr((n_terms, ridge_fac)).encode())
+    return sha.hexdigest()[:16]
+
+def factor_normal_matrix(bt_siginv_b, ridge_fac=None):
+    '''
+    Cholesky factorization of the normal matrix, with ridge_fac added to the diagonal if given. An ill-conditioned matrix that is not
+    numerically positive definite raises numpy.linalg.LinAlgError, in which case ridge_fac should be raised.
+    '''
+    if ridge_fac is not None:
+        bt_siginv_b = bt_siginv_b + ridge_fac*np.eye(bt_siginv_b.shape[0])
+    return cho_factor(bt_siginv_b, lower=True)
+
+def cached_normal_factorization(ravel_temps, fourier_templates, weights, n_terms, ridge_fac=None, cache_dir=None):
+    '''
+    Normal matrix of the Fourier templates and its Cholesky factorization, loaded from the cache directory if the same templates,
+    weights and ridge factor have been used before, e.g. by an earlier run on the same field, and computed and saved otherwise.
+
+    Parameters
+    ----------
+
+    ravel_temps : `~numpy.ndarray' of shape (4*n_terms**2, npix), or None
+        Raveled templates. Only used if fourier_templates is not a FourierBasis, or if the factorization is not cached.
+
+    fourier_templates : `FourierBasis', or None
+
+    weights : `~numpy.ndarray' of shape (npix,)
+
+    n_terms : int
+
+    ridge_fac : float, optional
+        Ridge regularization added to the diagonal before factorizing. Default is 'None'.
+
+    cache_dir : str, optional
+        Directory of cached factorizations. If left unspecified, the kernel cache directory of backends.get_cache_dir() is used. 
+        Default is 'None'.
+
+    Returns
+    -------
+
+    bt_siginv_b : `~numpy.ndarray' of shape (4*n_terms**2, 4*n_terms**2)
+
+    factor : tuple
+        Cholesky factor of bt_siginv_b (plus ridge), in the form used by scipy.linalg.cho_solve.
+
+    '''
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    cached = os.path.join(cache_dir, 'fourier_normal-'+normal_matrix_key(ravel_temps, fourier_templates, weights, n_terms, ridge_fac)+'.npz')
+
+    if os.path.isfile(cached):
+        with np.load(cached) as f:
+            return f['bt_siginv_b'], (f['factor'], True)
+
+    if ravel_temps is None:
+        ravel_temps = fourier_templates.design_matrix(n_terms)
+    bt_siginv_b = normal_matrix(ravel_temps, weights)
+    factor = factor_normal_matrix(bt_siginv_b, ridge_fac=ridge_fac)
+
+    # written under a temporary name first, so that concurrent runs never read a partial file
+    tmpfile = tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npz', delete=False)
+    with tmpfile:
+        np.savez(tmpfile, bt_siginv_b=bt_siginv_b, factor=factor[0])
+    os.replace(tmpfile.name, cached)
+
+    return bt_siginv_b, factor
+
 def compute_Ahat_templates(n_terms, error, imsz=None, bt_siginv_b=None, bt_siginv_b_inv=None,\
                            ravel_temps=None, fourier_templates=None, data=None, psf_fwhm=3., \
-                          mean_sig=True, ridge_fac = None, show=False, inpaint_nans=True, x_max_pivot=None):
+                          mean_sig=True, ridge_fac = None, show=False, inpaint_nans=True, x_max_pivot=None, \
+                          use_cache=True, cache_dir=None):
     
-    # NOTE -- this only works for single band at the moment. Is there a way to compute the Moore-Penrose inverse for 
-    # backgrounds observed over several bands with a fixed color prior? 
+    '''
+    Least squares (Moore-Penrose) estimate of the Fourier coefficients of an image, solving the noise-weighted normal equations 
+    (B^T S^{-1} B + ridge_fac I) A_hat = B^T S^{-1} K with a Cholesky factorization. The factorization depends only on the templates 
+    and the noise map, so it is cached on disk and reused by later calls on the same field.
 
-    # also , I think that using the full noise model in the matrix product is necessary when using multiband and multi-region
-    # evaluations. This migth already be handled in the code by zeroing out NaNs.
+    Parameters
+    ----------
 
-    if imsz is None:
-        imsz = error.shape
+    n_terms : int
+        Order of Fourier expansion.
 
-    if fourier_templates is None and ravel_temps is None:
-        fourier_templates = make_fourier_templates(imsz[0], imsz[1], n_terms, psf_fwhm=psf_fwhm, x_max_pivot=x_max_pivot)
+    error : `~numpy.ndarray' of shape (N, M)
+        Noise map. Pixels with zero or NaN noise are excluded from the fit when mean_sig is False.
 
-    if ravel_temps is None:
-        ravel_temps = ravel_temps_from_ndtemp(fourier_templates, n_terms)
-    
-    err_cut_rav = error.ravel()
+    bt_siginv_b, bt_siginv_b_inv : `~numpy.ndarray', optional
+        Normal matrix and its inverse (as returned by a previous call). If bt_siginv_b is given, it is factorized instead of being
+        computed from the templates. bt_siginv_b_inv is used as is to solve for the coefficients. Default is 'None'.
 
-    if bt_siginv_b_inv is None:
-        if mean_sig:
-            bt_siginv_b = np.dot(ravel_temps, ravel_temps.transpose())
-        else:
-            bt_siginv_b = np.dot(ravel_temps, np.dot(np.diag(err_cut_rav**(-2)), ravel_temps.transpose()))
-        
-        print('condition number of (B^T S^{-1} B)^{-1}: ', np.linalg.cond(bt_siginv_b))
-        
-        if ridge_fac is not None:
+    ravel_temps, fourier_templates : optional
+        Raveled templates, or a FourierBasis or template array. If neither is given, a FourierBasis is generated from imsz, 
+        psf_fwhm and x_max_pivot. Default is 'None'.
 
-            print('adding regularization')
-            lambda_I = np.zeros_like(bt_siginv_b)
-            np.fill_diagonal(lambda_I, ridge_fac)
-            bt_siginv_b_inv = np.linalg.inv(bt_siginv_b + lambda_I)
+    data : `~numpy.ndarray' of shape (N, M), optional
+        Image to fit. If inpaint_nans is True, NaN pixels are set (in place) to the mean of the image. Default is 'None'.
 
-        else:
-            bt_siginv_b_inv = np.linalg.inv(bt_siginv_b)
+    mean_sig : bool, optional
+        If True, every pixel is weighted by the mean noise variance, otherwise by its own. Default is True.
 
+    ridge_fac : float, optional
+        Ridge regularization of the normal matrix. Default is 'None'.
 
-    if mean_sig:
-        bt_siginv_b_inv *= np.nanmean(error.astype(np.float64))**2
-                
-    
-    if data is not None:
-        im_cut_rav = data.ravel()
+    use_cache : bool, optional
+        If True, the factorization of the normal matrix is read from/written to cache_dir. Default is True.
 
-        if inpaint_nans:
-            nan_idxs = np.where(np.isnan(im_cut_rav))[0]
-            for nan_idx in nan_idxs:
-                im_cut_rav[nan_idx] = np.nanmean(im_cut_rav)
+    cache_dir : str, optional
+        See cached_normal_factorization(). Default is 'None'.
 
-        if mean_sig:
-            siginv_K_rav = im_cut_rav*np.nanmean(error)**(-2)
-        else:
-            siginv_K_rav = im_cut_rav*err_cut_rav**(-2)
+    Returns
+    -------
 
+    fourier_templates, ravel_temps, bt_siginv_b, bt_siginv_b_inv, A_hat if data is given, otherwise fourier_templates, ravel_temps, 
+    bt_siginv_b_inv, A_hat, where bt_siginv_b_inv is the covariance of the coefficients A_hat (of shape (4*n_terms**2,)).
 
+    '''
+    # NOTE -- this only works for single band at the moment. Is there a way to compute the Moore-Penrose inverse for 
+    # backgrounds observed over several bands with a fixed color prior? normal_matrix() already sums over lists of
+    # templates and weights, which would be the first step of a joint fit.
 
-        siginv_K_rav[np.isinf(siginv_K_rav)] = 0.
+    if imsz is None:
+        imsz = error.shape
 
-        bt_siginv_K = np.dot(ravel_temps, siginv_K_rav)
+    if fourier_templates is None and ravel_temps is None:
+        fourier_templates = FourierBasis(imsz[0], imsz[1], n_terms, psf_fwhm=psf_fwhm, x_max_pivot=x_max_pivot)
 
-        A_hat = np.dot(bt_siginv_b_inv, bt_siginv_K)
+    if ravel_temps is None and not isinstance(fourier_templates, FourierBasis):
+        ravel_temps = ravel_temps_from_ndtemp(fourier_templates, n_terms)
 
+    weights = noise_weights(error, mean_sig=mean_sig)
+    if mean_sig:
+        var_scale = np.nanmean(error.astype(np.float64))**2
+    else:
+        var_scale = 1.
 
-        arr_3d = np.empty((n_terms,n_terms,4))
-        count = 0
-        for i in range(n_terms):
-            for j in range(n_terms):
-                for k in range(4):
-                    arr_3d[i,j,k] = A_hat[count]
-                    count += 1
+    factor = None
+    if bt_siginv_b_inv is None:
+        if bt_siginv_b is not None:
+            factor = factor_normal_matrix(bt_siginv_b, ridge_fac=ridge_fac)
+        elif use_cache:
+            bt_siginv_b, factor = cached_normal_factorization(ravel_temps, fourier_templates, weights, n_terms, ridge_fac=ridge_fac, cache_dir=cache_dir)
+        else:
+            if ravel_temps is None:
+                ravel_temps = fourier_templates.design_matrix(n_terms)
+            bt_siginv_b = normal_matrix(ravel_temps, weights)
+            factor = factor_normal_matrix(bt_siginv_b, ridge_fac=ridge_fac)
 
+        bt_siginv_b_inv = var_scale*cho_solve(factor, np.eye(factor[0].shape[0]))
+    
+    if data is not None:
 
-        temp_A_hat = generate_template(arr_3d, n_terms, fourier_templates=fourier_templates, N=imsz[0], M=imsz[1], x_max_pivot=x_max_pivot)
+        if inpaint_nans:
+            data[np.isnan(data)] = np.nanmean(data)
+
+        siginv_K = data.astype(np.float64)*weights.reshape(data.shape)
+        siginv_K[~np.isfinite(siginv_K)] = 0.
+
+        if ravel_temps is None:
+            bt_siginv_K = fourier_templates.project(siginv_K, n_terms).ravel()
+        else:
+            bt_siginv_K = np.dot(ravel_temps, siginv_K.ravel())
+
+        if factor is not None:
+            # the mean noise variance of mean_sig cancels between the two sides of the normal equations
+            A_hat = cho_solve(factor, bt_siginv_K)
+        else:
+            A_hat = np.dot(bt_siginv_b_inv, bt_siginv_K)/var_scale
 
         if show:
+            arr_3d = A_hat.reshape((n_terms, n_terms, 4))
+            temp_A_hat = generate_template(arr_3d, n_terms, fourier_templates=fourier_templates, N=imsz[0], M=imsz[1], x_max_pivot=x_max_pivot)
 
             plt.figure(figsize=(10,10))
             plt.suptitle('Moore-Penrose inverse, $N_{FC}$='+str(n_terms), fontsize=20)
@@ -127,6 +268,150 @@ def ravel_temps_from_ndtemp(templates, n_terms, auxdim=4):
     
     return ravel_temps
 
+class FourierBasis():
+    '''
+    Separable 2D Fourier templates of an N x M image. Template (i, j, k) is the outer product of a 1D sine or cosine of order j+1
+    along the first image axis and one of order i+1 along the second axis (k = 0, 1, 2, 3 for sin-sin, sin-cos, cos-sin and cos-cos,
+    the first factor of each name being the one of order i), so only the 1D factors are stored, which takes O(n_terms (N+M)) memory
+    rather than the O(n_terms^2 N M) of the dense template cube. The optional Gaussian smoothing by the PSF is separable as well,
+    and is applied to the 1D factors. Sums over templates are evaluated as products of the factor matrices in O(n_terms N M) time.
+
+    Parameters
+    ----------
+
+    N : int
+        length of image
+
+    M : int
+        width of image
+
+    n_terms : int
+        Order of Fourier expansion.
+
+    psf_fwhm : float, optional
+        Observation PSF full width at half maximum (FWHM), used to pre-convolve the templates. Default is 'None'.
+
+    shift : bool, optional
+        if True, the sines have half-integer orders. Default is False.
+
+    x_max_pivot : float, optional
+        Indicating pixel coordinate for boundary of FOV in each dimension. Default is 'None'.
+
+    '''
+    def __init__(self, N, M, n_terms, psf_fwhm=None, shift=False, x_max_pivot=None):
+        self.N, self.M, self.n_terms = N, M, n_terms
+
+        N_denom = N
+        M_denom = M
+        if x_max_pivot is not None:
+            N_denom = x_max_pivot
+            M_denom = x_max_pivot
+
+        orders = np.arange(1, n_terms+1)
+        sin_orders = orders - 0.5 if shift else orders
+        # factors along the second image axis (orders i) and the first image axis (orders j), sines first
+        self.cols = np.array([np.sin(np.outer(sin_orders, np.pi*np.arange(M)/N_denom)), np.cos(np.outer(orders, np.pi*np.arange(M)/N_denom))])
+        self.rows = np.array([np.sin(np.outer(sin_orders, np.pi*np.arange(N)/M_denom)), np.cos(np.outer(orders, np.pi*np.arange(N)/M_denom))])
+
+        if psf_fwhm is not None: # if beam size given, convolve with PSF assumed to be Gaussian
+            self.cols = gaussian_filter1d(self.cols, sigma=psf_fwhm/2.355, axis=-1)
+            self.rows = gaussian_filter1d(self.rows, sigma=psf_fwhm/2.355, axis=-1)
+
+    def template(self, i, j, k):
+        ''' Template (i, j, k) as an (N, M) array. '''
+        return np.outer(self.rows[k%2, j], self.cols[k//2, i])
+
+    def evaluate(self, coeffs):
+        '''
+        Sum of the templates weighted by coeffs.
+
+        Parameters
+        ----------
+
+        coeffs : `~numpy.ndarray' of shape (..., n, n, 4)
+            Coefficients of the first n <= n_terms orders. Leading dimensions, e.g. over chain samples, are evaluated together.
+
+        Returns
+        -------
+
+        sum_temp : `~numpy.ndarray' of shape (..., N, M)
+
+        '''
+        n = coeffs.shape[-3]
+        rows, cols = self.rows[:, :n], self.cols[:, :n]
+        coeffs_t = np.swapaxes(coeffs, -2, -3)
+        sum_temp = np.matmul(rows[0].T, np.matmul(coeffs_t[...,0], cols[0]) + np.matmul(coeffs_t[...,2], cols[1]))
+        sum_temp += np.matmul(rows[1].T, np.matmul(coeffs_t[...,1], cols[0]) + np.matmul(coeffs_t[...,3], cols[1]))
+        return sum_temp
+
+    def project(self, image, n=None, y0=0, x0=0):
+        '''
+        Dot products of an (N, M) image with the templates of the first n orders, as an (n, n, 4) array. This is the adjoint of evaluate().
+        A smaller image is projected onto the templates restricted to the box of the same shape with lower corner (y0, x0), at a cost
+        proportional to its size.
+        '''
+        if n is None:
+            n = self.n_terms
+        rows = self.rows[:, :n, y0:y0+image.shape[0]]
+        cols = self.cols[:, :n, x0:x0+image.shape[1]]
+        proj = np.matmul(np.matmul(rows[:, None], image), np.swapaxes(cols[None], -1, -2))
+        # proj[s, c] holds the products with row factor s and column factor c, indexed (j, i)
+        return np.stack([proj[k%2, k//2].T for k in range(4)], axis=2)
+
+    def weighted_gram(self, weights, n=None):
+        '''
+        Noise-weighted dot products <T_p, W T_q> of all pairs of templates of the first n orders, with W the diagonal matrix of the
+        (N, M) weight map. The products of two templates are separable too, so this costs O(n^2 N M) rather than the O(n^4 N M) of
+        multiplying out the design matrix.
+
+        Returns
+        -------
+
+        gram : `~numpy.ndarray' of shape (4 n^2, 4 n^2)
+            Rows and columns ordered as in design_matrix().
+
+        '''
+        if n is None:
+            n = self.n_terms
+        rows = self.rows[:, :n].reshape(2*n, self.N)
+        cols = self.cols[:, :n].reshape(2*n, self.M)
+        row_pairs = (rows[:,None,:]*rows[None,:,:]).reshape(4*n*n, self.N)
+        col_pairs = (cols[:,None,:]*cols[None,:,:]).reshape(4*n*n, self.M)
+        pair_gram = np.dot(np.dot(row_pairs, weights), col_pairs.T).reshape((2*n,)*4)
+
+        # row and column factor of each template, in (i, j, k) order
+        i, j, k = [idx.ravel() for idx in np.meshgrid(np.arange(n), np.arange(n), np.arange(4), indexing='ij')]
+        u, v = (k%2)*n + j, (k//2)*n + i
+        return pair_gram[u[:,None], u[None,:], v[:,None], v[None,:]]
+
+    def dense(self, n=None):
+        ''' Templates of the first n orders as an (n, n, 4, N, M) array, as returned by make_fourier_templates(). '''
+        if n is None:
+            n = self.n_terms
+        return np.stack([np.einsum('ja,ib->ijab', self.rows[k%2, :n], self.cols[k//2, :n]) for k in range(4)], axis=2)
+
+    def design_matrix(self, n=None):
+        ''' Raveled templates of the first n orders as the rows of a (4 n^2, N*M) array, ordered as in ravel_temps_from_ndtemp(). '''
+        if n is None:
+            n = self.n_terms
+        return self.dense(n).reshape(4*n*n, self.N*self.M)
+
+
+def show_fourier_templates(fourier_templates):
+    ''' Plots the templates of a FourierBasis, one figure for each of the four sine/cosine combinations. '''
+    n_terms = fourier_templates.n_terms
+    for k in range(4):
+        counter = 1
+        plt.figure(figsize=(8,8))
+        for i in range(n_terms):
+            for j in range(n_terms):           
+                plt.subplot(n_terms, n_terms, counter)
+                plt.title('i = '+ str(i)+', j = '+str(j))
+                plt.imshow(fourier_templates.template(i, j, k))
+                counter +=1
+        plt.tight_layout()
+        plt.show()
+
 def multiband_fourier_templates(imszs, n_terms, show_templates=False, psf_fwhms=None, x_max_pivot_list=None):
     '''
     Given a list of image and beam sizes, produces multiband fourier templates for background modeling.
@@ -150,7 +435,7 @@ def multiband_fourier_templates(imszs, n_terms, show_templates=False, psf_fwhms=
     Returns
     -------
 
-    all_templates : list of `numpy.ndarray's
+    all_templates : list of `FourierBasis' objects
         The set of Fourier templates for each observation.
 
     '''
@@ -167,14 +452,18 @@ def multiband_fourier_templates(imszs, n_terms, show_templates=False, psf_fwhms=
         if x_max_pivot_list is not None:
             x_max_pivot = x_max_pivot_list[b]
 
-        all_templates.append(make_fourier_templates(imszs[b][0], imszs[b][1], n_terms, show_templates=show_templates, psf_fwhm=psf_fwhm, x_max_pivot=x_max_pivot))
+        all_templates.append(FourierBasis(imszs[b][0], imszs[b][1], n_terms, psf_fwhm=psf_fwhm, x_max_pivot=x_max_pivot))
+        if show_templates:
+            show_fourier_templates(all_templates[-1])
+
     return all_templates
 
 def make_fourier_templates(N, M, n_terms, show_templates=False, psf_fwhm=None, shift=False, x_max_pivot=None):
         
     '''
     
-    Given image dimensions and order of the series expansion, generates a set of 2D fourier templates.
+    Given image dimensions and order of the series expansion, generates a set of 2D fourier templates. This materializes 
+    every template, FourierBasis gives the same templates in separable form.
 
     Parameters
     ----------
@@ -206,68 +495,12 @@ def make_fourier_templates(N, M, n_terms, show_templates=False, psf_fwhm=None, s
 
 
     '''
-
-    templates = np.zeros((n_terms, n_terms, 4, N, M))
-
-    x = np.arange(N)
-    y = np.arange(M)
-    
-    meshx, meshy = np.meshgrid(x, y)
-        
-    xtemps_cos = np.zeros((n_terms, N, M))
-    ytemps_cos = np.zeros((n_terms, N, M))
-    xtemps_sin = np.zeros((n_terms, N, M))
-    ytemps_sin = np.zeros((n_terms, N, M))
-
-    N_denom = N
-    M_denom = M
-
-    if x_max_pivot is not None:
-        N_denom = x_max_pivot
-        M_denom = x_max_pivot
-
-    for n in range(n_terms):
-
-        # modified series
-        if shift:
-            xtemps_sin[n] = np.sin((n+1-0.5)*np.pi*meshx/N_denom)
-            ytemps_sin[n] = np.sin((n+1-0.5)*np.pi*meshy/M_denom)
-        else:
-            xtemps_sin[n] = np.sin((n+1)*np.pi*meshx/N_denom)
-            ytemps_sin[n] = np.sin((n+1)*np.pi*meshy/M_denom)
-        
-        xtemps_cos[n] = np.cos((n+1)*np.pi*meshx/N_denom)
-        ytemps_cos[n] = np.cos((n+1)*np.pi*meshy/M_denom)
-    
-    for i in range(n_terms):
-        for j in range(n_terms):
-
-            if psf_fwhm is not None: # if beam size given, convolve with PSF assumed to be Gaussian
-                templates[i,j,0,:,:] = gaussian_filter(xtemps_sin[i]*ytemps_sin[j], sigma=psf_fwhm/2.355)
-                templates[i,j,1,:,:] = gaussian_filter(xtemps_sin[i]*ytemps_cos[j], sigma=psf_fwhm/2.355)
-                templates[i,j,2,:,:] = gaussian_filter(xtemps_cos[i]*ytemps_sin[j], sigma=psf_fwhm/2.355)
-                templates[i,j,3,:,:] = gaussian_filter(xtemps_cos[i]*ytemps_cos[j], sigma=psf_fwhm/2.355)
-
-            else:
-                templates[i,j,0,:,:] = xtemps_sin[i]*ytemps_sin[j]
-                templates[i,j,1,:,:] = xtemps_sin[i]*ytemps_cos[j]
-                templates[i,j,2,:,:] = xtemps_cos[i]*ytemps_sin[j]
-                templates[i,j,3,:,:] = xtemps_cos[i]*ytemps_cos[j]
+    fourier_templates = FourierBasis(N, M, n_terms, psf_fwhm=psf_fwhm, shift=shift, x_max_pivot=x_max_pivot)
      
     if show_templates:
-        for k in range(4):
-            counter = 1
-            plt.figure(figsize=(8,8))
-            for i in range(n_terms):
-                for j in range(n_terms):           
-                    plt.subplot(n_terms, n_terms, counter)
-                    plt.title('i = '+ str(i)+', j = '+str(j))
-                    plt.imshow(templates[i,j,k,:,:])
-                    counter +=1
-            plt.tight_layout()
-            plt.show()
+        show_fourier_templates(fourier_templates)
 
-    return templates
+    return fourier_templates.dense()
 
 
 def generate_template(fourier_coeffs, n_terms, fourier_templates=None, N=None, M=None, psf_fwhm=None, x_max_pivot=None):
@@ -278,7 +511,7 @@ def generate_template(fourier_coeffs, n_terms, fourier_templates=None, N=None, M
     Parameters
     ----------
 
-    fourier_coeffs : `~numpy.ndarray' of shape (n_terms, n_terms, 2)
+    fourier_coeffs : `~numpy.ndarray' of shape (n_terms, n_terms, 4)
         Coefficients of truncated Fourier expansion.
 
     n_terms : int
@@ -286,8 +519,8 @@ def generate_template(fourier_coeffs, n_terms, fourier_templates=None, N=None, M
         in case one wants the flexibility of calling it for different numbers of terms, even
         if the underlying truncated series has more terms.
 
-    fourier_templates : `~numpy.ndarray' of shape (n_terms, n_terms, 2, N, M), optional
-        Contains 2D Fourier templates for truncated series. If left unspecified, a set of Fourier templates is generated
+    fourier_templates : `FourierBasis' or `~numpy.ndarray' of shape (n_terms, n_terms, 4, N, M), optional
+        Contains 2D Fourier templates for truncated series. If left unspecified, a FourierBasis is generated
         on the fly. Default is 'None'.
 
     N : int, optional
@@ -317,12 +550,165 @@ def generate_template(fourier_coeffs, n_terms, fourier_templates=None, N=None, M
 
     '''
     if fourier_templates is None:
-        fourier_templates = make_fourier_templates(N, M, n_terms, psf_fwhm=psf_fwhm, x_max_pivot=x_max_pivot)
+        fourier_templates = FourierBasis(N, M, n_terms, psf_fwhm=psf_fwhm, x_max_pivot=x_max_pivot)
+
+    if isinstance(fourier_templates, FourierBasis):
+        return fourier_templates.evaluate(fourier_coeffs[:n_terms, :n_terms])
 
-    sum_temp = np.sum([fourier_coeffs[i,j,k]*fourier_templates[i,j,k] for i in range(n_terms) for j in range(n_terms) for k in range(fourier_coeffs.shape[-1])], axis=0)
+    nk = fourier_coeffs.shape[-1]
+    sum_temp = np.tensordot(fourier_coeffs[:n_terms, :n_terms, :nk], fourier_templates[:n_terms, :n_terms, :nk], axes=3)
     
     return sum_temp
 
+class P2Quantile():
+    '''
+    Running estimate of the p-quantile of every element of a stream of arrays, with the P^2 algorithm of Jain & Chlamtac (1985).
+    Five markers per element track the minimum, the p/2, p and (1+p)/2 quantiles and the maximum, and are moved by piecewise parabolic
+    interpolation as observations arrive, so the memory used does not grow with the number of observations.
+
+    Parameters
+    ----------
+
+    p : float
+        Quantile to estimate, between 0 and 1.
+
+    shape : tuple
+        Shape of the arrays in the stream.
+
+    '''
+    def __init__(self, p, shape):
+        self.p = p
+        self.shape = tuple(shape)
+        self.count = 0
+        size = int(np.prod(self.shape))
+        self.heights = np.zeros((5, size))
+        self.positions = np.zeros((5, size))
+        self.desired = np.array([0., 2*p, 4*p, 2+2*p, 4.])
+        self.increments = np.array([0., p/2, p, (1+p)/2, 1.])
+
+    def update(self, x):
+        ''' Adds one observation x, an array of the stream shape. '''
+        x = np.ravel(x)
+        if self.count < 5:
+            self.heights[self.count] = x
+            self.count += 1
+            if self.count == 5:
+                self.heights.sort(axis=0)
+                self.positions[:] = np.arange(5.)[:,None]
+            return
+
+        q, n = self.heights, self.positions
+        np.minimum(q[0], x, out=q[0])
+        np.maximum(q[4], x, out=q[4])
+        # markers above the observation move up by one
+        n[1:4] += x < q[1:4]
+        n[4] += 1
+        self.count += 1
+        self.desired += self.increments
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            # only the markers that are off their desired position by a pixel or more are adjusted
+            idx = np.flatnonzero(((d >= 1) & (n[i+1]-n[i] > 1)) | ((d <= -1) & (n[i-1]-n[i] < -1)))
+            if idx.size == 0:
+                continue
+            step = np.sign(d[idx])
+            ql, qi, qr = q[i-1, idx], q[i, idx], q[i+1, idx]
+            nl, ni, nr = n[i-1, idx], n[i, idx], n[i+1, idx]
+            q_parabolic = qi + step/(nr-nl)*((ni-nl+step)*(qr-qi)/(nr-ni) + (nr-ni-step)*(qi-ql)/(ni-nl))
+            q_linear = np.where(step > 0, qi + (qr-qi)/(nr-ni), qi - (ql-qi)/(nl-ni))
+            q[i, idx] = np.where((ql < q_parabolic) & (q_parabolic < qr), q_parabolic, q_linear)
+            n[i, idx] += step
+
+    def quantile(self):
+        ''' Current estimate of the p-quantile. With fewer than five observations, the exact quantile is returned. '''
+        if self.count < 5:
+            return np.quantile(self.heights[:self.count], self.p, axis=0).reshape(self.shape)
+        return self.heights[2].reshape(self.shape).copy()
+
+
+class StreamingMapStats():
+    '''
+    Per-pixel mean, standard deviation and approximate quantiles of a stream of maps, added in chunks. The mean and variance are
+    accumulated with the pairwise update of Chan et al. (1979), and the quantiles with P2Quantile, so only the current chunk of maps
+    is held in memory.
+
+    Parameters
+    ----------
+
+    shape : tuple
+        Shape of each map.
+
+    quantiles : list of floats, optional
+        Quantiles to estimate. Default is [0.5].
+
+    '''
+    def __init__(self, shape, quantiles=[0.5]):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.sumsq = np.zeros(shape)
+        self.estimators = dict([(p, P2Quantile(p, shape)) for p in quantiles])
+
+    def update(self, maps):
+        ''' Adds a chunk of maps, an array of shape (nmaps,)+shape. '''
+        nchunk = maps.shape[0]
+        if nchunk == 0:
+            return
+        chunk_mean = np.mean(maps, axis=0)
+        delta = chunk_mean - self.mean
+        total = self.count + nchunk
+        self.sumsq += np.sum((maps-chunk_mean)**2, axis=0) + delta**2*self.count*nchunk/total
+        self.mean += delta*nchunk/total
+        self.count = total
+        for estimator in self.estimators.values():
+            for m in maps:
+                estimator.update(m)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.sumsq/(self.count-ddof))
+
+    def quantile(self, p):
+        return self.estimators[p].quantile()
+
+
+def posterior_background_stats(fourier_coeffs, fourier_templates, bkg_samples=None, quantiles=[0.5], chunk_size=64):
+    '''
+    Per-pixel statistics of the background maps of a chain of Fourier coefficient samples. The maps of chunk_size samples
+    at a time are evaluated together with FourierBasis.evaluate() and passed to a StreamingMapStats, so the maps of the whole chain 
+    are never held in memory at once.
+
+    Parameters
+    ----------
+
+    fourier_coeffs : `~numpy.ndarray' of shape (nsamp, n_terms, n_terms, 4)
+        Fourier coefficient samples. Memory-mapped chains are read one chunk at a time.
+
+    fourier_templates : `FourierBasis'
+
+    bkg_samples : `~numpy.ndarray' of shape (nsamp,), optional
+        Mean background levels added to the maps. Default is 'None'.
+
+    quantiles : list of floats, optional
+        Quantiles to estimate. Default is [0.5].
+
+    chunk_size : int, optional
+        Number of maps evaluated at a time. Default is 64.
+
+    Returns
+    -------
+
+    stats : `StreamingMapStats'
+
+    '''
+    stats = StreamingMapStats((fourier_templates.N, fourier_templates.M), quantiles=quantiles)
+    for start in range(0, len(fourier_coeffs), chunk_size):
+        maps = fourier_templates.evaluate(np.asarray(fourier_coeffs[start:start+chunk_size], dtype=np.float64))
+        if bkg_samples is not None:
+            maps += np.asarray(bkg_samples[start:start+chunk_size]).reshape((-1, 1, 1))
+        stats.update(maps)
+
+    return stats
+
 def fit_coeffs_to_observed_comb(observed_comb, obs_noise_sig,ftemplates, true_fcoeffs = None, true_comb=None, n_terms=None, sig_dtemp=0.1, niter=100, init_nsig=1.):
     if true_fcoeffs is not None:
         init_fcoeffs = np.random.normal(0, obs_noise_sig, size=(true_fcoeffs.shape[0], true_fcoeffs.shape[1], 4))
@@ -1,4 +1,7 @@
 import numpy as np
+from numpy_backend import NumpyBackend
+
+numpy_kernels = NumpyBackend()
 
 def psf_poly_fit(psf0, nbin):
         assert psf0.shape[0] == psf0.shape[1] # assert PSF is square
@@ -31,18 +34,91 @@ def psf_poly_fit(psf0, nbin):
 
         return cf.reshape(cf.shape[0], cf.shape[1]*cf.shape[2])
 
-def image_model_eval(x, y, f, back, imsz, nc, cf, regsize=None, margin=0, offsetx=0, offsety=0, weights=None, ref=None, lib=None, template=None):
+def make_pixel_hash(imsz):
+    ''' Pixel hash workspace for the compiled model evaluation kernels. Every entry must be -1 between calls, which the kernels maintain.'''
+    return np.full(imsz[0]*imsz[1], -1, dtype=np.int32)
+
+class EvalBufferPool():
+    ''' 
+    Preallocated scratch buffers for image_model_eval(), so that repeated likelihood evaluations in the sampler do not allocate. 
+    Buffers are keyed by (band, nstar capacity, nc), where the capacity is nstar rounded up to a power of two, and image sized 
+    buffers are shared by all keys of the same band (any hashable label can be used as band, and image buffers are reallocated if 
+    the image size of a band changes). Arrays returned by image_model_eval() when using a pool are views into these 
+    buffers, so they are only valid until the next call for the same band and must be copied if they need to persist.
+    '''
+    def __init__(self, min_capacity=64):
+        self.min_capacity = min_capacity
+        self.source_buffers = dict()
+        self.image_buffers = dict()
+        self.n_alloc = 0
+        self.n_requests = 0
+        self.nbytes = 0
+
+    def _alloc(self, shape, dtype, fill=None):
+        if fill is None:
+            arr = np.empty(shape, dtype=dtype)
+        else:
+            arr = np.full(shape, fill, dtype=dtype)
+        self.n_alloc += 1
+        self.nbytes += arr.nbytes
+        return arr
+
+    def capacity(self, nstar):
+        cap = self.min_capacity
+        while cap < nstar:
+            cap *= 2
+        return cap
+
+    def get(self, band, nstar, nc, imsz, nregy, nregx, nparam=10):
+        ''' Returns dictionaries of per-source and image sized buffers for the given band, allocating them on first use. '''
+        self.n_requests += 1
+        key = (band, self.capacity(nstar), nc)
+        if key not in self.source_buffers:
+            cap = key[1]
+            self.source_buffers[key] = dict({'dd':self._alloc((cap, nparam), np.float32), 'recon':self._alloc((cap, nc*nc), np.float32), \
+                                            'ix':self._alloc(cap, np.int32), 'iy':self._alloc(cap, np.int32), \
+                                            'dx':self._alloc(cap, np.float32), 'dy':self._alloc(cap, np.float32)})
+        if band not in self.image_buffers or self.image_buffers[band]['image'].shape != (imsz[0], imsz[1]):
+            self.image_buffers[band] = dict({'image':self._alloc((imsz[0], imsz[1]), np.float32), 'reftemp':self._alloc((imsz[0], imsz[1]), np.float32, fill=0.), \
+                                            'weights':self._alloc(imsz, np.float32, fill=1.), 'diff2':self._alloc((nregy, nregx), np.float64)})
+        elif self.image_buffers[band]['diff2'].shape != (nregy, nregx):
+            self.image_buffers[band]['diff2'] = self._alloc((nregy, nregx), np.float64)
+
+        return self.source_buffers[key], self.image_buffers[band]
+
+    def get_multiband(self, nbands, nstar, nc, imszs, nregy, nregx, nparam=10):
+        '''
+        Returns the per-source workspaces of the fused multiband kernel and the list of image sized buffers of each band.
+        The per-band arrays (xp, yp, flux) are flat, so that their first nbands*nstar entries can be viewed as a contiguous
+        (nbands, nstar) array.
+        '''
+        self.n_requests += 1
+        key = ('multiband', self.capacity(nstar), nc)
+        if key not in self.source_buffers:
+            cap = key[1]
+            self.source_buffers[key] = dict({'dd':self._alloc((cap, nparam), np.float32), 'recon':self._alloc((cap, nc*nc), np.float32), \
+                                            'ix':self._alloc(cap, np.int32), 'iy':self._alloc(cap, np.int32), \
+                                            'xp':self._alloc(nbands*cap, np.float32), 'yp':self._alloc(nbands*cap, np.float32), \
+                                            'flux':self._alloc(nbands*cap, np.float32), 'diff2':self._alloc((nregy, nregx), np.float64)})
+        imbufs = []
+        for b in range(nbands):
+            if b not in self.image_buffers:
+                self.get(b, nstar, nc, imszs[b], nregy, nregx)
+                self.n_requests -= 1
+            imbufs.append(self.image_buffers[b])
+
+        return self.source_buffers[key], imbufs
+
+def image_model_eval(x, y, f, back, imsz, nc, cf, regsize=None, margin=0, offsetx=0, offsety=0, weights=None, ref=None, lib=None, template=None, pixel_hash=None, \
+                    pool=None, band=0):
     assert x.dtype == np.float32
     assert y.dtype == np.float32
     # assert f.dtype == np.float32
-    # not sure what to do with cf
-    #assert cf.dtype == np.float32
+    # cf is passed straight to the kernels, so it should already be C-contiguous float32 (see spire_data_utils.psf_model)
+    assert cf.dtype == np.float32
     if ref is not None:
         assert ref.dtype == np.float32
 
-    if weights is None:
-        weights = np.full(imsz, 1., dtype=np.float32)
-
     if regsize is None:
         regsize = max(imsz[0], imsz[1])
 
@@ -58,49 +134,86 @@ def image_model_eval(x, y, f, back, imsz, nc, cf, regsize=None, margin=0, offset
     nregy = int(imsz[1]/regsize + 1) # assumes imsz % regsize = 0?
     nregx = int(imsz[0]/regsize + 1)
 
+    # without a compiled kernel, use the vectorized NumPy implementation
+    if lib is None:
+        lib = numpy_kernels.clib_eval_modl
+
+    if pool is not None:
+        srcbufs, imbufs = pool.get(band, nstar, nc, imsz, nregy, nregx)
+        if weights is None:
+            weights = imbufs['weights']
+
+        # fill the design matrix in place, column by column
+        dx, dy = srcbufs['dx'][:nstar], srcbufs['dy'][:nstar]
+        ix, iy = srcbufs['ix'][:nstar], srcbufs['iy'][:nstar]
+        np.ceil(x, out=dx)
+        np.ceil(y, out=dy)
+        ix[:] = dx
+        iy[:] = dy
+        dx -= x
+        dy -= y
+        dd = srcbufs['dd'][:nstar]
+        dd[:,0] = 1.
+        dd[:,1] = dx
+        dd[:,2] = dy
+        np.multiply(dx, dx, out=dd[:,3])
+        np.multiply(dx, dy, out=dd[:,4])
+        np.multiply(dy, dy, out=dd[:,5])
+        np.multiply(dd[:,3], dx, out=dd[:,6])
+        np.multiply(dd[:,3], dy, out=dd[:,7])
+        np.multiply(dd[:,4], dy, out=dd[:,8])
+        np.multiply(dd[:,5], dy, out=dd[:,9])
+        dd *= f[:, None]
+
+        image = imbufs['image']
+        image.fill(back)
+        if template is not None:
+            image += template
+
+        recon = srcbufs['recon'][:nstar]
+        reftemp = ref
+        if ref is None:
+            reftemp = imbufs['reftemp']
+        diff2 = imbufs['diff2']
+        diff2.fill(0.)
+
+        if pixel_hash is None:
+            pixel_hash = make_pixel_hash(imsz)
+
+        lib(imsz[0], imsz[1], nstar, nc, cf.shape[0], dd, cf, recon, ix, iy, pixel_hash, image, reftemp, weights, diff2, regsize, margin, offsetx, offsety)
+
+        if ref is not None:
+            return image, diff2
+        else:
+            return image
+
+    if weights is None:
+        weights = np.full(imsz, 1., dtype=np.float32)
+
     ix = np.ceil(x).astype(np.int32)
     dx = ix - x
     iy = np.ceil(y).astype(np.int32)
     dy = iy - y
 
     dd = np.column_stack((np.full(nstar, 1., dtype=np.float32), dx, dy, dx*dx, dx*dy, dy*dy, dx*dx*dx, dx*dx*dy, dx*dy*dy, dy*dy*dy)).astype(np.float32) * f[:, None]
-    if lib is None:
-        image = np.full((imsz[1]+2*rad+1,imsz[0]+2*rad+1), back, dtype=np.float32)
-        recon2 = np.dot(dd, cf).reshape((nstar,nc,nc))
-        recon = np.zeros((nstar,nc,nc), dtype=np.float32)
-        recon[:,:,:] = recon2[:,:,:]
-        for i in range(nstar):
-            image[iy[i]:iy[i]+rad+rad+1,ix[i]:ix[i]+rad+rad+1] += recon[i,:,:]
 
-        image = image[rad:imsz[1]+rad,rad:imsz[0]+rad]
+    # image = np.full((imsz[1], imsz[0]), back, dtype=np.float32)
+    image = np.full((imsz[0], imsz[1]), back, dtype=np.float32)
 
-        if ref is not None:
-            diff = ref - image
-            diff2 = np.zeros((nregy, nregx), dtype=np.float64)
-            for i in range(nregy):
-                y0 = max(i*regsize - offsety - margin, 0)
-                y1 = min((i+1)*regsize - offsety + margin, imsz[1])
-                for j in range(nregx):
-                    x0 = max(j*regsize - offsetx - margin, 0)
-                    x1 = min((j+1)*regsize - offsetx + margin, imsz[0])
-                    subdiff = diff[y0:y1,x0:x1]
-                    diff2[i,j] = np.sum(subdiff*subdiff*weights[y0:y1,x0:x1])
-    else:
-        # image = np.full((imsz[1], imsz[0]), back, dtype=np.float32)
-        image = np.full((imsz[0], imsz[1]), back, dtype=np.float32)
+    recon = np.zeros((nstar,nc*nc), dtype=np.float32)
+    reftemp = ref
+    if ref is None:
+        reftemp = np.zeros((imsz[0], imsz[1]), dtype=np.float32)
+        # reftemp = np.zeros((imsz[1], imsz[0]), dtype=np.float32)
+    diff2 = np.zeros((nregy, nregx), dtype=np.float64)
 
-        recon = np.zeros((nstar,nc*nc), dtype=np.float32)
-        reftemp = ref
-        if ref is None:
-            reftemp = np.zeros((imsz[0], imsz[1]), dtype=np.float32)
-            # reftemp = np.zeros((imsz[1], imsz[0]), dtype=np.float32)
-        diff2 = np.zeros((nregy, nregx), dtype=np.float64)
-
-        if template is not None: # template
-            image += np.array(template)
-        
-        lib(imsz[0], imsz[1], nstar, nc, cf.shape[0], dd, cf, recon, ix, iy, image, reftemp, weights, diff2, regsize, margin, offsetx, offsety)
+    if template is not None: # template
+        image += np.array(template)
 
+    if pixel_hash is None:
+        pixel_hash = make_pixel_hash(imsz)
+    
+    lib(imsz[0], imsz[1], nstar, nc, cf.shape[0], dd, cf, recon, ix, iy, pixel_hash, image, reftemp, weights, diff2, regsize, margin, offsetx, offsety)
 
     if ref is not None:
         return image, diff2
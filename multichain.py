@@ -0,0 +1,430 @@
+import numpy as np
+import copy
+import multiprocessing
+import os
+import queue
+from multiprocessing import shared_memory
+
+''' This module runs several independent PCAT chains (lion(n_chains=...)) or tempered replicas (lion(n_temps=...)) in a
+process pool. The read-only data products (images, weights, noise maps, templates, PSF tables and Fourier templates) are 
+copied once into shared memory blocks and attached by every worker, rather than pickled once per chain. Each chain writes its own chain.npz to a chain<i> subdirectory
+of the run directory, and the Gelman-Rubin statistic of the number of sources, backgrounds and template amplitudes is
+reported as thinned samples arrive from the workers. In replica exchange runs, the states of adjacent temperatures are
+swapped by the parent process after every thinned sample. '''
+
+# fields of pcat_data and gdat holding read-only arrays that are placed in shared memory
+shared_data_fields = ['data_array', 'weights', 'errors', 'masks', 'template_array', 'psfs', 'cfs']
+# (the Fourier background templates are stored as separable FourierBasis factors, which are small enough to be pickled)
+shared_gdat_fields = []
+
+# shared memory blocks attached by a worker, kept open for the lifetime of the worker process since the data arrays are views into them
+attached_blocks = []
+
+
+class SharedArrayRef():
+	''' Placeholder for an array copied into a shared memory block, which is passed to the workers in place of the array. '''
+	def __init__(self, name, shape, dtype):
+		self.name = name
+		self.shape = shape
+		self.dtype = dtype
+
+def share_arrays(obj, blocks, memo):
+	'''
+	Replaces the numpy arrays in obj, which may be an array or nested lists and tuples of arrays, with SharedArrayRefs.
+	Each array is copied into a new shared memory block, appended to blocks, and arrays appearing more than once (tracked
+	by id in memo) are only copied once.
+	'''
+	if isinstance(obj, np.ndarray) and obj.dtype != object:
+		if id(obj) not in memo:
+			shm = shared_memory.SharedMemory(create=True, size=max(obj.nbytes, 1))
+			np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)[...] = obj
+			blocks.append(shm)
+			memo[id(obj)] = SharedArrayRef(shm.name, obj.shape, obj.dtype.str)
+		return memo[id(obj)]
+	if isinstance(obj, list):
+		return [share_arrays(o, blocks, memo) for o in obj]
+	if isinstance(obj, tuple):
+		return tuple([share_arrays(o, blocks, memo) for o in obj])
+	return obj
+
+def attach_arrays(obj, blocks, memo):
+	''' Inverse of share_arrays(), returning read-only views of the shared memory blocks. Attached blocks are appended to blocks. '''
+	if isinstance(obj, SharedArrayRef):
+		if obj.name not in memo:
+			shm = shared_memory.SharedMemory(name=obj.name)
+			blocks.append(shm)
+			arr = np.ndarray(obj.shape, dtype=np.dtype(obj.dtype), buffer=shm.buf)
+			arr.flags.writeable = False
+			memo[obj.name] = arr
+		return memo[obj.name]
+	if isinstance(obj, list):
+		return [attach_arrays(o, blocks, memo) for o in obj]
+	if isinstance(obj, tuple):
+		return tuple([attach_arrays(o, blocks, memo) for o in obj])
+	return obj
+
+def export_shared(gdat, data, blocks):
+	''' Returns shallow copies of gdat and data with their read-only arrays moved to shared memory blocks. '''
+	memo = dict()
+	data_shared = copy.copy(data)
+	for field in shared_data_fields:
+		setattr(data_shared, field, share_arrays(getattr(data, field), blocks, memo))
+
+	data_shared.psf_models = []
+	for psfmod in data.psf_models:
+		psfmod_shared = copy.copy(psfmod)
+		psfmod_shared.cf = share_arrays(psfmod.cf, blocks, memo)
+		psfmod_shared.psf = share_arrays(psfmod.psf, blocks, memo)
+		data_shared.psf_models.append(psfmod_shared)
+
+	gdat_shared = copy.copy(gdat)
+	for field in shared_gdat_fields:
+		if hasattr(gdat, field):
+			setattr(gdat_shared, field, share_arrays(getattr(gdat, field), blocks, memo))
+
+	return gdat_shared, data_shared
+
+def import_shared(gdat, data, blocks):
+	''' Attaches the shared arrays of gdat and data exported with export_shared(), in place. '''
+	memo = dict()
+	for field in shared_data_fields:
+		setattr(data, field, attach_arrays(getattr(data, field), blocks, memo))
+	for psfmod in data.psf_models:
+		psfmod.cf = attach_arrays(psfmod.cf, blocks, memo)
+		psfmod.psf = attach_arrays(psfmod.psf, blocks, memo)
+	for field in shared_gdat_fields:
+		if hasattr(gdat, field):
+			setattr(gdat, field, attach_arrays(getattr(gdat, field), blocks, memo))
+
+def gelman_rubin_rhat(list_of_chains):
+	'''
+	Gelman-Rubin potential scale reduction factor of a scalar parameter.
+
+	Parameters
+	----------
+
+	list_of_chains : '~numpy.ndarray' of shape (m, n)
+		n samples from each of m chains.
+
+	Returns
+	-------
+
+	Rhat : float
+
+	'''
+	m = len(list_of_chains)
+	n = len(list_of_chains[0])
+
+	B = (n/(m-1))*np.sum((np.mean(list_of_chains, axis=1)-np.mean(list_of_chains))**2)
+
+	W = 0.
+	for j in range(m):
+		sumsq = np.sum((list_of_chains[j]-np.mean(list_of_chains[j]))**2)
+		W += (1./m)*(1./(n-1.))*sumsq
+
+	var_th = ((n-1.)/n)*W + (B/n)
+
+	return np.sqrt(var_th/W)
+
+def chain_summary_names(gdat):
+	''' Names of the parameters returned by chain_summary(). '''
+	names = ['N_src']
+	if gdat.float_background:
+		names.extend(['bkg'+str(b) for b in range(gdat.nbands)])
+	if gdat.float_templates:
+		names.extend([temp_name+str(b) for temp_name in gdat.template_order for b in range(gdat.nbands)])
+	return names
+
+def chain_summary(gdat, model):
+	''' Scalar parameters of the current model state used for the live convergence diagnostic, see chain_summary_names(). '''
+	summary = [model.n]
+	if gdat.float_background:
+		summary.extend(list(model.bkg))
+	if gdat.float_templates:
+		summary.extend(list(np.array(model.template_amplitudes).ravel()))
+	return np.array(summary, dtype=np.float64)
+
+def run_chain(chain_idx, gdat, data, seed, chain_queue, temperature=1., exchange_queues=None, label='chain'):
+	'''
+	Runs a single chain in a worker process. The shared arrays of gdat and data are attached, the chain writes its
+	results to the <label><chain_idx> subdirectory of the run directory and sends a summary of every thinned sample to chain_queue.
+	For replica exchange runs, the likelihood is tempered by temperature and states are exchanged through exchange_queues,
+	see exchange_replica_state(). Returns the chain's time string (its directory relative to gdat.result_path) and the 
+	output of lion.main().
+	'''
+	from pcat_spire import lion, save_params
+
+	import_shared(gdat, data, attached_blocks)
+
+	# the background fit with the Moore-Penrose inverse modifies the pivot band image in place
+	if gdat.bkg_moore_penrose_inv:
+		data.data_array = [image.copy() for image in data.data_array]
+
+	np.random.seed(seed)
+
+	gdat.chain_idx = chain_idx
+	gdat.chain_queue = chain_queue
+	gdat.temperature = temperature
+	gdat.exchange_queues = exchange_queues
+	gdat.visual = False
+	gdat.timestr_list_file = None
+	gdat.timestr = gdat.timestr+'/'+label+str(chain_idx)
+
+	if gdat.save:
+		gdat.newdir = gdat.result_path+'/'+gdat.timestr
+		gdat.frame_dir = gdat.newdir+'/frames'
+		if not os.path.isdir(gdat.frame_dir):
+			os.makedirs(gdat.frame_dir)
+		save_params(gdat.newdir, gdat)
+
+	ob = lion.__new__(lion)
+	ob.gdat = gdat
+	ob.data = data
+
+	return gdat.timestr, ob.main()
+
+def get_replica_state(model):
+	''' Copy of the sampled parameters of a model, exchanged between temperatures in replica exchange runs. '''
+	state = dict({'stars':model.stars.copy(), 'n':model.n, 'source_ids':model.source_ids.copy(), 'next_source_id':model.next_source_id, 'bkg':np.array(model.bkg).copy(), 'template_amplitudes':np.array(model.template_amplitudes).copy()})
+	if model.fourier_coeffs is not None:
+		state['fourier_coeffs'] = model.fourier_coeffs.copy()
+		state['fc_rel_amps'] = np.array(model.fc_rel_amps).copy()
+	return state
+
+def set_replica_state(model, state):
+	model.stars[:] = state['stars']
+	model.n = state['n']
+	model.source_ids[:] = state['source_ids']
+	model.next_source_id = state['next_source_id']
+	model.build_source_grid()
+	model.bkg[:] = state['bkg']
+	model.template_amplitudes[:] = state['template_amplitudes']
+	if 'fourier_coeffs' in state:
+		model.fourier_coeffs[:] = state['fourier_coeffs']
+		model.fc_rel_amps[:] = state['fc_rel_amps']
+
+def exchange_replica_state(gdat, j, model, chi2):
+	'''
+	Called by each replica after thinned sample j. Sends the untempered log-likelihood and state of the model to the coordinator
+	in run_tempered() and waits for it to return either a state to continue from, if a swap with the replica at the next higher 
+	temperature was accepted, or None. Returns 1 if a swap with the next higher temperature was accepted, 0 if it was rejected 
+	and NaN if none was proposed, which is recorded in Samples.swap_accept.
+	'''
+	up_queue, down_queue = gdat.exchange_queues
+	up_queue.put((gdat.chain_idx, j, -0.5*np.sum(chi2), get_replica_state(model)))
+	state, swap_accept = down_queue.get()
+	if state is not None:
+		set_replica_state(model, state)
+	return swap_accept
+
+def worker_context():
+	'''
+	Multiprocessing context of the worker pools. The parent has already run the (OpenMP) kernels when resolving the backend, and
+	GNU libgomp is not fork-safe once its thread team exists, so forked workers would hang in their first parallel region. Workers 
+	are spawned instead, which re-imports the calling script, so scripts running several chains need an if __name__ == '__main__' guard.
+	'''
+	return multiprocessing.get_context('spawn')
+
+def get_chain_seeds(gdat, n):
+	''' Random seeds of n worker processes, consecutive from gdat.init_seed if it is set. '''
+	if gdat.init_seed is not None:
+		return [gdat.init_seed+i for i in range(n)]
+	return list(np.random.randint(2**31-1, size=n))
+
+def record_timestrs(gdat, timestrs):
+	''' Prints the time strings of the worker runs and appends them to gdat.timestr_list_file if it is specified. '''
+	print('Chain time strings:', timestrs, file=gdat.flog)
+
+	if gdat.timestr_list_file is not None:
+		if os.path.exists(gdat.timestr_list_file):
+			timestr_list = list(np.load(gdat.timestr_list_file)['timestr_list'])
+		else:
+			timestr_list = []
+		np.savez(gdat.timestr_list_file, timestr_list=timestr_list+timestrs)
+
+def report_rhats(gdat, traces, names, nsamp_done):
+	''' Prints the R-hat of each parameter over the second half of the samples received from every chain so far. '''
+	samples = np.array([trace[:nsamp_done] for trace in traces])[:,nsamp_done//2:,:]
+	if samples.shape[1] < 2:
+		return None
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		rhats = [gelman_rubin_rhat(samples[:,:,k]) for k in range(len(names))]
+
+	print('Sample '+str(nsamp_done)+', R-hat '+', '.join([name+' %0.3f' % rhat for name, rhat in zip(names, rhats)]), file=gdat.flog)
+	return rhats
+
+def run_chains(ob):
+	'''
+	Runs gdat.n_chains independent chains of the lion object ob in a process pool with one worker per chain, sharing the
+	read-only data arrays through shared memory. The R-hat of the chain summaries is reported every time all chains have
+	produced a new thinned sample, and the time strings of the chains are appended to gdat.timestr_list_file if specified.
+
+	Parameters
+	----------
+
+	ob : lion object
+		Configured run, with data loaded.
+
+	Returns
+	-------
+
+	results : list
+		Output of lion.main() for each chain.
+
+	rhats : list of floats
+		Final R-hat of each parameter in chain_summary_names(). Entries are NaN for parameters that are constant.
+
+	'''
+	gdat = ob.gdat
+	ob.initialize_print_log()
+
+	# resolve the backend once, so that the chains do not each benchmark the backends concurrently. This runs the kernels
+	# in this process, so the workers are spawned rather than forked (see worker_context)
+	ob.initialize_libmmult()
+
+	seeds = get_chain_seeds(gdat, gdat.n_chains)
+
+	names = chain_summary_names(gdat)
+	traces = [np.zeros((gdat.nsamp, len(names))) for i in range(gdat.n_chains)]
+	nsamp_received = np.zeros(gdat.n_chains, dtype=int)
+	nsamp_reported = 0
+	rhats = None
+
+	blocks = []
+	try:
+		gdat_shared, data_shared = export_shared(gdat, ob.data, blocks)
+		gdat_shared.flog = None # each chain opens its own log
+
+		ctx = worker_context()
+		manager = ctx.Manager()
+		chain_queue = manager.Queue()
+		with ctx.Pool(processes=gdat.n_chains) as pool:
+			results = [pool.apply_async(run_chain, (i, gdat_shared, data_shared, seeds[i], chain_queue)) for i in range(gdat.n_chains)]
+
+			while not all([result.ready() for result in results]) or not chain_queue.empty():
+				try:
+					chain_idx, j, summary = chain_queue.get(timeout=0.5)
+				except queue.Empty:
+					continue
+				traces[chain_idx][j] = summary
+				nsamp_received[chain_idx] = j+1
+
+				if np.min(nsamp_received) > nsamp_reported:
+					nsamp_reported = np.min(nsamp_received)
+					rhats = report_rhats(gdat, traces, names, nsamp_reported)
+
+			outputs = [result.get() for result in results]
+		manager.shutdown()
+	finally:
+		for shm in blocks:
+			shm.close()
+			shm.unlink()
+
+	record_timestrs(gdat, [output[0] for output in outputs])
+
+	if gdat.print_log:
+		gdat.flog.close()
+
+	return [output[1] for output in outputs], rhats
+
+def swap_pairs(j, n_temps):
+	''' Adjacent temperature pairs proposed for exchange after sample j, alternating between even and odd pairs. '''
+	return [(k, k+1) for k in range(j % 2, n_temps-1, 2)]
+
+def run_tempered(ob):
+	'''
+	Runs replica exchange (parallel tempering) with one worker process per temperature in gdat.temp_ladder. Each replica samples 
+	the posterior with its log-likelihood divided by its temperature, and after every thinned sample the coordinator here 
+	proposes swaps of the states of adjacent temperatures, accepted with probability 
+	min(1, exp((1/T_k - 1/T_k+1)*(logL_k+1 - logL_k))). Replica k is saved in the temp<k> subdirectory of the run directory,
+	temp0 being the untempered posterior.
+
+	Parameters
+	----------
+
+	ob : lion object
+		Configured run, with data loaded.
+
+	Returns
+	-------
+
+	results : list
+		Output of lion.main() for each temperature.
+
+	swap_rates : '~numpy.ndarray' of shape (n_temps-1,)
+		Fraction of accepted swaps between each pair of adjacent temperatures.
+
+	'''
+	gdat = ob.gdat
+	ob.initialize_print_log()
+	ob.initialize_libmmult()
+
+	temps = np.array(gdat.temp_ladder, dtype=np.float64)
+	n_temps = len(temps)
+	seeds = get_chain_seeds(gdat, n_temps)
+	rng = np.random.RandomState(seeds[0])
+
+	n_attempt = np.zeros(n_temps-1)
+	n_accept = np.zeros(n_temps-1)
+
+	blocks = []
+	try:
+		gdat_shared, data_shared = export_shared(gdat, ob.data, blocks)
+		gdat_shared.flog = None
+
+		ctx = worker_context()
+		manager = ctx.Manager()
+		up_queue = manager.Queue()
+		down_queues = [manager.Queue() for k in range(n_temps)]
+		with ctx.Pool(processes=n_temps) as pool:
+			results = [pool.apply_async(run_chain, (k, gdat_shared, data_shared, seeds[k], None, temps[k], (up_queue, down_queues[k]), 'temp')) for k in range(n_temps)]
+
+			for j in range(gdat.nsamp):
+				logLs, states = np.zeros(n_temps), [None for k in range(n_temps)]
+				nrecv = 0
+				while nrecv < n_temps:
+					try:
+						k, _, logL, state = up_queue.get(timeout=0.5)
+					except queue.Empty:
+						for result in results:
+							if result.ready() and not result.successful():
+								result.get() # raises the worker's exception
+						continue
+					logLs[k], states[k] = logL, state
+					nrecv += 1
+
+				new_states = [None for k in range(n_temps)]
+				swap_accepts = [np.nan for k in range(n_temps)]
+				for k0, k1 in swap_pairs(j, n_temps):
+					n_attempt[k0] += 1
+					log_alpha = (1./temps[k0] - 1./temps[k1])*(logLs[k1] - logLs[k0])
+					swap_accepts[k0] = 0
+					if np.log(rng.uniform()) < log_alpha:
+						n_accept[k0] += 1
+						swap_accepts[k0] = 1
+						new_states[k0], new_states[k1] = states[k1], states[k0]
+
+				for k in range(n_temps):
+					down_queues[k].put((new_states[k], swap_accepts[k]))
+
+				with np.errstate(divide='ignore', invalid='ignore'):
+					print('Sample '+str(j)+', swap acceptance '+' '.join(['(T=%0.2f/%0.2f) %0.3f' % (temps[k], temps[k+1], n_accept[k]/n_attempt[k]) for k in range(n_temps-1)]), file=gdat.flog)
+
+			outputs = [result.get() for result in results]
+		manager.shutdown()
+	finally:
+		for shm in blocks:
+			shm.close()
+			shm.unlink()
+
+	swap_rates = n_accept/np.maximum(n_attempt, 1)
+	print('Temperature ladder:', temps, file=gdat.flog)
+	print('Swap acceptance fractions:', np.round(swap_rates, 3), file=gdat.flog)
+
+	record_timestrs(gdat, [output[0] for output in outputs])
+
+	if gdat.print_log:
+		gdat.flog.close()
+
+	return [output[1] for output in outputs], swap_rates
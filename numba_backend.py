@@ -0,0 +1,107 @@
+import numpy as np
+from numpy_backend import NumpyBackend, get_nreg
+
+''' This module contains a Numba implementation of the PCAT kernels, compiled at import (and cached on disk) rather than built
+with icc or OpenBLAS. NumbaBackend has the same function names and arguments as pcat-lion.c (pcat_*) and blas.c (clib_*), with
+parallel loops over subregions, sources and bands of image rows, and float32 arithmetic for the model images. Kernels that are
+not implemented here (the sparse acceptance update) are inherited from the NumPy backend. Numba is an optional dependency,
+numba_available is False if it cannot be imported. '''
+
+try:
+	import numba
+	from numba import njit, prange
+	numba_available = True
+except ImportError:
+	numba_available = False
+
+
+if numba_available:
+
+	@njit(parallel=True, cache=True)
+	def _like_eval(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety, nregx, nregy):
+		# regions are independent, so each one is summed by a single thread in the same order as the serial loop
+		for j in prange(nregy):
+			y0 = max(j*regsize-offsety-margin, 0)
+			y1 = min((j+1)*regsize-offsety+margin, NY)
+			for i in range(nregx):
+				x0 = max(i*regsize-offsetx-margin, 0)
+				x1 = min((i+1)*regsize-offsetx+margin, NX)
+				summ = 0.
+				for jj in range(y0, y1):
+					for ii in range(x0, x1):
+						diff = image[jj*NX+ii] - ref[jj*NX+ii]
+						summ += diff*diff*weight[jj*NX+ii]
+				diff2[j*nregx+i] = summ
+
+	@njit(parallel=True, cache=True)
+	def _model_eval(NX, NY, nstar, nc, k, A, B, C, x, y, image, nband):
+		npsf = nc*nc
+		rad = nc//2
+
+		# matrix product, one source per thread
+		for p in prange(nstar):
+			for m in range(npsf):
+				summ = np.float32(0.)
+				for c in range(k):
+					summ += A[p*k+c]*B[c*npsf+m]
+				C[p*npsf+m] = summ
+
+		# each band of image rows is owned by one thread, which inserts the rows of every stamp falling in it in source order
+		for t in prange(nband):
+			row0 = (NY*t)//nband
+			row1 = (NY*(t+1))//nband
+			for p in range(nstar):
+				xx = x[p]
+				yy = y[p]
+				imax = min(xx+rad, NX-1)
+				jmax = min(min(yy+rad, NY-1), row1-1)
+				for j in range(max(max(yy-rad, 0), row0), jmax+1):
+					j2 = (p*nc+j-yy+rad)*nc
+					for i in range(max(xx-rad, 0), imax+1):
+						image[j*NX+i] += C[j2+i-xx+rad]
+
+	@njit(parallel=True, cache=True)
+	def _imag_acpt(NX, NY, image, image_acpt, reg_acpt, regsize, margin, offsetx, offsety, nregx, nregy):
+		for j in prange(nregy):
+			y0 = max(j*regsize-offsety-margin, 0)
+			y1 = min((j+1)*regsize-offsety+margin, NY)
+			for i in range(nregx):
+				if reg_acpt[j*nregx+i] > 0:
+					x0 = max(i*regsize-offsetx-margin, 0)
+					x1 = min((i+1)*regsize-offsetx+margin, NX)
+					for jj in range(y0, y1):
+						for ii in range(x0, x1):
+							image_acpt[jj*NX+ii] = image[jj*NX+ii]
+
+
+class NumbaBackend(NumpyBackend):
+	'''
+	Numba versions of the model evaluation, likelihood and acceptance kernels. Arguments are the same as for the compiled libraries,
+	and arrays are passed to the jitted functions as flat views, so they should be C-contiguous.
+	'''
+
+	name = 'numba'
+
+	def __init__(self):
+		if not numba_available:
+			raise ImportError('numba is needed for the numba backend')
+
+	def clib_set_numb_thrd(self, numbthrd, booldete):
+		# the parallel loops write disjoint outputs in the serial order, so results do not depend on the number of threads
+		numba.set_num_threads(min(numbthrd, numba.config.NUMBA_NUM_THREADS))
+
+	def clib_eval_llik(self, NX, NY, model, ref, weight, diff2, regsize, margin, offsetx, offsety, booltile=1):
+		nregy, nregx = get_nreg(NX, NY, regsize, booltile)
+		_like_eval(NX, NY, model.reshape(-1), ref.reshape(-1), weight.reshape(-1), diff2.reshape(-1), regsize, margin, offsetx, offsety, nregx, nregy)
+
+	def clib_eval_modl(self, NX, NY, nstar, nc, k, A, B, C, x, y, hash, image, ref, weight, diff2, regsize, margin, offsetx, offsety, booltile=1):
+		_model_eval(NX, NY, nstar, nc, k, A.reshape(-1), B.reshape(-1), C.reshape(-1), x, y, image.reshape(-1), min(numba.get_num_threads(), NY))
+		self.clib_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety, booltile)
+
+	def clib_updt_modl(self, NX, NY, model, model_acpt, acceptreg, regsize, margin, offsetx, offsety, booltile=1):
+		nregy, nregx = get_nreg(NX, NY, regsize, booltile)
+		_imag_acpt(NX, NY, model.reshape(-1), model_acpt.reshape(-1), acceptreg.reshape(-1), regsize, margin, offsetx, offsety, nregx, nregy)
+
+	def pcat_set_num_threads(self, nthreads, deterministic):
+		self.clib_set_numb_thrd(nthreads, deterministic)
+
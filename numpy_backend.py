@@ -0,0 +1,182 @@
+import numpy as np
+
+''' This module contains a vectorized NumPy implementation of the compiled PCAT kernels, for use when no compiled library
+is available (e.g. on laptops or in CI). NumpyBackend exposes the same function names and arguments as blas.c (clib_*) and
+pcat-lion.c (pcat_*), so it can be passed anywhere the ctypes library object is used. Outputs are written in place to the
+same arguments as in the C kernels. Images are indexed as image[j*NX+i], as in the C code. '''
+
+
+def region_bounds(npix, regsize, margin, offset, nreg):
+	''' Lower and upper pixel bounds of the margin-extended regions along one image axis. '''
+	idx = np.arange(nreg)
+	lo = np.clip(idx*regsize - offset - margin, 0, npix)
+	hi = np.clip((idx+1)*regsize - offset + margin, 0, npix)
+	return lo, hi
+
+def region_sums(values, ylo, yhi, xlo, xhi):
+	'''
+	Sums of a 2D array over the (possibly overlapping) boxes [ylo[j]:yhi[j], xlo[i]:xhi[i]], using reduceat over the region edges.
+
+	Parameters
+	----------
+
+	values : '~numpy.ndarray' of shape (NY, NX)
+
+	ylo, yhi, xlo, xhi : '~numpy.ndarray's of ints
+		Region bounds along each axis, see region_bounds().
+
+	Returns
+	-------
+
+	sums : '~numpy.ndarray' of shape (len(ylo), len(xlo)), dtype float64
+
+	'''
+	# pad with a row and column of zeros so that bounds equal to the image size are valid reduceat indices
+	padded = np.zeros((values.shape[0]+1, values.shape[1]+1), dtype=np.float64)
+	padded[:-1,:-1] = values
+
+	# interleaving lower and upper bounds gives the sum over [lo, hi) at even indices, odd indices are discarded
+	yedges = np.empty(2*len(ylo), dtype=np.intp)
+	yedges[0::2], yedges[1::2] = ylo, yhi
+	xedges = np.empty(2*len(xlo), dtype=np.intp)
+	xedges[0::2], xedges[1::2] = xlo, xhi
+
+	sums = np.add.reduceat(np.add.reduceat(padded, yedges, axis=0)[0::2], xedges, axis=1)[:,0::2]
+	sums *= (yhi > ylo)[:,None]*(xhi > xlo)[None,:]
+
+	return sums
+
+def region_range(p0, p1, regsize, margin, offset, nreg):
+	''' Range [lo, hi) of the margin-extended regions along one image axis that overlap the pixel ranges [p0, p1). '''
+	lo = np.clip((p0 + offset - margin)//regsize, 0, nreg)
+	hi = np.clip(-((-(p1 + offset + margin))//regsize), 0, nreg)
+	return lo, hi
+
+def box_union_mask(x0, x1, y0, y1, NX, NY):
+	''' Boolean (NY, NX) mask of the union of boxes [y0:y1, x0:x1], computed with a cumulative sum over box corners. '''
+	good = (x0 < x1)*(y0 < y1)
+	x0, x1, y0, y1 = x0[good], x1[good], y0[good], y1[good]
+	cover = np.zeros((NY+1, NX+1), dtype=np.int32)
+	np.add.at(cover, (y0, x0), 1)
+	np.add.at(cover, (y0, x1), -1)
+	np.add.at(cover, (y1, x0), -1)
+	np.add.at(cover, (y1, x1), 1)
+	return np.cumsum(np.cumsum(cover, axis=0), axis=1)[:NY,:NX] > 0
+
+def get_nreg(NX, NY, regsize, booltile=1):
+	if booltile > 0:
+		return NY//regsize + 1, NX//regsize + 1
+	return NY//regsize, NX//regsize
+
+
+class NumpyBackend():
+	'''
+	Vectorized NumPy versions of the compiled kernels. The clib_* methods take the same arguments as blas.c, with booltile optional
+	and set to 1 by default, which is the region layout PCAT passes to every kernel. The pcat_* methods are aliases with the arguments 
+	of pcat-lion.c. bench_model_eval.py --parity checks that the outputs match the compiled backends. The pixel hash argument of the model evaluation is accepted
+	for compatibility but not needed, since the scatter-add handles sources in the same pixel.
+	'''
+
+	name = 'numpy'
+
+	def clib_set_numb_thrd(self, numbthrd, booldete):
+		pass
+
+	def clib_eval_llik(self, NX, NY, model, ref, weight, diff2, regsize, margin, offsetx, offsety, booltile=1):
+		nregy, nregx = get_nreg(NX, NY, regsize, booltile)
+		ylo, yhi = region_bounds(NY, regsize, margin, offsety, nregy)
+		xlo, xhi = region_bounds(NX, regsize, margin, offsetx, nregx)
+
+		diff = model.reshape(NY, NX) - ref.reshape(NY, NX)
+		diff2[:nregy,:nregx] = region_sums(diff*diff*weight.reshape(NY, NX), ylo, yhi, xlo, xhi)
+
+	def clib_eval_modl(self, NX, NY, nstar, nc, k, A, B, C, x, y, hash, image, ref, weight, diff2, regsize, margin, offsetx, offsety, booltile=1):
+		rad = nc//2
+		C[:nstar] = np.dot(A[:nstar], B)
+		stamps = C[:nstar].reshape(nstar, nc, nc)
+
+		rows = y[:nstar,None] - rad + np.arange(nc)[None,:]
+		cols = x[:nstar,None] - rad + np.arange(nc)[None,:]
+		inside = ((rows >= 0)*(rows < NY))[:,:,None]*((cols >= 0)*(cols < NX))[:,None,:]
+		flat_idx = rows[:,:,None]*NX + cols[:,None,:]
+
+		# np.add.at accumulates repeated indices in source order, like the insertion loop in the C kernels
+		np.add.at(image.reshape(-1), flat_idx[inside], stamps[inside])
+
+		self.clib_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety, booltile)
+
+	def clib_updt_modl(self, NX, NY, model, model_acpt, acceptreg, regsize, margin, offsetx, offsety, booltile=1):
+		nregy, nregx = get_nreg(NX, NY, regsize, booltile)
+		ylo, yhi = region_bounds(NY, regsize, margin, offsety, nregy)
+		xlo, xhi = region_bounds(NX, regsize, margin, offsetx, nregx)
+
+		jacpt, iacpt = np.nonzero(acceptreg[:nregy,:nregx] > 0)
+		mask = box_union_mask(xlo[iacpt], xhi[iacpt], ylo[jacpt], yhi[jacpt], NX, NY)
+		model_acpt.reshape(NY, NX)[mask] = model.reshape(NY, NX)[mask]
+
+	def clib_updt_modl_sprs(self, NX, NY, nstar, nc, x, y, dmodel, resid, model, weight, acceptreg, diff2, boxes, regsize, margin, offsetx, offsety, booltile=1):
+		nregy, nregx = get_nreg(NX, NY, regsize, booltile)
+		ylo, yhi = region_bounds(NY, regsize, margin, offsety, nregy)
+		xlo, xhi = region_bounds(NX, regsize, margin, offsetx, nregx)
+		rad = nc//2
+
+		# bounding box of the stamps within each accepted region, over the few regions each stamp can overlap
+		bx0, bx1 = np.maximum(x[:nstar]-rad, 0), np.minimum(x[:nstar]+rad+1, NX)
+		by0, by1 = np.maximum(y[:nstar]-rad, 0), np.minimum(y[:nstar]+rad+1, NY)
+		j0, j1 = region_range(by0, by1, regsize, margin, offsety, nregy)
+		i0, i1 = region_range(bx0, bx1, regsize, margin, offsetx, nregx)
+		jreg = j0[:,None,None] + np.arange(max(np.max(j1-j0, initial=0), 0))[None,:,None]
+		ireg = i0[:,None,None] + np.arange(max(np.max(i1-i0, initial=0), 0))[None,None,:]
+		jreg, ireg = np.broadcast_arrays(jreg, ireg)
+		valid = (jreg < j1[:,None,None])*(ireg < i1[:,None,None])
+		jreg, ireg = np.minimum(jreg, nregy-1), np.minimum(ireg, nregx-1)
+		x0 = np.maximum(xlo[ireg], bx0[:,None,None])
+		x1 = np.minimum(xhi[ireg], bx1[:,None,None])
+		y0 = np.maximum(ylo[jreg], by0[:,None,None])
+		y1 = np.minimum(yhi[jreg], by1[:,None,None])
+		overlap = valid*(x0 < x1)*(y0 < y1)*(acceptreg[:nregy,:nregx][jreg, ireg] > 0)
+
+		reg = (jreg*nregx + ireg)[overlap]
+		boxes[:nregy*nregx] = (NX, 0, NY, 0)
+		np.minimum.at(boxes[:,0], reg, x0[overlap])
+		np.maximum.at(boxes[:,1], reg, x1[overlap])
+		np.minimum.at(boxes[:,2], reg, y0[overlap])
+		np.maximum.at(boxes[:,3], reg, y1[overlap])
+
+		# the boxes of accepted regions are disjoint, so each one is updated on its own slice of the images
+		res2d, mod2d = resid.reshape(NY, NX), model.reshape(NY, NX)
+		dmod2d, weig2d = dmodel.reshape(NY, NX), weight.reshape(NY, NX)
+		dchi2 = 0.
+		for r in np.flatnonzero((boxes[:nregy*nregx,0] < boxes[:nregy*nregx,1])*(boxes[:nregy*nregx,2] < boxes[:nregy*nregx,3])):
+			cx0, cx1, cy0, cy1 = boxes[r]
+			dm = dmod2d[cy0:cy1, cx0:cx1]
+			dm64 = dm.astype(np.float64)
+			dchi2_pix = (dm64 - 2.*res2d[cy0:cy1, cx0:cx1])*dm64*weig2d[cy0:cy1, cx0:cx1]
+
+			# regions overlapping the box, with bounds relative to the box corner
+			(rj0,), (rj1,) = region_range(np.array([cy0]), np.array([cy1]), regsize, margin, offsety, nregy)
+			(ri0,), (ri1,) = region_range(np.array([cx0]), np.array([cx1]), regsize, margin, offsetx, nregx)
+			diff2[rj0:rj1, ri0:ri1] += region_sums(dchi2_pix, np.clip(ylo[rj0:rj1]-cy0, 0, cy1-cy0), np.clip(yhi[rj0:rj1]-cy0, 0, cy1-cy0), \
+														np.clip(xlo[ri0:ri1]-cx0, 0, cx1-cx0), np.clip(xhi[ri0:ri1]-cx0, 0, cx1-cx0))
+			res2d[cy0:cy1, cx0:cx1] -= dm
+			mod2d[cy0:cy1, cx0:cx1] += dm
+			dchi2 += np.sum(dchi2_pix)
+
+		return dchi2
+
+	# pcat-lion.c names, without the booltile argument
+	def pcat_set_num_threads(self, nthreads, deterministic):
+		pass
+
+	def pcat_like_eval(self, NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety):
+		self.clib_eval_llik(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety)
+
+	def pcat_model_eval(self, NX, NY, nstar, nc, k, A, B, C, x, y, hash, image, ref, weight, diff2, regsize, margin, offsetx, offsety):
+		self.clib_eval_modl(NX, NY, nstar, nc, k, A, B, C, x, y, hash, image, ref, weight, diff2, regsize, margin, offsetx, offsety)
+
+	def pcat_imag_acpt(self, NX, NY, image, image_acpt, reg_acpt, regsize, margin, offsetx, offsety):
+		self.clib_updt_modl(NX, NY, image, image_acpt, reg_acpt, regsize, margin, offsetx, offsety)
+
+	def pcat_imag_acpt_sparse(self, NX, NY, nstar, nc, x, y, image, resid, model, weight, reg_acpt, diff2, boxes, regsize, margin, offsetx, offsety):
+		return self.clib_updt_modl_sprs(NX, NY, nstar, nc, x, y, image, resid, model, weight, reg_acpt, diff2, boxes, regsize, margin, offsetx, offsety)
+
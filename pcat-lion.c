@@ -1,6 +1,11 @@
 #include <stdlib.h>
+#include <math.h>
 #include <stdbool.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 #include "mkl_cblas.h"
+#include "mkl_service.h"
 #include "i_malloc.h"
 #define max(a,b) \
     ({ typeof (a) _a = (a);    \
@@ -11,6 +16,15 @@
 	typeof (b) _b = (b);   \
         _a < _b ? _a : _b; })
 
+// sets the number of OpenMP threads (of the calling thread only, so call it from each thread that runs kernels) used by the region and row band loops. if deterministic > 0 the MKL matrix product is 
+// kept single-threaded, so results match the serial kernels bit for bit (the OpenMP loops are deterministic by construction)
+void pcat_set_num_threads(int nthreads, int deterministic) {
+#ifdef _OPENMP
+    omp_set_num_threads(nthreads);
+#endif
+    mkl_set_num_threads(deterministic > 0 ? 1 : nthreads);
+}
+
 void pcat_imag_acpt(int NX, int NY, float* image, float* image_acpt, int* reg_acpt, int regsize, int margin, int offsetx, int offsety) {
     int NREGX = (NX / regsize) + 1;
     int NREGY = (NY / regsize) + 1;
@@ -30,10 +44,104 @@ void pcat_imag_acpt(int NX, int NY, float* image, float* image_acpt, int* reg_ac
     }
 }
 
+// range [*lo, *hi) of the margin-extended regions along one axis that overlap the pixels [p0, p1). region k covers
+// [k*regsize-offset-margin, (k+1)*regsize-offset+margin), and negative numerators (which truncate towards zero) are clamped to 0
+static void region_range(int p0, int p1, int regsize, int margin, int offset, int nreg, int* lo, int* hi){
+    *lo = max((p0 + offset - margin) / regsize, 0);
+    *hi = min((p1 + offset + margin + regsize - 1) / regsize, nreg);
+}
+
+
+double pcat_imag_acpt_sparse(int NX, int NY, int nstar, int nc, int* x, int* y, float* image, float* resid, float* model,
+	float* weight, int* reg_acpt, double* diff2, int* boxes, int regsize, int margin, int offsetx, int offsety)
+{
+    // applies the accepted part of a delta model to the residual and model images, only visiting the bounding box of the 
+    // PSF stamps that fall in each accepted region. assumes the footprints (with margins) of accepted regions do not overlap.
+    // diff2 holds the chi2 of each region (with margins) and is updated in place. returns the change in full-image chi2.
+    int NREGX = (NX / regsize) + 1;
+    int NREGY = (NY / regsize) + 1;
+    int rad = nc/2;
+    int i, j, ii, jj, r, istar, reg, x0, x1, y0, y1, bx0, bx1, by0, by1, cx0, cx1, cy0, cy1;
+    int i0, i1, j0, j1;
+    double dchi2 = 0., dm;
+
+    for (r=0 ; r < NREGX*NREGY ; r++) {
+        boxes[4*r] = NX; boxes[4*r+1] = 0; boxes[4*r+2] = NY; boxes[4*r+3] = 0;
+    }
+
+    // bounding box of the stamps within each accepted region
+    for (istar = 0 ; istar < nstar ; istar++) {
+        bx0 = max(x[istar]-rad, 0);
+        bx1 = min(x[istar]+rad+1, NX);
+        by0 = max(y[istar]-rad, 0);
+        by1 = min(y[istar]+rad+1, NY);
+        region_range(by0, by1, regsize, margin, offsety, NREGY, &j0, &j1);
+        region_range(bx0, bx1, regsize, margin, offsetx, NREGX, &i0, &i1);
+        for (j=j0 ; j < j1 ; j++) {
+            y0 = max(max(j*regsize-offsety-margin, 0), by0);
+            y1 = min(min((j+1)*regsize-offsety+margin, NY), by1);
+            if (y0 >= y1) continue;
+            for (i=i0 ; i < i1 ; i++) {
+                if (reg_acpt[j*NREGX+i] <= 0) continue;
+                x0 = max(max(i*regsize-offsetx-margin, 0), bx0);
+                x1 = min(min((i+1)*regsize-offsetx+margin, NX), bx1);
+                if (x0 >= x1) continue;
+                reg = 4*(j*NREGX+i);
+                boxes[reg] = min(boxes[reg], x0);
+                boxes[reg+1] = max(boxes[reg+1], x1);
+                boxes[reg+2] = min(boxes[reg+2], y0);
+                boxes[reg+3] = max(boxes[reg+3], y1);
+            }
+        }
+    }
+
+    // change in chi2 of every region that overlaps a box, using the residual before the update
+    for (r=0 ; r < NREGX*NREGY ; r++) {
+        bx0 = boxes[4*r]; bx1 = boxes[4*r+1]; by0 = boxes[4*r+2]; by1 = boxes[4*r+3];
+        if (bx0 >= bx1 || by0 >= by1) continue;
+        for (jj=by0 ; jj<by1; jj++)
+         for (ii=bx0 ; ii<bx1; ii++) {
+            dm = image[jj*NX+ii];
+            dchi2 += (dm - 2.*resid[jj*NX+ii]) * dm * weight[jj*NX+ii];
+         }
+        region_range(by0, by1, regsize, margin, offsety, NREGY, &j0, &j1);
+        region_range(bx0, bx1, regsize, margin, offsetx, NREGX, &i0, &i1);
+        for (j=j0 ; j < j1 ; j++) {
+            cy0 = max(max(j*regsize-offsety-margin, 0), by0);
+            cy1 = min(min((j+1)*regsize-offsety+margin, NY), by1);
+            if (cy0 >= cy1) continue;
+            for (i=i0 ; i < i1 ; i++) {
+                cx0 = max(max(i*regsize-offsetx-margin, 0), bx0);
+                cx1 = min(min((i+1)*regsize-offsetx+margin, NX), bx1);
+                if (cx0 >= cx1) continue;
+                for (jj=cy0 ; jj<cy1; jj++)
+                 for (ii=cx0 ; ii<cx1; ii++) {
+                    dm = image[jj*NX+ii];
+                    diff2[j*NREGX+i] += (dm - 2.*resid[jj*NX+ii]) * dm * weight[jj*NX+ii];
+                 }
+            }
+        }
+    }
+
+    // implement the accepted delta model
+    for (r=0 ; r < NREGX*NREGY ; r++) {
+        bx0 = boxes[4*r]; bx1 = boxes[4*r+1]; by0 = boxes[4*r+2]; by1 = boxes[4*r+3];
+        for (jj=by0 ; jj<by1; jj++)
+         for (ii=bx0 ; ii<bx1; ii++) {
+            resid[jj*NX+ii] -= image[jj*NX+ii];
+            model[jj*NX+ii] += image[jj*NX+ii];
+         }
+    }
+
+    return dchi2;
+}
+
 void pcat_like_eval(int NX, int NY, float* image, float* ref, float* weight, double* diff2, int regsize, int margin, int offsetx, int offsety) {
     int NREGX = (NX / regsize) + 1;
     int NREGY = (NY / regsize) + 1;
     int y0, y1, x0, x1, i, j, ii, jj;
+    // regions are independent, so each one is summed by a single thread in the same order as the serial loop
+    #pragma omp parallel for private(y0, y1, x0, x1, i, ii, jj) schedule(static)
     for (j=0 ; j < NREGY ; j++) {
         y0 = max(j*regsize-offsety-margin, 0);
         y1 = min((j+1)*regsize-offsety+margin, NY);
@@ -49,7 +157,7 @@ void pcat_like_eval(int NX, int NY, float* image, float* ref, float* weight, dou
 }
 
 void pcat_model_eval(int NX, int NY, int nstar, int nc, int k, float* A, float* B, float* C, int* x,
-	int* y, float* image, float* ref, float* weight, double* diff2, int regsize, int margin,
+	int* y, int* hash, float* image, float* ref, float* weight, double* diff2, int regsize, int margin,
 	int offsetx, int offsety)
 {
     int      i,i2,imax,j,j2,jmax,rad,istar,xx,yy;
@@ -62,8 +170,8 @@ void pcat_model_eval(int NX, int NY, int nstar, int nc, int k, float* A, float*
 
     // overwrite and shorten A matrix
     // save time if there are many sources per pixel
-    int hash[NY*NX];
-    for (i=0; i<NY*NX; i++) { hash[i] = -1; }
+    // hash is a caller-owned workspace of NY*NX entries that must be -1 on entry. only the entries touched here are reset 
+    // below, which avoids both a full-image memset and a stack allocation that overflows on large images
     int jstar = 0;
     for (istar = 0; istar < nstar; istar++)
     {
@@ -82,22 +190,112 @@ void pcat_model_eval(int NX, int NY, int nstar, int nc, int k, float* A, float*
         }
     }
     nstar = jstar;
+    for (istar = 0; istar < nstar; istar++) { hash[y[istar]*NX+x[istar]] = -1; }
 
     //  matrix multiplication
     cblas_sgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
         nstar, n, k, alpha, A, k, B, n, beta, C, n);
 
     //  loop over stars, insert psfs into image    
+    // with OpenMP each thread owns a band of image rows and inserts the rows of every stamp that fall in it, in source order, 
+    // so there are no write conflicts and every pixel is summed in the same order as in the serial loop
+    #pragma omp parallel private(i, i2, imax, j, j2, jmax, istar, xx, yy)
+    {
+    int row0 = 0, row1 = NY;
+#ifdef _OPENMP
+    row0 = (NY*omp_get_thread_num())/omp_get_num_threads();
+    row1 = (NY*(omp_get_thread_num()+1))/omp_get_num_threads();
+#endif
     for (istar = 0 ; istar < nstar ; istar++)
     {
 	xx = x[istar];
 	yy = y[istar];
 	imax = min(xx+rad,NX-1);
-	jmax = min(yy+rad,NY-1);
-	for (j = max(yy-rad,0), j2 = (istar*nc+j-yy+rad)*nc ; j <= jmax ; j++, j2+=nc)
+	jmax = min(min(yy+rad,NY-1),row1-1);
+	for (j = max(max(yy-rad,0),row0), j2 = (istar*nc+j-yy+rad)*nc ; j <= jmax ; j++, j2+=nc)
 	    for (i = max(xx-rad,0), i2 = i-xx+rad ; i <= imax ; i++, i2++)
 		image[j*NX+i] += C[i2+j2];
     }
+    }
 
     pcat_like_eval(NX, NY, image, ref, weight, diff2, regsize, margin, offsetx, offsety);
 }
+
+// fused multiband evaluation: transforms the pivot band positions x, y to every band with the fast astrometry tables, builds the
+// design matrix and evaluates each band model and its region chi2 with pcat_model_eval, summing the region chi2 over bands into diff2.
+// astrom holds, for each band b > 0 in turn, the 6 x AH x AW tables of fast_astrom.fit_astrom_arrays (xtrans, ytrans, dxpdx, dypdx,
+// dxpdy, dypdy), with astrom_dims[2*(b-1)] = AW and astrom_dims[2*(b-1)+1] = AH, or AW = 0 if band b shares the pivot band astrometry.
+// f (nbands x nstar) holds the band fluxes already scaled to pixel units, B (nbands x k x nc*nc) the PSF coefficients, and xp, yp
+// (nbands x nstar) receive the transformed positions. images, refs, weights and hashes are arrays of per-band pointers, and imszs,
+// regsizes, margins, offsetxs and offsetys hold two, one, one, one and one entries per band. A, C, x0, y0 and diff2_band are 
+// workspaces of nstar x k, nstar x nc*nc, nstar, nstar and nreg entries. images are filled with the band backgrounds first.
+void pcat_multiband_eval(int nbands, int nstar, int nc, int k, float* x, float* y, float* f, float* backs, double* astrom, int* astrom_dims,
+	float* A, float* B, float* C, int* x0, int* y0, float* xp, float* yp, int** hashes, float** images, float** refs, float** weights,
+	double* diff2_band, double* diff2, int* imszs, int* regsizes, int* margins, int* offsetxs, int* offsetys)
+{
+    int b, p, r, xi, yi, n, NX, NY, AW, AH, nreg;
+    long idx, plane, offset = 0;
+    float xb, yb, xr, yr, dx, dy, fl;
+    double* tab;
+
+    for (b = 0; b < nbands; b++)
+    {
+        NX = imszs[2*b];
+        NY = imszs[2*b+1];
+        AW = 0; AH = 0;
+        if (b > 0) { AW = astrom_dims[2*(b-1)]; AH = astrom_dims[2*(b-1)+1]; }
+        tab = astrom + offset;
+        plane = (long)AW*AH;
+
+        n = 0;
+        for (p = 0; p < nstar; p++)
+        {
+            if (AW == 0) { xb = x[p]; yb = y[p]; }
+            else {
+                // same nearest-pixel linearization as fast_astrom.transform_q
+                xr = floorf(x[p]+0.5f);
+                yr = floorf(y[p]+0.5f);
+                xi = min(max((int)xr, 0), AW-1);
+                yi = min(max((int)yr, 0), AH-1);
+                idx = (long)yi*AW+xi;
+                xb = (float)(tab[idx] + (x[p]-xr)*tab[2*plane+idx] + (y[p]-yr)*tab[4*plane+idx]);
+                yb = (float)(tab[plane+idx] + (x[p]-xr)*tab[3*plane+idx] + (y[p]-yr)*tab[5*plane+idx]);
+            }
+            xp[b*nstar+p] = xb;
+            yp[b*nstar+p] = yb;
+
+            // sources outside the band image are dropped, as in image_model_eval
+            if (xb > 0 && xb < NX-1 && yb > 0 && yb < NY-1)
+            {
+                x0[n] = (int)ceilf(xb);
+                y0[n] = (int)ceilf(yb);
+                dx = x0[n] - xb;
+                dy = y0[n] - yb;
+                fl = f[b*nstar+p];
+                A[n*k+0] = fl;
+                A[n*k+1] = fl*dx;
+                A[n*k+2] = fl*dy;
+                A[n*k+3] = fl*dx*dx;
+                A[n*k+4] = fl*dx*dy;
+                A[n*k+5] = fl*dy*dy;
+                A[n*k+6] = fl*dx*dx*dx;
+                A[n*k+7] = fl*dx*dx*dy;
+                A[n*k+8] = fl*dx*dy*dy;
+                A[n*k+9] = fl*dy*dy*dy;
+                n++;
+            }
+        }
+
+        for (r = 0; r < NX*NY; r++) { images[b][r] = backs[b]; }
+
+        nreg = (NX/regsizes[b]+1)*(NY/regsizes[b]+1);
+        for (r = 0; r < nreg; r++) { diff2_band[r] = 0.; }
+
+        pcat_model_eval(NX, NY, n, nc, k, A, B+(long)b*k*nc*nc, C, x0, y0, hashes[b], images[b], refs[b], weights[b], diff2_band, \
+            regsizes[b], margins[b], offsetxs[b], offsetys[b]);
+
+        for (r = 0; r < nreg; r++) { diff2[r] = (b == 0) ? diff2_band[r] : diff2[r] + diff2_band[r]; }
+
+        offset += 6*plane;
+    }
+}
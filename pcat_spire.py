@@ -13,9 +13,16 @@ import os.path
 from os import path
 import sys
 import warnings
+import resource
+from concurrent.futures import ThreadPoolExecutor
 import scipy.stats as stats
 from scipy.ndimage import gaussian_filter
-from image_eval import psf_poly_fit, image_model_eval
+from image_eval import psf_poly_fit, image_model_eval, make_pixel_hash, EvalBufferPool
+from numpy_backend import NumpyBackend
+from spatial_index import neighbours, neighbour_cutoff, gaussian_adjacency, SourceGrid
+from chain_io import ChainWriter, ChainStore, ChainReader, RaggedCatalog
+from multichain import run_chains, run_tempered, chain_summary, exchange_replica_state
+from backends import load_backend, select_backend, declare_kernels, set_kernel_threads, uses_pcat_names, get_model_kernel, get_fused_kernel, fused_pointers
 from fast_astrom import *
 import pickle
 from spire_data_utils import *
@@ -53,6 +60,10 @@ def save_params(directory, gdat):
 	param_dict = vars(gdat).copy()
 	param_dict['fc_templates'] = None # these take up too much space and not necessary
 	param_dict['truth_catalog'] = None 
+	param_dict['pixel_hashes'] = None
+	param_dict['flog'] = None
+	param_dict['chain_queue'] = None
+	param_dict['exchange_queues'] = None
 	
 	with open(directory+'/params.txt', 'wb') as file:
 		file.write(pickle.dumps(param_dict))
@@ -64,6 +75,33 @@ def save_params(directory, gdat):
 			file2.write(key+': '+str(param_dict[key])+'\n')
 	file2.close()
 
+def save_checkpoint(directory, state):
+	''' 
+	Pickles the sampler state to directory/checkpoint.pkl. The state is written to a temporary file in the same directory, 
+	flushed to disk and then renamed over the previous checkpoint, so an interrupted write leaves the previous checkpoint intact.
+	'''
+	path = directory+'/checkpoint.pkl'
+	with open(path+'.tmp', 'wb') as file:
+		pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+		file.flush()
+		os.fsync(file.fileno())
+	os.replace(path+'.tmp', path)
+
+	# make the rename itself durable
+	dirfd = os.open(directory, os.O_RDONLY)
+	try:
+		os.fsync(dirfd)
+	finally:
+		os.close(dirfd)
+
+def load_checkpoint(directory):
+	''' Loads the sampler state saved by save_checkpoint(), or returns None if directory has no checkpoint. '''
+	path = directory+'/checkpoint.pkl'
+	if not os.path.isfile(path):
+		return None
+	with open(path, 'rb') as file:
+		return pickle.load(file)
+
 def fluxes_to_color(flux1, flux2):
 	return 2.5*np.log10(flux1/flux2)
 
@@ -73,32 +111,15 @@ def initialize_c(gdat, libmmult, cblas=False):
 	# if gdat.verbtype > 1:
 	# 	print('initializing c routines and data structs', file=gdat.flog)
 
-	array_2d_float = npct.ndpointer(dtype=np.float32, ndim=2, flags="C_CONTIGUOUS")
-	array_1d_int = npct.ndpointer(dtype=np.int32, ndim=1, flags="C_CONTIGUOUS")
-	array_2d_double = npct.ndpointer(dtype=np.float64, ndim=2, flags="C_CONTIGUOUS")
-	array_2d_int = npct.ndpointer(dtype=np.int32, ndim=2, flags="C_CONTIGUOUS")
+	# persistent per-band pixel hash workspaces used by the model evaluation kernels to combine sources that land in the same pixel.
+	# the kernels only reset the entries they touch, so these are initialized once here rather than on every call
+	gdat.pixel_hashes = [make_pixel_hash(imsz) for imsz in gdat.imszs]
 
-	if cblas:
-		if os.path.getmtime('pcat-lion.c') > os.path.getmtime('pcat-lion.so'):
-			warnings.warn('pcat-lion.c modified after compiled pcat-lion.so', Warning)		
-				
-		libmmult.pcat_model_eval.restype = None
-		libmmult.pcat_model_eval.argtypes = [c_int, c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
-		libmmult.pcat_imag_acpt.restype = None
-		libmmult.pcat_imag_acpt.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_int, c_int, c_int, c_int, c_int]
-		libmmult.pcat_like_eval.restype = None
-		libmmult.pcat_like_eval.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
+	# the numpy and numba backends take python arguments directly, no ctypes declarations needed
+	if not isinstance(libmmult, NumpyBackend):
+		declare_kernels(libmmult, cblas)
 
-	else:
-		if os.path.getmtime('blas.c') > os.path.getmtime('blas.so'):
-			warnings.warn('blas.c modified after compiled blas.so', Warning)		
-		
-		libmmult.clib_eval_modl.restype = None
-		libmmult.clib_eval_modl.argtypes = [c_int, c_int, c_int, c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_1d_int, array_1d_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
-		libmmult.clib_updt_modl.restype = None
-		libmmult.clib_updt_modl.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_int, c_int, c_int, c_int, c_int]
-		libmmult.clib_eval_llik.restype = None
-		libmmult.clib_eval_llik.argtypes = [c_int, c_int, array_2d_float, array_2d_float, array_2d_float, array_2d_double, c_int, c_int, c_int, c_int]
+	set_kernel_threads(libmmult, cblas, gdat.n_threads, gdat.deterministic_kernels)
 
 def add_directory(dirpath):
 	if not os.path.isdir(dirpath):
@@ -146,27 +167,13 @@ def create_directories(gdat):
 	print('timestr:', timestr)
 	return frame_dir_name, new_dir_name, timestr
 
-def neighbours(x,y,neigh,i,generate=False):
-	''' Neighbours function is used in merge proposal, where you have some source and you want to choose a nearby
-		source with some probability to merge. '''
-
-	neighx = np.abs(x - x[i])
-	neighy = np.abs(y - y[i])
-	adjacency = np.exp(-(neighx*neighx + neighy*neighy)/(2.*neigh*neigh))
-	adjacency[i] = 0.
-	neighbours = np.sum(adjacency)
-	if generate:
-		if neighbours:
-			j = np.random.choice(adjacency.size, p=adjacency.flatten()/float(neighbours))
-		else:
-			j = -1
-		return neighbours, j
-	else:
-		return neighbours
-
 def get_region(x, offsetx, regsize):
 	return (np.floor(x + offsetx).astype(np.int) / regsize).astype(np.int)
 
+def row_band(image, nx, y0, y1):
+	''' View of rows y0 <= y < y1 of a C-contiguous image with rows of length nx. '''
+	return image.reshape(-1)[y0*nx:y1*nx].reshape(y1-y0, nx)
+
 def idx_parity(x, y, n, offsetx, offsety, parity_x, parity_y, regsize):
 	match_x = (get_region(x[0:n], offsetx, regsize) % 2) == parity_x
 	match_y = (get_region(y[0:n], offsety, regsize) % 2) == parity_y
@@ -287,6 +294,175 @@ class Proposal:
 			return self.stars0[self._X,:], self.stars0[self._Y,:]
 
 
+class RegionTask:
+	''' 
+	Share of a region-parallel point source proposal handled by one thread (see Model.region_parallel_step()). The thread
+	proposes within the active regions of region rows [rows[0], rows[1]), i.e. pairs kregy[0] <= k < kregy[1] of rows 2k+parity_y, 
+	using its own random state, and may add at most room sources to the catalog.
+	'''
+	def __init__(self, kregy, parity_y, frac, room, rng):
+		self.kregy = kregy
+		self.rows = (2*kregy[0]+parity_y, 2*kregy[1]+parity_y-1)
+		self.frac = frac
+		self.room = room
+		self.rng = rng
+
+
+class ResidualProjections:
+	'''
+	Noise-weighted dot products <c, W r> of the residuals r of each band with the linear components c of its model, and the Gram 
+	matrices <c, W c'> of the components. The components are the background level (a map of ones), the templates and the Fourier 
+	templates, with indices 0, 1 + template index and fc_offset + (i*n_terms + j)*4 + k. A proposal that changes the amplitudes of 
+	components by a changes the chi2 of band b by a^T G a - 2 a^T <c, W r>, which is computed here without touching the pixels. 
+	The Gram matrices only depend on the weights. The dot products are updated with the Gram matrices after accepted component changes, 
+	and with the projections of the accepted delta model over the boxes touched by sparse point source acceptance (see box_projections()), 
+	so they are only recomputed from the full residuals after invalidate().
+
+	Parameters
+	----------
+
+	weights : list of `~numpy.ndarray's
+		Pixel weights of each band.
+
+	templates : list of lists, optional
+		Template images of each band, with None for templates not used in a band. Default is 'None'.
+
+	fourier_templates : list of `FourierBasis' objects, optional
+		Fourier templates of each band. Default is 'None'.
+
+	n_terms : int, optional
+		Order of the Fourier expansion. Default is 'None'.
+
+	'''
+	def __init__(self, weights, templates=None, fourier_templates=None, n_terms=None):
+		self.weights = weights
+		self.templates = templates
+		self.fourier_templates = fourier_templates
+		self.n_terms = n_terms
+		self.fc_offset = 1
+		if templates is not None:
+			self.fc_offset += max([len(temps) for temps in templates])
+		self.components = [self.map_components(b) for b in range(len(weights))]
+		self.gram = [self.component_gram(b) for b in range(len(weights))]
+		self.proj = None
+
+	def map_components(self, b):
+		''' Background and template components of band b as an array of shape (fc_offset, npix). '''
+		w = self.weights[b]
+		components = np.zeros((self.fc_offset, w.size))
+		components[0] = 1.
+		if self.templates is not None:
+			for i, temp in enumerate(self.templates[b]):
+				if temp is not None:
+					components[1+i] = temp.ravel()
+		return components
+
+	def component_gram(self, b):
+		w = self.weights[b].astype(np.float64)
+		components = self.components[b]
+		if self.fourier_templates is None:
+			return np.dot(components*w.ravel(), components.T)
+
+		fc_gram = self.fourier_templates[b].weighted_gram(w, self.n_terms)
+		gram = np.zeros((self.fc_offset+fc_gram.shape[0],)*2)
+		gram[:self.fc_offset,:self.fc_offset] = np.dot(components*w.ravel(), components.T)
+		gram[self.fc_offset:,self.fc_offset:] = fc_gram
+		for l, component in enumerate(components):
+			gram[l,self.fc_offset:] = self.fourier_templates[b].project(w*component.reshape(w.shape), self.n_terms).ravel()
+		gram[self.fc_offset:,:self.fc_offset] = gram[:self.fc_offset,self.fc_offset:].T
+		return gram
+
+	def invalidate(self):
+		self.proj = None
+
+	def project(self, resids):
+		''' Computes the dot products of the components with the weighted residuals, if they are not up to date. '''
+		if self.proj is not None:
+			return
+		self.proj = []
+		for b, resid in enumerate(resids):
+			wr = self.weights[b]*resid
+			proj = np.dot(self.components[b], wr.ravel().astype(np.float64))
+			if self.fourier_templates is not None:
+				proj = np.concatenate([proj, self.fourier_templates[b].project(wr, self.n_terms).ravel()])
+			self.proj.append(proj)
+
+	def fc_index(self, idxvec):
+		return self.fc_offset + (idxvec[0]*self.n_terms + idxvec[1])*4 + idxvec[2]
+
+	def dchi2(self, resids, b, idx, amps):
+		''' Change in the chi2 of band b when the amplitudes of components idx change by amps. '''
+		self.project(resids)
+		return np.dot(amps, np.dot(self.gram[b][np.ix_(idx, idx)], amps)) - 2*np.dot(amps, self.proj[b][idx])
+
+	def update(self, b, dproj):
+		''' Updates the dot products of band b after the residuals changed by -d, with dproj the dot products <c, W d>. '''
+		if self.proj is not None:
+			self.proj[b] -= dproj
+
+	def accept(self, b, idx, amps):
+		''' Updates the dot products of band b after an accepted change of the amplitudes of components idx by amps. '''
+		if self.proj is not None:
+			self.update(b, np.dot(self.gram[b][:,idx], amps))
+
+	def box_projections(self, b, dmodel, boxes, y0=0):
+		'''
+		Dot products <c, W d> of the components of band b with a delta model d that is zero outside of a set of boxes, as applied by 
+		the sparse acceptance kernels. The cost is proportional to the area of the boxes rather than the image.
+
+		Parameters
+		----------
+
+		dmodel : `~numpy.ndarray'
+			Delta model of rows y0 onwards of the image.
+
+		boxes : `~numpy.ndarray' of shape (nbox, 4)
+			Boxes (x0, x1, y0, y1) of dmodel, relative to row y0 of the image. Empty boxes are skipped.
+
+		y0 : int, optional
+			First image row of dmodel. Default is 0.
+
+		Returns
+		-------
+
+		dproj : `~numpy.ndarray' of shape (ncomponents,)
+
+		'''
+		w = self.weights[b]
+		ny, nx = w.shape
+		dmodel = dmodel.reshape(-1, nx)
+		components = self.components[b].reshape(self.fc_offset, ny, nx)
+		dproj = np.zeros(self.gram[b].shape[0])
+		for bx0, bx1, by0, by1 in boxes:
+			if bx0 >= bx1 or by0 >= by1:
+				continue
+			wd = w[y0+by0:y0+by1, bx0:bx1]*dmodel[by0:by1, bx0:bx1].astype(np.float64)
+			dproj[:self.fc_offset] += np.tensordot(components[:, y0+by0:y0+by1, bx0:bx1], wd, axes=2)
+			if self.fourier_templates is not None:
+				dproj[self.fc_offset:] += self.fourier_templates[b].project(wd, self.n_terms, y0=y0+by0, x0=bx0).ravel()
+		return dproj
+
+	def render(self, b, idx, amps):
+		''' Model image of the change of the amplitudes of components idx of band b by amps. '''
+		shape = self.weights[b].shape
+		dmodel = np.zeros(shape, dtype=np.float64)
+		fc_amps = np.zeros(0 if self.fourier_templates is None else 4*self.n_terms**2)
+		for l, amp in zip(idx, amps):
+			if l == 0:
+				dmodel += amp
+			elif l < self.fc_offset:
+				dmodel += amp*self.templates[b][l-1]
+			else:
+				fc_amps[l-self.fc_offset] = amp
+		nz = np.flatnonzero(fc_amps)
+		if nz.size == 1:
+			i, j, k = np.unravel_index(nz[0], (self.n_terms, self.n_terms, 4))
+			dmodel += fc_amps[nz[0]]*self.fourier_templates[b].template(i, j, k)
+		elif nz.size > 1:
+			dmodel += self.fourier_templates[b].evaluate(fc_amps.reshape((self.n_terms, self.n_terms, 4)))
+		return dmodel.astype(np.float32)
+
+
 class Model:
 
 	_X = 0
@@ -312,6 +488,29 @@ class Model:
 		self.imszs = gdat.imszs # this is list of image sizes for all bands, not just first one
 		self.kickrange = gdat.kickrange
 		self.libmmult = libmmult
+		self.temperature = gdat.temperature
+
+		# scratch buffers reused across likelihood evaluations, see pcat_multiband_eval()
+		self.eval_pool = EvalBufferPool()
+		self.n_pool_alloc_prev = 0
+
+		# kernel evaluating all bands in one native call (None for the python backends), see pcat_multiband_eval()
+		self.fused_eval = get_fused_kernel(libmmult, gdat.cblas)
+		self.fused_args = None
+		if self.fused_eval is not None:
+			self.init_fused_eval()
+
+		# thread pool and per-thread workspaces for region-parallel point source proposals, see region_parallel_step()
+		self.region_executor = None
+		self.residual_projections = None
+		if gdat.n_region_threads > 1:
+			# the OpenMP (and numba) thread counts are per calling thread, so they are set again in each worker
+			initializer, initargs = None, ()
+			if libmmult is not None:
+				initializer, initargs = set_kernel_threads, (libmmult, gdat.cblas, gdat.n_threads, gdat.deterministic_kernels)
+			self.region_executor = ThreadPoolExecutor(max_workers=gdat.n_region_threads, initializer=initializer, initargs=initargs)
+			self.region_workspaces = [dict({'pool':EvalBufferPool(), 'pixel_hashes':[make_pixel_hash(imsz) for imsz in gdat.imszs]}) \
+										for t in range(gdat.n_region_threads)]
 
 		self.margins = np.zeros(gdat.nbands).astype(np.int)
 		self.max_nsrc = gdat.max_nsrc
@@ -358,18 +557,10 @@ class Model:
 
 
 				_, _, _, bt_siginv_b_inv, A_hat = compute_Ahat_templates(self.gdat.MP_order, self.dat.errors[0],\
-																		fourier_templates=self.gdat.fc_templates[0][:self.gdat.MP_order,:self.gdat.MP_order,:], \
+																		fourier_templates=self.gdat.fc_templates[0], \
 																		data = self.dat.data_array[0], mean_sig=self.gdat.mean_sig, ridge_fac=self.gdat.ridge_fac)
 
-				init_coeffs = np.empty((self.gdat.MP_order,self.gdat.MP_order,4))
-				count = 0
-				for i in range(self.gdat.MP_order):
-					for j in range(self.gdat.MP_order):
-						for k in range(4):
-							init_coeffs[i,j,k] = A_hat[count]
-							count += 1
-
-				self.fourier_coeffs[:self.gdat.MP_order, :self.gdat.MP_order, :] = init_coeffs.copy()
+				self.fourier_coeffs[:self.gdat.MP_order, :self.gdat.MP_order, :] = A_hat.reshape((self.gdat.MP_order, self.gdat.MP_order, 4))
 
 			self.n_fourier_terms = self.gdat.n_fourier_terms
 			self.dfc = np.zeros((self.n_fourier_terms, self.n_fourier_terms, 4))
@@ -445,7 +636,8 @@ class Model:
 		print('self.color_mus : ', self.color_mus)
 		print('self.color_sigs : ', self.color_sigs)
 
-		if gdat.load_state_timestr is None:
+		# when resuming, the state is restored from the run's checkpoint in lion.main()
+		if gdat.load_state_timestr is None or gdat.resume:
 			for b in range(gdat.nbands):
 
 				if b==0:
@@ -467,6 +659,7 @@ class Model:
 
 			gdat_previous, _, _ = load_param_dict(gdat.load_state_timestr, result_path=gdat.result_path)
 
+			# (2+nbands, n) catalog, or (2+nbands, max_nsrc) zero-padded in older runs
 			previous_cat = np.load(catpath)['cat']
 
 			self.n = np.count_nonzero(previous_cat[self._F,:])
@@ -490,14 +683,14 @@ class Model:
 
 			if gdat_previous.nbands == gdat.nbands:
 				print('same number of bands, set catalogs equal to each other')
-				self.stars = previous_cat
+				self.stars[:,0:self.n] = previous_cat[:,0:self.n]
 			else:
 				print('were gonna have to draw some colors babyy')
-				self.stars[self._X,:] = previous_cat[self._X,:]
-				self.stars[self._Y,:] = previous_cat[self._Y,:]
+				self.stars[self._X,0:self.n] = previous_cat[self._X,0:self.n]
+				self.stars[self._Y,0:self.n] = previous_cat[self._Y,0:self.n]
 				for b in range(gdat.nbands):
 					if gdat_previous.nbands > b:
-						self.stars[self._F+b,:] = previous_cat[self._F+b,:]
+						self.stars[self._F+b,0:self.n] = previous_cat[self._F+b,0:self.n]
 					else:
 						print('drawing colors on band ', b)
 						new_colors = np.random.normal(loc=self.color_mus[b-1], scale=self.color_sigs[b-1], size=self.n)
@@ -507,6 +700,73 @@ class Model:
 			print('self.bkg is ', self.bkg, file=gdat.flog)
 			print('self.template amplitudes is ', self.template_amplitudes, file=gdat.flog)
 
+		# stable identifiers of the sources, which follow them through moves and the reordering of the catalog on deaths
+		self.source_ids = np.full(self.max_nsrc, -1, dtype=np.int64)
+		self.source_ids[0:self.n] = np.arange(self.n)
+		self.next_source_id = self.n
+
+		self.build_source_grid()
+
+
+	# attributes that are rebuilt by __init__ or hold libraries, buffers and threads, which are not saved in checkpoints
+	checkpoint_skip = ['dat', 'gdat', 'libmmult', 'eval_pool', 'fused_eval', 'fused_args', 'region_executor', 'region_workspaces', 'fourier_templates', \
+						'n_pool_alloc_prev', 'source_grid', 'residual_projections']
+
+	def get_checkpoint_state(self):
+		''' Dictionary of the model attributes that change while sampling (catalog, backgrounds, template and Fourier amplitudes, 
+		pending changes dback, dtemplate and dfc, move weights, region offsets, etc.), to be saved with save_checkpoint(). '''
+		return dict({key:value for key, value in self.__dict__.items() if key not in self.checkpoint_skip})
+
+	def set_checkpoint_state(self, state):
+		self.__dict__.update(state)
+		if 'source_ids' not in state: # checkpoints written before sources had identifiers
+			self.source_ids = np.full(self.max_nsrc, -1, dtype=np.int64)
+			self.source_ids[0:self.n] = np.arange(self.n)
+			self.next_source_id = self.n
+		self.build_source_grid()
+
+	def build_source_grid(self):
+		''' 
+		Builds the cell list of pivot band source positions used by idx_parity_stars() and merge_split_stars(), which the sampler 
+		updates with accepted moves, births and deaths. It has to be rebuilt whenever the catalog is replaced as a whole.
+		Cells are as large as the distance beyond which the merge/split adjacency vanishes, so that neighbour lists only visit 
+		the 3x3 cells around each source.
+		'''
+		self.source_grid = SourceGrid(self.imsz0, np.ceil(neighbour_cutoff(self.stars.dtype)*self.kickrange), self.max_nsrc)
+		self.source_grid.build(self.stars[self._X, 0:self.n], self.stars[self._Y, 0:self.n])
+
+	def move_sources(self, idx, starsp):
+		''' Sets the parameters of sources idx to starsp. '''
+		self.stars[:, idx] = starsp
+		self.source_grid.move(idx, starsp[self._X,:], starsp[self._Y,:])
+
+	def append_sources(self, starsb):
+		''' Appends the sources starsb of shape (2+nbands, k) to the catalog, with new source identifiers. '''
+		idx = np.arange(self.n, self.n+starsb.shape[1])
+		self.stars[:, idx] = starsb
+		self.source_ids[idx] = self.next_source_id + np.arange(idx.size)
+		self.next_source_id += idx.size
+		self.source_grid.insert(idx, starsb[self._X,:], starsb[self._Y,:])
+		self.n += idx.size
+
+	def remove_sources(self, idx_kill):
+		''' 
+		Removes sources idx_kill from the catalog in O(len(idx_kill)) time. The catalog stays a dense prefix stars[:, 0:n], the last 
+		sources being moved into the entries left by removed sources before them, so indices of remaining sources can change but 
+		their identifiers in source_ids do not.
+		'''
+		idx_kill = np.unique(idx_kill)
+		n = self.n - idx_kill.size
+		holes = idx_kill[idx_kill < n]
+		tail = np.arange(n, self.n)
+		fillers = tail[np.logical_not(np.isin(tail, idx_kill))]
+		self.source_grid.remove(idx_kill)
+		self.source_grid.relabel(fillers, holes)
+		self.stars[:, holes] = self.stars[:, fillers]
+		self.source_ids[holes] = self.source_ids[fillers]
+		self.stars[:, n:self.n] = 0
+		self.source_ids[n:self.n] = -1
+		self.n = n
 
 	def update_moveweights(self, j):
 
@@ -577,16 +837,89 @@ class Model:
 				print('-'*16, file=self.gdat.flog)
 		print('-'*16, file=self.gdat.flog)
 		print('Total (s): %0.3f' % (np.sum(statarrays[2:])/1000), file=self.gdat.flog)
+
+		# ru_maxrss is in kilobytes on Linux and bytes on macOS
+		peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+		if sys.platform == 'darwin':
+			peak_rss /= 1024.
+		n_pool_alloc = self.eval_pool.n_alloc - self.n_pool_alloc_prev
+		self.n_pool_alloc_prev = self.eval_pool.n_alloc
+		print('Peak RSS (MB): %0.1f' % peak_rss, file=self.gdat.flog)
+		print('Eval buffer pool: %d new allocations, %d total (%0.1f MB) over %d requests' % (n_pool_alloc, self.eval_pool.n_alloc, self.eval_pool.nbytes/1024.**2, self.eval_pool.n_requests), file=self.gdat.flog)
 		print('='*16, file=self.gdat.flog)
 
 		return timestat_array, accept_fracs
 
 
+	def init_fused_eval(self):
+		''' 
+		Sets up the arguments of the fused multiband kernel that do not change while sampling: the stacked PSF coefficients, 
+		the fast astrometry tables of bands after the pivot band (flagged with zero size where a band shares the pivot band astrometry),
+		the image and region sizes, and the addresses of the pixel hash and weight arrays. self.fused_eval is set to None if the 
+		kernel cannot be used, i.e. if the bands have different PSF stamp sizes or the astrometry tables are missing.
+		'''
+		if len(set(self.dat.ncs)) > 1:
+			self.fused_eval = None
+			return
+
+		tables, dims = [], []
+		for b in range(1, self.gdat.nbands):
+			if self.gdat.bands[b] == self.gdat.bands[0]:
+				dims.extend([0, 0])
+			elif b-1 < len(self.dat.fast_astrom.all_fast_arrays):
+				table = np.ascontiguousarray(self.dat.fast_astrom.all_fast_arrays[b-1], dtype=np.float64)
+				tables.append(table.ravel())
+				dims.extend([table.shape[2], table.shape[1]])
+			else:
+				self.fused_eval = None
+				return
+
+		if len(tables) == 0:
+			tables.append(np.zeros(1, dtype=np.float64))
+
+		self.fused_args = dict({'cfs':np.ascontiguousarray(np.array(self.dat.cfs), dtype=np.float32), 'astrom':np.concatenate(tables), \
+							'astrom_dims':np.array(dims+[0, 0], dtype=np.int32), 'imszs':np.array(self.gdat.imszs, dtype=np.int32).ravel(), \
+							'regsizes':np.array(self.gdat.regsizes, dtype=np.int32), 'hashes':fused_pointers(self.gdat.pixel_hashes), \
+							'weights':fused_pointers(self.dat.weights)})
+
+	def pcat_multiband_eval_fused(self, x, y, f, bkg, nc, ref, beam_fac=1., margin_fac=1):
+		''' 
+		Evaluates the models and the summed region chi2 of all bands in a single call to the fused multiband kernel, which also
+		applies the astrometric transformation to each band. Returns the model images, the summed chi2 and the source positions 
+		in each band, as pcat_multiband_eval() does with return_xy=True. Templates are not supported.
+		'''
+		nstar = len(x)
+		args = self.fused_args
+		srcbufs, imbufs = self.eval_pool.get_multiband(self.nbands, nstar, nc[0], self.imszs, self.nregy, self.nregx)
+
+		flux = srcbufs['flux'][:self.nbands*nstar].reshape(self.nbands, nstar)
+		np.multiply((np.array(beam_fac)*np.array(nc))[:,None], f, out=flux, casting='unsafe')
+		xp = srcbufs['xp'][:self.nbands*nstar].reshape(self.nbands, nstar)
+		yp = srcbufs['yp'][:self.nbands*nstar].reshape(self.nbands, nstar)
+		images = [imbuf['image'] for imbuf in imbufs]
+
+		self.fused_eval(self.nbands, nstar, nc[0], args['cfs'].shape[1], np.ascontiguousarray(x, dtype=np.float32), np.ascontiguousarray(y, dtype=np.float32), \
+						flux, np.array(bkg, dtype=np.float32), args['astrom'], args['astrom_dims'], srcbufs['dd'], args['cfs'], srcbufs['recon'], \
+						srcbufs['ix'], srcbufs['iy'], xp, yp, args['hashes'], fused_pointers(images), fused_pointers(ref), args['weights'], \
+						srcbufs['diff2'], imbufs[0]['diff2'], args['imszs'], args['regsizes'], (self.margins*margin_fac).astype(np.int32), \
+						self.offsetxs.astype(np.int32), self.offsetys.astype(np.int32))
+
+		return images, imbufs[0]['diff2'].copy(), [(xp[b], yp[b]) for b in range(self.nbands)]
+
 	def pcat_multiband_eval(self, x, y, f, bkg, nc, cf, weights, ref, lib, beam_fac=1., margin_fac=1, dtemplate=None, rtype=None, dfc=None, idxvec=None, precomp_temps=None, fc_rel_amps=None, \
-		perturb_band_idx=None):
-		''' Wrapper for multiband likelihood evaluation given model parameters.'''
+		perturb_band_idx=None, return_xy=False):
+		''' Wrapper for multiband likelihood evaluation given model parameters. If return_xy is True, the source positions in each band are returned as well.
+		The returned model images are views into self.eval_pool and are overwritten by the next call, so copy them if they need to persist.
+		Without templates, all bands are evaluated with one call to the fused kernel if the library provides it.'''
+
+		if self.fused_eval is not None and dtemplate is None and precomp_temps is None and dfc is None and perturb_band_idx is None:
+			dmodels, diff2s, xys = self.pcat_multiband_eval_fused(x, y, f, bkg, nc, ref, beam_fac=beam_fac, margin_fac=margin_fac)
+			if return_xy:
+				return dmodels, diff2s, 0, xys
+			return dmodels, diff2s, 0
 
 		dmodels = []
+		xys = []
 		dt_transf = 0
 		nb = 0
 
@@ -622,7 +955,7 @@ class Model:
 			elif dfc is not None:
 
 				if idxvec is not None:
-					pc_temp = self.fourier_templates[b][idxvec[0], idxvec[1], idxvec[2]]*dfc[idxvec[0], idxvec[1], idxvec[2]]
+					pc_temp = self.fourier_templates[b].template(idxvec[0], idxvec[1], idxvec[2])*dfc[idxvec[0], idxvec[1], idxvec[2]]
 
 					if dtemp is None:
 						dtemp = fc_rel_amps[b]*pc_temp
@@ -630,7 +963,7 @@ class Model:
 						dtemp += fc_rel_amps[b]*pc_temp
 
 				else:
-					pc_temp = np.sum([dfc[i,j,k]*self.fourier_templates[b][i,j,k] for i in range(self.n_fourier_terms) for j in range(self.n_fourier_terms) for k in range(4)], axis=0)
+					pc_temp = self.fourier_templates[b].evaluate(dfc[:self.n_fourier_terms, :self.n_fourier_terms])
 
 					if dtemp is None:
 						dtemp = fc_rel_amps[b]*pc_temp
@@ -648,9 +981,10 @@ class Model:
 
 
 				dmodel, diff2 = image_model_eval(xp, yp, beam_fac[b]*nc[b]*f[b], bkg[b], self.imszs[b], \
-												nc[b], np.array(cf[b]).astype(np.float32()), weights=self.dat.weights[b], \
+												nc[b], cf[b], weights=self.dat.weights[b], \
 												ref=ref[b], lib=lib, regsize=self.regsizes[b], \
-												margin=self.margins[b]*margin_fac, offsetx=self.offsetxs[b], offsety=self.offsetys[b], template=dtemp)
+												margin=self.margins[b]*margin_fac, offsetx=self.offsetxs[b], offsety=self.offsetys[b], template=dtemp, \
+												pixel_hash=self.gdat.pixel_hashes[b], pool=self.eval_pool, band=b)
 
 				# diff2s += diff2
 			else:    
@@ -658,23 +992,246 @@ class Model:
 				yp=y
 
 				dmodel, diff2 = image_model_eval(xp, yp, beam_fac[b]*nc[b]*f[b], bkg[b], self.imszs[b], \
-												nc[b], np.array(cf[b]).astype(np.float32()), weights=self.dat.weights[b], \
+												nc[b], cf[b], weights=self.dat.weights[b], \
 												ref=ref[b], lib=lib, regsize=self.regsizes[b], \
-												margin=self.margins[b]*margin_fac, offsetx=self.offsetxs[b], offsety=self.offsetys[b], template=dtemp)
+												margin=self.margins[b]*margin_fac, offsetx=self.offsetxs[b], offsety=self.offsetys[b], template=dtemp, \
+												pixel_hash=self.gdat.pixel_hashes[b], pool=self.eval_pool, band=b)
 			
 				# diff2s = diff2
 
 			if nb==0:
-				diff2s = diff2
+				diff2s = diff2.copy()
 				nb += 1
 			else:
 				diff2s += diff2
 
 			dmodels.append(dmodel)
+			xys.append((xp, yp))
+
+		if return_xy:
+			return dmodels, diff2s, dt_transf, xys
 
 		return dmodels, diff2s, dt_transf 
 
 
+	def init_chi2_ledger(self, models, resids):
+		''' 
+		Initializes the running chi2 ledger used by run_sampler(). 
+
+		Parameters
+		----------
+
+		models : list of `~numpy.ndarray's
+			Model images for each band.
+
+		resids : list of `~numpy.ndarray's
+			Residual images (data - model) for each band.
+
+		Returns
+		-------
+
+		chi2_regions : list of `~numpy.ndarray's of shape (nregy, nregx)
+			Chi2 of each subregion (including margins) for each band.
+
+		chi2_ledger : `~numpy.ndarray' of shape (nbands,)
+			Exact full-image chi2 for each band.
+
+		'''
+		chi2_regions = []
+		chi2_ledger = np.zeros(self.nbands)
+
+		for b in range(self.nbands):
+			diff2 = np.zeros((self.nregy, self.nregx), dtype=np.float64)
+			if self.gdat.cblas:
+				self.libmmult.pcat_like_eval(self.imszs[b][0], self.imszs[b][1], models[b], self.dat.data_array[b], self.dat.weights[b], diff2, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
+			else:
+				self.libmmult.clib_eval_llik(self.imszs[b][0], self.imszs[b][1], models[b], self.dat.data_array[b], self.dat.weights[b], diff2, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b], 1)
+			chi2_regions.append(diff2)
+			chi2_ledger[b] = np.sum(self.dat.weights[b]*resids[b]*resids[b])
+
+		return chi2_regions, chi2_ledger
+
+	def region_worker(self, rtype, task, workspace, resids, models, logL, lib):
+		''' 
+		Makes a point source proposal of type rtype (0, 1 or 2) within the regions of task and accepts it region by region, updating 
+		the residual and model images in place. Each band is evaluated on the rows of the image covered by the region rows of the task 
+		and the region row on either side, so the work done by a thread scales with its share of the image. The footprints of accepted 
+		regions do not overlap, so threads write to disjoint pixels, and the changes in chi2 of the regions they touch are returned 
+		to the caller rather than applied.
+
+		Returns
+		-------
+
+		result : dict or None
+			None if no valid proposal was made. Otherwise the proposal, its acceptance (acceptprop), the first region row evaluated (rb),
+			the change in chi2 of region rows rb onwards for each band (chi2_deltas), the change in full-image chi2 of each band (dchi2s) and 
+			the projections of the accepted delta model of each band on the linear components (dprojs, see ResidualProjections.box_projections()).
+
+		'''
+		proposal = [self.move_stars, self.birth_death_stars, self.merge_split_stars][rtype](task=task)
+		if not proposal.goodmove:
+			return None
+
+		rb, re = max(task.rows[0]-1, 0), min(task.rows[1]+1, self.nregy)
+		nr = re - rb
+		diff2s = np.zeros((nr, self.nregx))
+		evals = []
+
+		for b in range(self.nbands):
+			nx, ny = self.imszs[b]
+			y0 = max(rb*self.regsizes[b] - self.offsetys[b] - self.margins[b], 0)
+			y1 = min(re*self.regsizes[b] - self.offsetys[b] + self.margins[b], ny)
+			# region j of the row band is region rb+j of the image
+			offsety = self.offsetys[b] + y0 - rb*self.regsizes[b]
+
+			if b > 0 and self.gdat.bands[b] != self.gdat.bands[0]:
+				xp, yp = self.dat.fast_astrom.transform_q(proposal.xphon, proposal.yphon, b-1)
+			else:
+				xp, yp = proposal.xphon, proposal.yphon
+			yp = yp - np.float32(y0)
+
+			# image buffers are keyed by parity as the row band of a thread depends on it
+			dmodel, diff2 = image_model_eval(xp, yp, self.pixel_per_beam[b]*self.dat.ncs[b]*proposal.fphon[b], proposal.dback[b], (nx, y1-y0), self.dat.ncs[b], \
+											self.dat.cfs[b], weights=row_band(self.dat.weights[b], nx, y0, y1), ref=row_band(resids[b], nx, y0, y1), lib=lib, \
+											regsize=self.regsizes[b], margin=self.margins[b], offsetx=self.offsetxs[b], offsety=offsety, \
+											pixel_hash=workspace['pixel_hashes'][b], pool=workspace['pool'], band=(b, self.parity_y))
+			diff2s += diff2[:nr]
+			evals.append((y0, y1, offsety, xp, yp, dmodel, diff2.shape))
+
+		plogL = -0.5*diff2s
+		rows = np.arange(rb, re)
+		plogL[np.logical_or(rows % 2 != self.parity_y, np.logical_or(rows < task.rows[0], rows >= task.rows[1])),:] = float('-inf')
+		plogL[:,(1-self.parity_x)::2] = float('-inf')
+		dlogP = (plogL - logL[rb:re])/self.temperature
+		assert np.isnan(dlogP).any() == False
+
+		refx, refy = proposal.get_ref_xy()
+		regionx = get_region(refx, self.offsetxs[0], self.regsizes[0])
+		regiony = get_region(refy, self.offsetys[0], self.regsizes[0]) - rb
+		dlogP[regiony, regionx] += proposal.factor
+
+		acceptreg = (np.log(task.rng.uniform(size=dlogP.shape)) < dlogP).astype(np.int32)
+		acceptprop = acceptreg[regiony, regionx]
+
+		chi2_deltas = []
+		dchi2s = np.zeros(self.nbands)
+		# the dot products are only read here, and updated by the caller once all threads are done
+		track_projections = self.residual_projections is not None and self.residual_projections.proj is not None
+		dprojs = [None for b in range(self.nbands)]
+		for b, (y0, y1, offsety, xp, yp, dmodel, nreg) in enumerate(evals):
+			nx = self.imszs[b][0]
+			acceptreg_b = np.zeros(nreg, dtype=np.int32)
+			acceptreg_b[:nr] = acceptreg
+			chi2_delta = np.zeros(nreg, dtype=np.float64)
+			boxes = np.zeros((nreg[0]*nreg[1], 4), dtype=np.int32)
+			ix = np.ceil(xp).astype(np.int32)
+			iy = np.ceil(yp).astype(np.int32)
+			args = (nx, y1-y0, ix.size, self.dat.ncs[b], ix, iy, dmodel, row_band(resids[b], nx, y0, y1), row_band(models[b], nx, y0, y1), \
+					row_band(self.dat.weights[b], nx, y0, y1), acceptreg_b, chi2_delta, boxes, self.regsizes[b], self.margins[b], self.offsetxs[b], offsety)
+			if self.gdat.cblas:
+				dchi2s[b] = self.libmmult.pcat_imag_acpt_sparse(*args)
+			else:
+				dchi2s[b] = self.libmmult.clib_updt_modl_sprs(*(args+(1,)))
+			chi2_deltas.append(chi2_delta[:nr])
+			if track_projections:
+				dprojs[b] = self.residual_projections.box_projections(b, dmodel, boxes, y0=y0)
+
+		return dict({'proposal':proposal, 'acceptprop':acceptprop, 'rb':rb, 'chi2_deltas':chi2_deltas, 'dchi2s':dchi2s, 'dprojs':dprojs})
+
+	def region_parallel_step(self, rtype, resids, models, logL, chi2_regions, chi2_ledger, lib):
+		''' 
+		Region-parallel point source proposal. The pairs of active region rows are split into contiguous blocks, one per thread of 
+		self.region_executor, and each thread runs region_worker() on its block with its own random state and evaluation buffers. 
+		Once all threads are done, the per-region chi2, the chi2 ledger and the catalog are updated with the accepted moves of every thread.
+
+		Parameters
+		----------
+
+		rtype : int
+			Proposal type, 0 (move), 1 (birth/death) or 2 (merge/split).
+
+		resids, models : lists of `~numpy.ndarray's
+			Residual and model images of each band, updated in place.
+
+		logL : `~numpy.ndarray' of shape (nregy, nregx)
+			Log-likelihood of each region before the proposal.
+
+		chi2_regions : list of `~numpy.ndarray's of shape (nregy, nregx)
+			Chi2 of each region for each band, updated in place.
+
+		chi2_ledger : `~numpy.ndarray' of shape (nbands,)
+			Full-image chi2 of each band, updated in place.
+
+		lib : function
+			Model evaluation kernel.
+
+		Returns
+		-------
+
+		accept : float
+			Fraction of accepted proposals.
+
+		outbound : int
+			1 if no thread made a valid proposal, 0 otherwise.
+
+		logL : `~numpy.ndarray' of shape (nregy, nregx)
+			Log-likelihood of each region after the proposal.
+
+		dt_eval, dt_merge : floats
+			Time spent by the threads and time spent updating the catalog.
+
+		'''
+		t0 = time.time()
+		mregy = int(((self.imsz0[1] / self.regsizes[0] + 1) + 1) / 2)
+		blocks = [block for block in np.array_split(np.arange(mregy), len(self.region_workspaces)) if block.size > 0]
+		# births and splits of each thread are limited to a share of the free catalog entries
+		rooms = [room.size for room in np.array_split(np.arange(self.max_nsrc - self.n), len(blocks))]
+		seeds = np.random.randint(np.iinfo(np.int32).max, size=len(blocks))
+
+		futures = []
+		for t, block in enumerate(blocks):
+			task = RegionTask((block[0], block[-1]+1), self.parity_y, block.size/float(mregy), rooms[t], np.random.RandomState(seeds[t]))
+			futures.append(self.region_executor.submit(self.region_worker, rtype, task, self.region_workspaces[t], resids, models, logL, lib))
+		results = [future.result() for future in futures]
+		results = [result for result in results if result is not None]
+
+		t1 = time.time()
+		if len(results) == 0:
+			verbprint(self.verbtype, 'Out of bounds..', verbthresh=1)
+			return 0., 1, logL, t1-t0, 0.
+
+		nprop, naccept = 0, 0
+		idx_kill = []
+		for result in results:
+			for b in range(self.nbands):
+				rb = result['rb']
+				chi2_regions[b][rb:rb+result['chi2_deltas'][b].shape[0]] += result['chi2_deltas'][b]
+				if result['dprojs'][b] is not None:
+					self.residual_projections.update(b, result['dprojs'][b])
+			chi2_ledger += result['dchi2s']
+
+			proposal, acceptprop = result['proposal'], result['acceptprop']
+			nprop += acceptprop.size
+			naccept += np.count_nonzero(acceptprop)
+
+			if proposal.idx_move is not None:
+				self.move_sources(proposal.idx_move.compress(acceptprop), proposal.starsp.compress(acceptprop, axis=1))
+
+			if proposal.do_birth:
+				self.append_sources(proposal.starsb.compress(acceptprop, axis=1).reshape((2+self.nbands,-1)))
+
+			if proposal.idx_kill is not None:
+				idx_kill.append(proposal.idx_kill.compress(acceptprop, axis=0).flatten())
+
+		# kills are applied last, as in run_sampler(), so that the indices of all threads refer to the same catalog
+		if len(idx_kill) > 0:
+			self.remove_sources(np.concatenate(idx_kill))
+
+		logL = -0.5*np.sum(chi2_regions, axis=0)
+		accept = naccept/float(nprop) if nprop > 0 else 0.
+
+		return accept, 0, logL, t1-t0, time.time()-t1
+
 	def run_sampler(self, sample_idx):
 		''' run_sampler() completes nloop samples, so the function is called nsamp times'''
 		
@@ -732,10 +1289,7 @@ class Model:
 		verbprint(self.gdat.verbtype, 'self.n here is '+str(self.n), verbthresh=1)
 		verbprint(self.gdat.verbtype, 'n_phon = '+str(n_phon), verbthresh=1)
 
-		if self.gdat.cblas:
-			lib = self.libmmult.pcat_model_eval
-		else:
-			lib = self.libmmult.clib_eval_modl
+		lib = get_model_kernel(self.libmmult, self.gdat.cblas)
 
 		dtemplate = None
 		fcoeff = None
@@ -748,7 +1302,7 @@ class Model:
 			
 			for b in range(self.nbands):
 
-				running_temp.append(np.sum([self.fourier_coeffs[i,j,k]*self.fourier_templates[b][i,j,k] for i in range(self.n_fourier_terms) for j in range(self.n_fourier_terms) for k in range(4)], axis=0))
+				running_temp.append(self.fourier_templates[b].evaluate(self.fourier_coeffs[:self.n_fourier_terms, :self.n_fourier_terms]))
 			
 			running_temp = np.array(running_temp)
 
@@ -756,10 +1310,35 @@ class Model:
 														 dtemplate=dtemplate, precomp_temps=running_temp, fc_rel_amps=self.fc_rel_amps)
 
 		logL = -0.5*diff2s
+
+		# models are updated in place with accepted moves, so they cannot share memory with the evaluation buffers
+		models = [model.copy() for model in models]
 	   
 		for b in range(self.nbands):
 			resids[b] -= models[b]
 
+		chi2_regions, chi2_ledger = self.init_chi2_ledger(models, resids)
+
+		# the ledger is updated from per-region chi2 deltas, which is only valid if the margin-extended footprints 
+		# of same-parity regions do not overlap
+		disjoint_margins = all([2*self.margins[b] <= self.regsizes[b] for b in range(self.nbands)])
+
+		# bounding boxes (x0, x1, y0, y1) of the pixels updated in each region by sparse acceptance
+		acpt_boxes = np.zeros((self.nregy*self.nregx, 4), dtype=np.int32)
+
+		# background, template and Fourier component proposals are decided from dot products of the residuals with the model 
+		# components, see ResidualProjections. The projections are only kept if one of these components is floated
+		closed_form_linear = self.gdat.closed_form_proposals and (self.gdat.float_background or self.gdat.float_templates or self.gdat.float_fourier_comps)
+		if closed_form_linear:
+			if self.residual_projections is None:
+				templates, fourier_templates, n_terms = None, None, None
+				if self.gdat.float_templates:
+					templates = self.dat.template_array
+				if self.gdat.float_fourier_comps:
+					fourier_templates, n_terms = self.fourier_templates, self.n_fourier_terms
+				self.residual_projections = ResidualProjections(self.dat.weights, templates=templates, fourier_templates=fourier_templates, n_terms=n_terms)
+			self.residual_projections.invalidate()
+
 		'''the proposals here are: move_stars (P) which changes the parameters of existing model sources, 
 		birth/death (BD) and merge/split (MS). Don't worry about perturb_astrometry. 
 		The moveweights array, once normalized, determines the probability of choosing a given proposal. '''
@@ -791,18 +1370,20 @@ class Model:
 				self.parity_x = 0
 				self.parity_y = 0
 
-			#proposal types
-			proposal = movefns[rtype]()
+			if rtype < 3 and self.region_executor is not None and disjoint_margins:
+				# same-parity regions are split across threads, see region_parallel_step()
+				proposal = None
+				accept[i], outbounds[i], logL, dts[1,i], dts[2,i] = self.region_parallel_step(rtype, resids, models, logL, chi2_regions, chi2_ledger, lib)
+			else:
+				#proposal types
+				proposal = movefns[rtype]()
 
-			dts[0,i] = time.time() - t1
+				dts[0,i] = time.time() - t1
 			
-			if proposal.goodmove:
+			if proposal is not None and proposal.goodmove:
 				t2 = time.time()
 
-				if self.gdat.cblas:
-					lib = self.libmmult.pcat_model_eval
-				else:
-					lib = self.libmmult.clib_eval_modl
+				lib = get_model_kernel(self.libmmult, self.gdat.cblas)
 
 				dtemplate = None
 				fcoeff = None
@@ -821,10 +1402,23 @@ class Model:
 				if rtype > 2:
 					margin_fac = 0
 
-				if rtype == 3: # background
-					# recompute model likelihood with margins set to zero, use current values of star parameters and use background level equal to self.bkg (+self.dback up to this point)
-					
+				closed_form = closed_form_linear and rtype > 2
+
+				if rtype == 3:
 					bkg_perturb_band_idxs.append(proposal.perturb_band_idx)
+				elif rtype == 4:
+					temp_perturb_band_idxs.append(proposal.perturb_band_idx)
+
+				if closed_form: # background, template or fourier comp
+					component_changes = self.linear_component_changes(proposal, rtype, fc_rel_amps)
+					dchi2 = [self.residual_projections.dchi2(resids, b, idx, amps) for b, (idx, amps) in enumerate(component_changes) if idx is not None]
+
+					# only the sum over regions enters the acceptance of full-image proposals
+					dlogP = np.zeros_like(logL)
+					dlogP[0,0] = -0.5*np.sum(dchi2)/self.temperature
+
+				elif rtype == 3: # background
+					# recompute model likelihood with margins set to zero, use current values of star parameters and use background level equal to self.bkg (+self.dback up to this point)
 
 					mods, diff2s_nomargin, dt_transf = self.pcat_multiband_eval(self.stars[self._X,0:self.n], self.stars[self._Y,0:self.n], self.stars[self._F:,0:self.n], \
 																bkg, self.dat.ncs, self.dat.cfs, weights=self.dat.weights, ref=self.dat.data_array, lib=lib, \
@@ -840,7 +1434,6 @@ class Model:
 
 				elif rtype == 4: # template
 
-					temp_perturb_band_idxs.append(proposal.perturb_band_idx)
 					mods, diff2s_nomargin, dt_transf = self.pcat_multiband_eval(self.stars[self._X,0:self.n], self.stars[self._Y,0:self.n], self.stars[self._F:,0:self.n], \
 															bkg, self.dat.ncs, self.dat.cfs, weights=self.dat.weights, ref=self.dat.data_array, lib=lib, \
 															beam_fac=self.pixel_per_beam, margin_fac=margin_fac, dtemplate=dtemplate, rtype=rtype, precomp_temps=running_temp, fc_rel_amps=fc_rel_amps, \
@@ -874,18 +1467,20 @@ class Model:
 
 				else: # movestar, birth/death, merge/split
 
-					dmodels, diff2s, dt_transf = self.pcat_multiband_eval(proposal.xphon, proposal.yphon, proposal.fphon, proposal.dback, self.dat.ncs, self.dat.cfs, weights=self.dat.weights, \
-													ref=resids, lib=lib, beam_fac=self.pixel_per_beam, margin_fac=margin_fac, rtype=rtype)
+					dmodels, diff2s, dt_transf, phon_xys = self.pcat_multiband_eval(proposal.xphon, proposal.yphon, proposal.fphon, proposal.dback, self.dat.ncs, self.dat.cfs, weights=self.dat.weights, \
+													ref=resids, lib=lib, beam_fac=self.pixel_per_beam, margin_fac=margin_fac, rtype=rtype, return_xy=True)
 	
 				
 
-				plogL = -0.5*diff2s  
+				if not closed_form:
+					plogL = -0.5*diff2s  
 
-				if rtype < 3:
-					plogL[(1-self.parity_y)::2,:] = float('-inf') # don't accept off-parity regions
-					plogL[:,(1-self.parity_x)::2] = float('-inf')
-				
-				dlogP = plogL - logL
+					if rtype < 3:
+						plogL[(1-self.parity_y)::2,:] = float('-inf') # don't accept off-parity regions
+						plogL[:,(1-self.parity_x)::2] = float('-inf')
+					
+					# tempered likelihood for replica exchange runs, the prior factors below are not tempered
+					dlogP = (plogL - logL)/self.temperature
 				
 				assert np.isnan(dlogP).any() == False
 				
@@ -935,6 +1530,10 @@ class Model:
 					else:
 						acceptreg = np.zeros(shape=(self.nregy, self.nregx)).astype(np.int32)
 
+					if closed_form and accept_or_not:
+						# the change of the model is only rendered once the proposal is accepted
+						dmodels = [None if idx is None else self.residual_projections.render(b, idx, amps) for b, (idx, amps) in enumerate(component_changes)]
+
 				
 				nb = 0 # index used for perturb_band_idx stuff
 
@@ -945,25 +1544,55 @@ class Model:
 						if b != proposal.perturb_band_idx:
 							continue
 
-					dmodel_acpt = np.zeros_like(dmodels[b])
-					diff2_acpt = np.zeros_like(diff2s)
+					if closed_form and (not accept_or_not or dmodels[b] is None):
+						# rejected or not changed, so the residuals and region chi2 are unchanged
+						diff2_acpt = chi2_regions[b]
+
+					elif rtype < 3 and disjoint_margins:
+						# for point source proposals the delta model is only non-zero within the PSF stamps, so the residual, model and 
+						# per-region chi2 are updated over the bounding boxes of stamps within accepted regions, rather than the full image
+						ix = np.ceil(phon_xys[b][0]).astype(np.int32)
+						iy = np.ceil(phon_xys[b][1]).astype(np.int32)
 
-					if self.gdat.cblas:
+						if self.gdat.cblas:
+							chi2_ledger[b] += self.libmmult.pcat_imag_acpt_sparse(self.imszs[b][0], self.imszs[b][1], ix.size, self.dat.ncs[b], ix, iy, dmodels[b], resids[b], models[b], self.dat.weights[b], \
+																		acceptreg, chi2_regions[b], acpt_boxes, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
+						else:
+							chi2_ledger[b] += self.libmmult.clib_updt_modl_sprs(self.imszs[b][0], self.imszs[b][1], ix.size, self.dat.ncs[b], ix, iy, dmodels[b], resids[b], models[b], self.dat.weights[b], \
+																		acceptreg, chi2_regions[b], acpt_boxes, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b], 1)
+						diff2_acpt = chi2_regions[b]
+						if closed_form_linear:
+							self.residual_projections.update(b, self.residual_projections.box_projections(b, dmodels[b], acpt_boxes))
 
-						self.libmmult.pcat_imag_acpt(self.imszs[b][0], self.imszs[b][1], dmodels[b], dmodel_acpt, acceptreg, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
-						# using this dmodel containing only accepted moves, update logL
-						self.libmmult.pcat_like_eval(self.imszs[b][0], self.imszs[b][1], dmodel_acpt, resids[b], self.dat.weights[b], diff2_acpt, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])   
 					else:
-						
-						self.libmmult.clib_updt_modl(self.imszs[b][0], self.imszs[b][1], dmodels[b], dmodel_acpt, acceptreg, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
-						# using this dmodel containing only accepted moves, update logL
-						self.libmmult.clib_eval_llik(self.imszs[b][0], self.imszs[b][1], dmodel_acpt, resids[b], self.dat.weights[b], diff2_acpt, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])   
+						dmodel_acpt = np.zeros_like(dmodels[b])
+						diff2_acpt = np.zeros_like(chi2_regions[b])
+
+						if self.gdat.cblas:
 
-					resids[b] -= dmodel_acpt
-					models[b] += dmodel_acpt
+							self.libmmult.pcat_imag_acpt(self.imszs[b][0], self.imszs[b][1], dmodels[b], dmodel_acpt, acceptreg, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])
+							# using this dmodel containing only accepted moves, update logL
+							self.libmmult.pcat_like_eval(self.imszs[b][0], self.imszs[b][1], dmodel_acpt, resids[b], self.dat.weights[b], diff2_acpt, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b])   
+						else:
+							
+							self.libmmult.clib_updt_modl(self.imszs[b][0], self.imszs[b][1], dmodels[b], dmodel_acpt, acceptreg, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b], 1)
+							# using this dmodel containing only accepted moves, update logL
+							self.libmmult.clib_eval_llik(self.imszs[b][0], self.imszs[b][1], dmodel_acpt, resids[b], self.dat.weights[b], diff2_acpt, self.regsizes[b], self.margins[b], self.offsetxs[b], self.offsetys[b], 1)   
+
+						resids[b] -= dmodel_acpt
+						models[b] += dmodel_acpt
+						if closed_form_linear and not closed_form and np.sum(acceptreg) > 0:
+							# point source proposals without disjoint margins, the accepted delta model can cover the whole image
+							full_image = np.array([[0, self.imszs[b][0], 0, self.imszs[b][1]]])
+							self.residual_projections.update(b, self.residual_projections.box_projections(b, dmodel_acpt, full_image))
+						# background/template/fourier component moves change every pixel, so resynchronize with the exact value
+						if np.sum(acceptreg) > 0:
+							chi2_ledger[b] = np.sum(self.dat.weights[b]*resids[b]*resids[b])
+
+						chi2_regions[b] = diff2_acpt
 
 					if nb==0:
-						diff2_total1 = diff2_acpt
+						diff2_total1 = diff2_acpt.copy()
 						nb += 1
 					else:
 						diff2_total1 += diff2_acpt
@@ -979,24 +1608,17 @@ class Model:
 				if proposal.idx_move is not None:
 					starsp = proposal.starsp.compress(acceptprop, axis=1)
 					idx_move_a = proposal.idx_move.compress(acceptprop)
-					self.stars[:, idx_move_a] = starsp
+					self.move_sources(idx_move_a, starsp)
 
 				
 				if proposal.do_birth:
 					starsb = proposal.starsb.compress(acceptprop, axis=1)
 					starsb = starsb.reshape((2+self.nbands,-1))
-					num_born = starsb.shape[1]
-					self.stars[:, self.n:self.n+num_born] = starsb
-					self.n += num_born
+					self.append_sources(starsb)
 
 				if proposal.idx_kill is not None:
 					idx_kill_a = proposal.idx_kill.compress(acceptprop, axis=0).flatten()
-					num_kill = idx_kill_a.size
-				   
-					# nstar is correct, not n, because x,y,f are full nstar arrays
-					self.stars[:, 0:self.max_nsrc-num_kill] = np.delete(self.stars, idx_kill_a, axis=1)
-					self.stars[:, self.max_nsrc-num_kill:] = 0
-					self.n -= num_kill
+					self.remove_sources(idx_kill_a)
 
 				if proposal.change_bkg_bool:
 					if np.sum(acceptreg) > 0:
@@ -1014,7 +1636,12 @@ class Model:
 							self.dfc += proposal.dfc
 
 							for b in range(self.nbands):
-								running_temp[b] += self.fourier_templates[b][proposal.idx0, proposal.idx1, proposal.idxk]*proposal.dfc[proposal.idx0, proposal.idx1, proposal.idxk]
+								running_temp[b] += self.fourier_templates[b].template(proposal.idx0, proposal.idx1, proposal.idxk)*proposal.dfc[proposal.idx0, proposal.idx1, proposal.idxk]
+
+				if closed_form and np.sum(acceptreg) > 0:
+					for b, (idx, amps) in enumerate(component_changes):
+						if idx is not None:
+							self.residual_projections.accept(b, idx, amps)
 	
 				dts[2,i] = time.time() - t3
 
@@ -1029,12 +1656,23 @@ class Model:
 					else:
 						accept[i] = 0
 			
-			else:
+			elif proposal is not None:
 				verbprint(self.verbtype, 'Out of bounds..', verbthresh=1)
 				outbounds[i] = 1
 
-			for b in range(self.nbands):
-				diff2_list[i] += np.sum(self.dat.weights[b]*(self.dat.data_array[b]-models[b])*(self.dat.data_array[b]-models[b]))
+			if self.gdat.exact_chi2_period is not None and i % self.gdat.exact_chi2_period == 0:
+				chi2_regions_exact, chi2_exact = self.init_chi2_ledger(models, resids)
+				region_drift = [np.abs(chi2_regions[b]-chi2_regions_exact[b]) for b in range(self.nbands)]
+				verbprint(self.verbtype, 'Chi2 ledger drift = '+str(np.sum(chi2_ledger)-np.sum(chi2_exact))+', max region chi2 drift = '+str(np.max(region_drift)), verbthresh=1)
+				# the running region chi2 only accumulate float rounding, so a larger drift means the kernels disagree on the region layout
+				if any([np.any(drift > 1e-4*np.abs(exact)+1e-2) for drift, exact in zip(region_drift, chi2_regions_exact)]):
+					warnings.warn('Per-region chi2 drifted by up to '+str(np.max(region_drift))+' from the exact value', Warning)
+				chi2_ledger, chi2_regions = chi2_exact, chi2_regions_exact
+				logL = -0.5*np.sum(chi2_regions, axis=0)
+				if closed_form_linear:
+					self.residual_projections.invalidate()
+
+			diff2_list[i] = np.sum(chi2_ledger)
 
 			verbprint(self.verbtype, 'End of loop '+str(i), verbthresh=1)		
 			verbprint(self.verbtype, 'self.n = '+str(self.n), verbthresh=1)					
@@ -1090,8 +1728,19 @@ class Model:
 		return self.n, chi2, timestat_array, accept_fracs, diff2_list, rtype_array, accept, resids, models
 
 
-	def idx_parity_stars(self):
-		return idx_parity(self.stars[self._X,:], self.stars[self._Y,:], self.n, self.offsetxs[0], self.offsetys[0], self.parity_x, self.parity_y, self.regsizes[0])
+	def idx_parity_stars(self, task=None):
+		''' 
+		Indices of sources in active regions, restricted to the region rows of task if given. The active regions of the whole image 
+		hold about a quarter of the catalog, which a vectorized scan finds faster than the source grid, while the rows of a task 
+		are looked up in the grid so that each thread only visits its own share of the catalog.
+		'''
+		if task is None:
+			return idx_parity(self.stars[self._X,:], self.stars[self._Y,:], self.n, self.offsetxs[0], self.offsetys[0], self.parity_x, self.parity_y, self.regsizes[0])
+		regx = (np.arange(self.nregx+1) % 2) == self.parity_x
+		regy = (np.arange(self.nregy+1) % 2) == self.parity_y
+		regy[:task.rows[0]] = False
+		regy[task.rows[1]:] = False
+		return self.source_grid.sources_in_regions(self.offsetxs[0], self.offsetys[0], self.regsizes[0], regx, regy)
 
 	def bounce_off_edges(self, catalogue): # works on both stars and galaxies
 		mask = catalogue[self._X,:] < 0
@@ -1111,6 +1760,45 @@ class Model:
 				np.logical_and(catalogue[self._Y,:] > 0, catalogue[self._Y,:] < self.imsz0[1] - 1))
 
 
+	def linear_component_changes(self, proposal, rtype, fc_rel_amps):
+		'''
+		Changes of the amplitudes of the linear model components (see ResidualProjections) made by a background (rtype 3), template (4) 
+		or Fourier component (5) proposal.
+
+		Returns
+		-------
+
+		component_changes : list of tuples
+			(idx, amps) for each band, the component indices and their changes, or (None, None) for bands the proposal does not change.
+
+		'''
+		component_changes = []
+		for b in range(self.nbands):
+			idx, amps = [], []
+			if proposal.perturb_band_idx is not None and b != proposal.perturb_band_idx:
+				pass
+			elif rtype == 3:
+				idx, amps = [0], [proposal.dback[b]]
+			elif rtype == 4:
+				for i, temp in enumerate(self.dat.template_array[b]):
+					if temp is not None and proposal.dtemplate[i][b] != 0.:
+						idx.append(1+i)
+						amps.append(proposal.dtemplate[i][b])
+			elif proposal.fc_rel_amp_bool:
+				# rescales the current Fourier component model of the band
+				idx = list(range(self.residual_projections.fc_offset, self.residual_projections.fc_offset+4*self.n_fourier_terms**2))
+				amps = proposal.dfc_rel_amps[b]*(self.fourier_coeffs+self.dfc)[:self.n_fourier_terms, :self.n_fourier_terms].ravel()
+			else:
+				idx = [self.residual_projections.fc_index([proposal.idx0, proposal.idx1, proposal.idxk])]
+				amps = [fc_rel_amps[b]*proposal.dfc[proposal.idx0, proposal.idx1, proposal.idxk]]
+
+			if len(idx) == 0 or not np.any(amps):
+				component_changes.append((None, None))
+			else:
+				component_changes.append((np.array(idx), np.array(amps, dtype=np.float64)))
+
+		return component_changes
+
 	def perturb_background(self):
 
 		proposal = Proposal(self.gdat)
@@ -1229,14 +1917,14 @@ class Model:
 		return proposal
 
 
-	def flux_proposal(self, f0, nw, trueminf=None):
+	def flux_proposal(self, f0, nw, trueminf=None, rng=np.random):
 		if trueminf is None:
 			trueminf = self.trueminf
 		lindf = np.float32(self.err_f/(self.regions_factor*np.sqrt(self.gdat.nominal_nsrc*(2+self.nbands))))
 		logdf = np.float32(0.01/np.sqrt(self.gdat.nominal_nsrc))
 		ff = np.log(logdf*logdf*f0 + logdf*np.sqrt(lindf*lindf + logdf*logdf*f0*f0)) / logdf
 		ffmin = np.log(logdf*logdf*trueminf + logdf*np.sqrt(lindf*lindf + logdf*logdf*trueminf*trueminf)) / logdf
-		dff = np.random.normal(size=nw).astype(np.float32)
+		dff = rng.normal(size=nw).astype(np.float32)
 		aboveffmin = ff - ffmin
 		oob_flux = (-dff > aboveffmin)
 		dff[oob_flux] = -2*aboveffmin[oob_flux] - dff[oob_flux]
@@ -1244,8 +1932,9 @@ class Model:
 		pf = np.exp(-logdf*pff) * (-lindf*lindf*logdf*logdf+np.exp(2*logdf*pff)) / (2*logdf*logdf)
 		return pf
 
-	def move_stars(self): 
-		idx_move = self.idx_parity_stars()
+	def move_stars(self, task=None): 
+		rng = np.random if task is None else task.rng
+		idx_move = self.idx_parity_stars(task)
 		nw = idx_move.size
 		stars0 = self.stars.take(idx_move, axis=1)
 		starsp = np.empty_like(stars0)
@@ -1256,9 +1945,9 @@ class Model:
 
 		for b in range(self.nbands):
 			if b==0:
-				pf = self.flux_proposal(f0[b], nw)
+				pf = self.flux_proposal(f0[b], nw, rng=rng)
 			else:
-				pf = self.flux_proposal(f0[b], nw, trueminf=0.0001) #place a minor minf to avoid negative fluxes in non-pivot bands
+				pf = self.flux_proposal(f0[b], nw, trueminf=0.0001, rng=rng) #place a minor minf to avoid negative fluxes in non-pivot bands
 			pfs.append(pf)
  
 		if (np.array(pfs)<0).any():
@@ -1309,8 +1998,8 @@ class Model:
 		verbprint(self.verbtype,'dpos_rms : '+str(dpos_rms), verbthresh=1)
 		
 		dpos_rms[dpos_rms < 1e-3] = 1e-3 #do we need this line? perhaps not
-		dx = np.random.normal(size=nw).astype(np.float32)*dpos_rms
-		dy = np.random.normal(size=nw).astype(np.float32)*dpos_rms
+		dx = rng.normal(size=nw).astype(np.float32)*dpos_rms
+		dy = rng.normal(size=nw).astype(np.float32)*dpos_rms
 		starsp[self._X,:] = stars0[self._X,:] + dx
 		starsp[self._Y,:] = stars0[self._Y,:] + dy
 		
@@ -1336,29 +2025,35 @@ class Model:
 		return proposal
 
 
-	def birth_death_stars(self):
-		lifeordeath = np.random.randint(2)
+	def birth_death_stars(self, task=None):
+		rng = np.random if task is None else task.rng
+		lifeordeath = rng.randint(2)
 		nbd = (self.nregx * self.nregy) / 4
+		room = self.max_nsrc - self.n
+		if task is not None: # number of proposals in proportion to the share of active regions
+			nbd = max(int(round(nbd*task.frac)), 1)
+			room = task.room
 		proposal = Proposal(self.gdat)
 		# birth
-		if lifeordeath and self.n < self.max_nsrc: # need room for at least one source
-			nbd = int(min(nbd, self.max_nsrc-self.n)) # add nbd sources, or just as many as will fit
+		if lifeordeath and room > 0: # need room for at least one source
+			nbd = int(min(nbd, room)) # add nbd sources, or just as many as will fit
 			# mildly violates detailed balance when n close to nstar
 			# want number of regions in each direction, divided by two, rounded up
 			
 			mregx = int(((self.imsz0[0] / self.regsizes[0] + 1) + 1) / 2) # assumes that imsz are multiples of regsize
 			mregy = int(((self.imsz0[1] / self.regsizes[0] + 1) + 1) / 2)
+			kregy = (0, mregy) if task is None else task.kregy
 
 			starsb = np.empty((2+self.nbands, nbd), dtype=np.float32)
-			starsb[self._X,:] = (np.random.randint(mregx, size=nbd)*2 + self.parity_x + np.random.uniform(size=nbd))*self.regsizes[0] - self.offsetxs[0]
-			starsb[self._Y,:] = (np.random.randint(mregy, size=nbd)*2 + self.parity_y + np.random.uniform(size=nbd))*self.regsizes[0] - self.offsetys[0]
+			starsb[self._X,:] = (rng.randint(mregx, size=nbd)*2 + self.parity_x + rng.uniform(size=nbd))*self.regsizes[0] - self.offsetxs[0]
+			starsb[self._Y,:] = (rng.randint(kregy[0], kregy[1], size=nbd)*2 + self.parity_y + rng.uniform(size=nbd))*self.regsizes[0] - self.offsetys[0]
 			
 			for b in range(self.nbands):
 				if b==0:
-					starsb[self._F+b,:] = self.trueminf * np.exp(np.random.exponential(scale=1./(self.truealpha-1.),size=nbd))
+					starsb[self._F+b,:] = self.trueminf * np.exp(rng.exponential(scale=1./(self.truealpha-1.),size=nbd))
 				else:
 					# draw new source colors from color prior
-					new_colors = np.random.normal(loc=self.color_mus[b-1], scale=self.color_sigs[b-1], size=nbd)
+					new_colors = rng.normal(loc=self.color_mus[b-1], scale=self.color_sigs[b-1], size=nbd)
 					
 					if self.gdat.linear_flux:
 						starsb[self._F+b,:] = starsb[self._F,:]*new_colors
@@ -1377,8 +2072,7 @@ class Model:
 
 			starsb = starsb.compress(inbounds, axis=1)
 			
-			# checking for what is in mask takes on average 50 us with scatter depending on how many sources there are being proposed
-			not_in_mask = np.array([self.dat.weights[0][int(starsb[self._Y,k]), int(starsb[self._X, k])] > 0 for k in range(starsb.shape[1])])
+			not_in_mask = self.dat.weights[0][starsb[self._Y,:].astype(np.int64), starsb[self._X,:].astype(np.int64)] > 0
 
 
 			starsb = starsb.compress(not_in_mask, axis=1)
@@ -1393,10 +2087,10 @@ class Model:
 		# death
 		# does region based death obey detailed balance?
 		elif not lifeordeath and self.n > 0: # need something to kill
-			idx_reg = self.idx_parity_stars()
+			idx_reg = self.idx_parity_stars(task)
 			nbd = int(min(nbd, idx_reg.size)) # kill nbd sources, or however many sources remain
 			if nbd > 0:
-				idx_kill = np.random.choice(idx_reg, size=nbd, replace=False)
+				idx_kill = rng.choice(idx_reg, size=nbd, replace=False)
 				starsk = self.stars.take(idx_kill, axis=1)
 				factor = np.full(nbd, self.penalty)
 				proposal.add_death_stars(idx_kill, starsk)
@@ -1404,23 +2098,28 @@ class Model:
 				assert np.isnan(factor).any()==False
 		return proposal
 
-	def merge_split_stars(self):
+	def merge_split_stars(self, task=None):
 
-		splitsville = np.random.randint(2)
-		idx_reg = self.idx_parity_stars()
+		rng = np.random if task is None else task.rng
+		splitsville = rng.randint(2)
+		idx_reg = self.idx_parity_stars(task)
 		fracs, sum_fs = [],[]
 		idx_bright = idx_reg.take(np.flatnonzero(self.stars[self._F, :].take(idx_reg) > 2*self.trueminf)) # in region!
 		bright_n = idx_bright.size
 		nms = int((self.nregx * self.nregy) / 4)
+		room = self.max_nsrc - self.n
+		if task is not None:
+			nms = max(int(round(nms*task.frac)), 1)
+			room = task.room
 		goodmove = False
 		proposal = Proposal(self.gdat)
 		# split
-		if splitsville and self.n > 0 and self.n < self.max_nsrc and bright_n > 0: # need something to split, but don't exceed nstar
+		if splitsville and self.n > 0 and room > 0 and bright_n > 0: # need something to split, but don't exceed nstar
 			
-			nms = min(nms, bright_n, self.max_nsrc-self.n) # need bright source AND room for split source
-			dx = (np.random.normal(size=nms)*self.kickrange).astype(np.float32)
-			dy = (np.random.normal(size=nms)*self.kickrange).astype(np.float32)
-			idx_move = np.random.choice(idx_bright, size=nms, replace=False)
+			nms = min(nms, bright_n, room) # need bright source AND room for split source
+			dx = (rng.normal(size=nms)*self.kickrange).astype(np.float32)
+			dy = (rng.normal(size=nms)*self.kickrange).astype(np.float32)
+			idx_move = rng.choice(idx_bright, size=nms, replace=False)
 			stars0 = self.stars.take(idx_move, axis=1)
 
 			fminratio = stars0[self._F,:] / self.trueminf
@@ -1431,11 +2130,11 @@ class Model:
 			verbprint(self.verbtype, 'dy = '+str(dy), verbthresh=1)
 			verbprint(self.verbtype, 'idx_move : '+str(idx_move), verbthresh=1)
 				
-			fracs.append((1./fminratio + np.random.uniform(size=nms)*(1. - 2./fminratio)).astype(np.float32))
+			fracs.append((1./fminratio + rng.uniform(size=nms)*(1. - 2./fminratio)).astype(np.float32))
 			
 			for b in range(self.nbands-1):
 				# changed to split similar fluxes
-				d_color = np.random.normal(0,self.gdat.split_col_sig)
+				d_color = rng.normal(0,self.gdat.split_col_sig)
 				# this frac_sim is what source 1 is multiplied by in its remaining bands, so source 2 is multiplied by (1-frac_sim)
 				# print('dcolor is ', d_color)
 				# F_b = F_1*(1 + [f_1*(1-F_1)*delta s/f_2])
@@ -1488,7 +2187,21 @@ class Model:
 				proposal.add_move_stars(idx_move, stars0, starsp)
 				proposal.add_birth_stars(starsb)
 				# can this go nested in if statement? 
-			invpairs = np.empty(nms)
+
+			# adjacency sums of both sources of each split over the catalog with only that split applied (source idx_move[k] 
+			# moved and the new source appended), as computed by neighbours(), using the candidate neighbours of each source
+			x, y = self.stars[self._X, 0:self.n], self.stars[self._Y, 0:self.n]
+			xq = np.concatenate([starsp[self._X,:], starsb[self._X,:]])
+			yq = np.concatenate([starsp[self._Y,:], starsb[self._Y,:]])
+			pair_q, pair_j = self.source_grid.pairs(xq, yq, neighbour_cutoff(x.dtype)*self.kickrange)
+			adjacency = gaussian_adjacency(x, y, xq, yq, pair_q, pair_j, self.kickrange)
+			adjacency[pair_j == np.tile(idx_move, 2)[pair_q]] = 0.
+			neighsum = np.bincount(pair_q, weights=adjacency, minlength=2*nms)
+			neighx = np.abs(starsp[self._X,:] - starsb[self._X,:])
+			neighy = np.abs(starsp[self._Y,:] - starsb[self._Y,:])
+			split_adjacency = np.exp(-(neighx*neighx + neighy*neighy)/(2.*self.kickrange*self.kickrange))
+			invpairs = 1./(neighsum[:nms] + split_adjacency) + 1./(neighsum[nms:] + split_adjacency) #divide by zero
+			invpairs *= 0.5
 			
 			verbprint(self.verbtype, 'splitsville is happening', verbthresh=1)
 			verbprint(self.verbtype, 'goodmove: '+str(goodmove), verbthresh=1)
@@ -1497,46 +2210,53 @@ class Model:
 			verbprint(self.verbtype, 'sum_fs: '+str(sum_fs), verbthresh=1)
 			verbprint(self.verbtype, 'fminratio is '+str(fminratio), verbthresh=1)
 
-			for k in range(nms):
-				xtemp = self.stars[self._X, 0:self.n].copy()
-				ytemp = self.stars[self._Y, 0:self.n].copy()
-				xtemp[idx_move[k]] = starsp[self._X, k]
-				ytemp[idx_move[k]] = starsp[self._Y, k]
-				xtemp = np.concatenate([xtemp, starsb[self._X, k:k+1]])
-				ytemp = np.concatenate([ytemp, starsb[self._Y, k:k+1]])
-				invpairs[k] =  1./neighbours(xtemp, ytemp, self.kickrange, idx_move[k]) #divide by zero
-				invpairs[k] += 1./neighbours(xtemp, ytemp, self.kickrange, self.n)
-			invpairs *= 0.5
-
 		# merge
 		elif not splitsville and idx_reg.size > 1: # need two things to merge!
 
 			nms = int(min(nms, idx_reg.size/2))
 			idx_move = np.empty(nms, dtype=np.int)
 			idx_kill = np.empty(nms, dtype=np.int)
-			choosable = np.zeros(self.max_nsrc, dtype=np.bool)
-			choosable[idx_reg] = True
-			nchoosable = float(idx_reg.size)
 			invpairs = np.empty(nms)
 			
 			verbprint(self.verbtype, 'Merging two things!!', verbthresh=1)
 			verbprint(self.verbtype, 'nms: '+str(nms), verbthresh=1)
-			verbprint(self.verbtype, 'idx_move '+str(idx_move), verbthresh=1)
-			verbprint(self.verbtype, 'idx_kill '+str(idx_kill), verbthresh=1)
-				
+
+			# candidate partners and adjacency sums (as computed by neighbours()) of every source in the region, computed once for all pairs
+			x, y = self.stars[self._X, 0:self.n], self.stars[self._Y, 0:self.n]
+			pair_q, pair_j = self.source_grid.pairs(x[idx_reg], y[idx_reg], neighbour_cutoff(x.dtype)*self.kickrange)
+			adjacency = gaussian_adjacency(x, y, x[idx_reg], y[idx_reg], pair_q, pair_j, self.kickrange)
+			adjacency[pair_j == idx_reg[pair_q]] = 0.
+			pair_offsets = np.searchsorted(pair_q, np.arange(idx_reg.size+1))
+			neighsum = np.bincount(pair_q, weights=adjacency, minlength=idx_reg.size)
+			region_idx = np.full(self.n, -1)
+			region_idx[idx_reg] = np.arange(idx_reg.size)
+
+			# region sources that can still be chosen are choosable[:nchoosable], slot[q] being the position of idx_reg[q] in choosable
+			choosable = np.arange(idx_reg.size)
+			slot = np.arange(idx_reg.size)
+			nchoosable = idx_reg.size
+			uniforms = rng.uniform(size=(nms, 2))
+
 			for k in range(nms):
-				idx_move[k] = np.random.choice(self.max_nsrc, p=choosable/nchoosable)
-				invpairs[k], idx_kill[k] = neighbours(self.stars[self._X, 0:self.n], self.stars[self._Y, 0:self.n], self.kickrange, idx_move[k], generate=True)
-				if invpairs[k] > 0:
-					invpairs[k] = 1./invpairs[k]
-				# prevent sources from being involved in multiple proposals
-				if not choosable[idx_kill[k]]:
-					idx_kill[k] = -1
-				if idx_kill[k] != -1:
-					invpairs[k] += 1./neighbours(self.stars[self._X, 0:self.n], self.stars[self._Y, 0:self.n], self.kickrange, idx_kill[k])
-					choosable[idx_move[k]] = False
-					choosable[idx_kill[k]] = False
-					nchoosable -= 2
+				q = choosable[min(int(uniforms[k,0]*nchoosable), nchoosable-1)]
+				idx_move[k] = idx_reg[q]
+				idx_kill[k] = -1
+				invpairs[k] = 0.
+				if neighsum[q] > 0:
+					invpairs[k] = 1./neighsum[q]
+					# draw the partner with probability proportional to its adjacency
+					cdf = np.cumsum(adjacency[pair_offsets[q]:pair_offsets[q+1]])
+					idx_partner = pair_j[pair_offsets[q] + min(np.searchsorted(cdf, uniforms[k,1]*cdf[-1], side='right'), cdf.size-1)]
+					q_partner = region_idx[idx_partner]
+					# prevent sources from being involved in multiple proposals
+					if q_partner >= 0 and slot[q_partner] < nchoosable:
+						idx_kill[k] = idx_partner
+						invpairs[k] += 1./neighsum[q_partner]
+						for q_used in [q, q_partner]:
+							last = choosable[nchoosable-1]
+							choosable[slot[q_used]], choosable[nchoosable-1] = last, q_used
+							slot[last], slot[q_used] = slot[q_used], nchoosable-1
+							nchoosable -= 1
 			invpairs *= 0.5
 
 			inbounds = (idx_kill != -1)
@@ -1659,17 +2379,19 @@ class Samples():
 
 	def __init__(self, gdat):
 		self.nsample = np.zeros(gdat.nsamp, dtype=np.int32)
-		self.xsample = np.zeros((gdat.nsamp, gdat.max_nsrc), dtype=np.float32)
-		self.ysample = np.zeros((gdat.nsamp, gdat.max_nsrc), dtype=np.float32)
+		# (n, 2+nbands) arrays of the (x, y, fluxes) of the sources of each sample, saved as a chain_io.RaggedCatalog, and their identifiers
+		self.catalogs = []
+		self.source_ids = []
 		self.timestats = np.zeros((gdat.nsamp, 6, 7), dtype=np.float32)
 
 		self.diff2_all = np.zeros((gdat.nsamp, gdat.nloop), dtype=np.float32)
 		self.accept_all = np.zeros((gdat.nsamp, gdat.nloop), dtype=np.float32)
 		self.rtypes = np.zeros((gdat.nsamp, gdat.nloop), dtype=np.float32)
 		self.accept_stats = np.zeros((gdat.nsamp, 7), dtype=np.float32)
+		# 1 (0) if a swap with the next higher temperature was accepted (rejected) after the sample in replica exchange runs, NaN otherwise
+		self.swap_accept = np.full(gdat.nsamp, np.nan, dtype=np.float32)
 
 		self.tq_times = np.zeros(gdat.nsamp, dtype=np.float32)
-		self.fsample = [np.zeros((gdat.nsamp, gdat.max_nsrc), dtype=np.float32) for x in range(gdat.nbands)]
 		
 		self.bkg_sample = np.zeros((gdat.nsamp, gdat.nbands))
 		self.template_amplitudes = np.zeros((gdat.nsamp, gdat.n_templates, gdat.nbands))
@@ -1688,8 +2410,8 @@ class Samples():
 	def add_sample(self, j, model, diff2_list, accepts, rtype_array, accept_fracs, chi2_all, statarrays, resids, model_images):
 		
 		self.nsample[j] = model.n
-		self.xsample[j,:] = model.stars[Model._X, :]
-		self.ysample[j,:] = model.stars[Model._Y, :]
+		self.catalogs.append(model.stars[:Model._F+self.nbands, :model.n].T.astype(np.float32))
+		self.source_ids.append(model.source_ids[:model.n].copy())
 		self.diff2_all[j,:] = diff2_list
 		self.accept_all[j,:] = accepts
 		self.rtypes[j,:] = rtype_array
@@ -1703,11 +2425,21 @@ class Samples():
 			self.fc_rel_amps[j,:] = model.fc_rel_amps
 
 		for b in range(self.nbands):
-			self.fsample[b][j,:] = model.stars[Model._F+b,:]
 			if self.gdat.nsamp - j < self.gdat.residual_samples+1:
 				self.residuals[b][-(self.gdat.nsamp-j),:,:] = resids[b] 
 				self.model_images[b][-(self.gdat.nsamp-j),:,:] = model_images[b]
 
+	def set_swap_accept(self, j, swap_accept):
+		self.swap_accept[j] = swap_accept
+
+	def get_checkpoint_state(self):
+		return dict({key:value for key, value in self.__dict__.items() if key != 'gdat'})
+
+	def set_checkpoint_state(self, state):
+		self.__dict__.update(state)
+		if 'source_ids' not in state: # checkpoints written before sources had identifiers
+			self.source_ids = [np.full(len(catalog), -1, dtype=np.int64) for catalog in self.catalogs]
+
 	def save_samples(self, result_path, timestr):
 
 		# fourier comp, fourier comp colors
@@ -1722,13 +2454,83 @@ class Samples():
 
 		residuals0, model_images0 = self.residuals[0], self.model_images[0]
 
-		np.savez(result_path + '/' + str(timestr) + '/chain.npz', n=self.nsample, x=self.xsample, y=self.ysample, f=self.fsample, \
-			chi2=self.chi2sample, times=self.timestats, accept=self.accept_stats, diff2s=self.diff2_all, rtypes=self.rtypes, \
+		catalog = RaggedCatalog.from_catalogs(self.catalogs, Model._F+self.nbands)
+
+		savez = np.savez_compressed if self.gdat.compress_chain else np.savez
+		savez(result_path + '/' + str(timestr) + '/chain.npz', n=self.nsample, catalog=catalog.records, catalog_offsets=catalog.offsets, \
+			source_ids=np.concatenate(self.source_ids+[np.zeros(0, dtype=np.int64)]), \
+			max_nsrc=self.gdat.max_nsrc, nbands=self.nbands, chi2=self.chi2sample, times=self.timestats, accept=self.accept_stats, swap_accept=self.swap_accept, diff2s=self.diff2_all, rtypes=self.rtypes, \
 			accepts=self.accept_all, residuals0=residuals0, residuals1=residuals1, residuals2=residuals2, model_images0=model_images0,\
 			model_images1=model_images1, model_images2=model_images2, bkg=self.bkg_sample, template_amplitudes=self.template_amplitudes, \
 			fourier_coeffs=self.fourier_coeffs, fc_rel_amps=self.fc_rel_amps)
 
 
+class StreamedSamples(Samples):
+	''' 
+	Samples that are appended to a chain store in the chain subdirectory of the run directory as they are drawn (see chain_io), 
+	rather than kept in preallocated arrays, so that memory use does not grow with nsamp and the chain can be read with 
+	chain_io.ChainReader while the run is going. Catalogs are saved without padding to max_nsrc.
+	'''
+	def __init__(self, gdat):
+		self.gdat = gdat
+		self.nbands = gdat.nbands
+		self.dirpath = gdat.result_path+'/'+gdat.timestr+'/chain'
+		self.fields = dict({'n':((), np.int32), 'chi2':((gdat.nbands,), np.int32), 'times':((6, 7), np.float32), 'accept':((7,), np.float32), \
+						'diff2s':((gdat.nloop,), np.float32), 'rtypes':((gdat.nloop,), np.float32), 'accepts':((gdat.nloop,), np.float32), \
+						'bkg':((gdat.nbands,), np.float64), 'template_amplitudes':((gdat.n_templates, gdat.nbands), np.float64), 'swap_accept':((), np.float32)})
+		if gdat.float_fourier_comps:
+			self.fields['fourier_coeffs'] = ((gdat.n_fourier_terms, gdat.n_fourier_terms, 4), np.float64)
+			self.fields['fc_rel_amps'] = ((gdat.nbands,), np.float64)
+		for b in range(gdat.nbands):
+			self.fields['residuals'+str(b)] = ((gdat.imszs[b][0], gdat.imszs[b][1]), np.float32)
+			self.fields['model_images'+str(b)] = ((gdat.imszs[b][0], gdat.imszs[b][1]), np.float32)
+		# one record (x, y, f_0, ..., f_{nbands-1}) and identifier per source
+		self.ragged_fields = dict({'catalog':((2+gdat.nbands,), np.float32), 'source_ids':((), np.int64)})
+		self.attrs = dict({'max_nsrc':int(gdat.max_nsrc), 'nbands':int(gdat.nbands), 'n_fourier_terms':int(gdat.n_fourier_terms), 'nsamp':int(gdat.nsamp)})
+		# opened on first use, so that the store of a resumed run is not truncated before the checkpoint is restored
+		self.writer = None
+
+	def open_writer(self, counts=None):
+		if self.writer is not None:
+			self.writer.close()
+		self.writer = ChainWriter(self.dirpath, self.fields, ragged_fields=self.ragged_fields, attrs=self.attrs, counts=counts)
+
+	def add_sample(self, j, model, diff2_list, accepts, rtype_array, accept_fracs, chi2_all, statarrays, resids, model_images):
+
+		values = dict({'n':model.n, 'chi2':chi2_all, 'times':statarrays, 'accept':accept_fracs, 'diff2s':diff2_list, 'rtypes':rtype_array, \
+					'accepts':accepts, 'bkg':model.bkg, 'template_amplitudes':model.template_amplitudes, \
+					'catalog':model.stars[:2+self.nbands, :model.n].T, 'source_ids':model.source_ids[:model.n]})
+		if self.gdat.float_fourier_comps:
+			values['fourier_coeffs'] = model.fourier_coeffs
+			values['fc_rel_amps'] = model.fc_rel_amps
+		if self.gdat.nsamp - j < self.gdat.residual_samples+1:
+			for b in range(self.nbands):
+				values['residuals'+str(b)] = resids[b]
+				values['model_images'+str(b)] = model_images[b]
+
+		if self.writer is None:
+			self.open_writer()
+		self.writer.append(values)
+
+	def set_swap_accept(self, j, swap_accept):
+		self.writer.append(dict({'swap_accept':swap_accept}))
+
+	def get_checkpoint_state(self):
+		return dict({'counts':self.writer.get_state()})
+
+	def set_checkpoint_state(self, state):
+		# anything written after the checkpoint is dropped
+		self.open_writer(counts=state['counts'])
+
+	def save_samples(self, result_path, timestr):
+		if self.writer is None:
+			self.open_writer()
+		self.writer.close()
+		store = ChainStore(self.dirpath)
+		self.residuals = [store.field('residuals'+str(b)) for b in range(self.nbands)]
+		self.model_images = [store.field('model_images'+str(b)) for b in range(self.nbands)]
+
+
 # -------------------- actually execute the thing ----------------
 
 class lion():
@@ -1915,6 +2717,20 @@ class lion():
 			mock_name = None, \
 			# filepath for previous catalog if using as an initial state. loads in .npy files
 			load_state_timestr = None, \
+			# the complete sampler state (model, samples so far and random state) is saved to checkpoint.pkl in the run directory 
+			# every checkpoint_period samples and/or every checkpoint_interval seconds. Checkpoints are written atomically
+			checkpoint_period = None, \
+			checkpoint_interval = None, \
+			# if True, the run with time string load_state_timestr is continued in its own directory from its last checkpoint, 
+			# with the same results as an uninterrupted run. The data should be loaded the same way as in the original run 
+			# (set init_seed if add_noise=True). Not supported for replica exchange runs
+			resume = False, \
+			# 'npz' keeps the thinned samples in memory and saves them to chain.npz at the end of the run. 'stream' appends each 
+			# sample to a chain store in the chain subdirectory of the run directory as it is drawn, without padding catalogs to 
+			# max_nsrc. Either can be read with chain_io.ChainReader, including while a streamed run is going
+			chain_format = 'npz', \
+			# if True, chain.npz is compressed (losslessly) with np.savez_compressed
+			compress_chain = False, \
 			# set flag to True if you want posterior plots/catalog samples/etc from run saved
 			save = True, \
 
@@ -1949,6 +2765,14 @@ class lion():
 			nominal_nsrc = 1000, \
 			# splits up image into subregions to do proposals within
 			nregion = 5, \
+			# the chi2 recorded for each proposal is taken from a running per-region ledger. If set to an integer k, the exact full-image 
+			# chi2 is recomputed every k proposals, recorded in its place and used to resynchronize the ledger (useful for validation). 
+			# The per-region chi2 are recomputed too, with a warning if they drifted by more than float rounding
+			exact_chi2_period = None, \
+			# if True, background, template and Fourier component proposals are accepted or rejected from the change in chi2 computed 
+			# in closed form from dot products of the residuals with the model components (see ResidualProjections), and the model 
+			# is only rendered if the proposal is accepted
+			closed_form_proposals = True, \
 			# used when splitting sources and determining colors of resulting objects
 			split_col_sig = 0.2, \
 			# set linear_flux to true in order to get color priors in terms of linear flux density ratios
@@ -2033,13 +2857,62 @@ class lion():
 			# set to True if using CBLAS library
 			cblas=False, \
 			# set to True if using OpenBLAS library for non-Intel processors
-			openblas=False):
+			openblas=False, \
+			# selects the kernel backend by name, one of 'mkl' (pcat-lion.c), 'openblas' (blas-open.c), 'blas' (blas.c), 'numba' 
+			# (compiled at import, needs numba), 'numpy' (vectorized) or 'auto', which benchmarks all available backends on the 
+			# image and picks the fastest. The 'auto' choice is cached per image size, so only the first run benchmarks. If None, 
+			# the backend is set by cblas/openblas, or 'blas' if neither is set. Compiled libraries are built on first use into a 
+			# per-user cache (see backends.py). If the requested backend is not available, the numba backend is used instead, 
+			# or numpy if numba is not installed
+			backend = None, \
+			# time in seconds spent benchmarking each backend when backend='auto'
+			backend_benchmark_time = 1., \
+			# number of OpenMP threads used by the compiled kernels (requires a library compiled with OpenMP, see Makefile)
+			n_threads = 1, \
+			# if True, the BLAS matrix product in the kernels is kept single-threaded so that results are bit for bit 
+			# identical to the serial kernels for any n_threads
+			deterministic_kernels = True, \
+			# number of independent chains, run in parallel in a process pool with one process per chain (see multichain.py). 
+			# the data arrays are shared between processes, each chain is saved in a chain<i> subdirectory of the run directory 
+			# and the Gelman-Rubin R-hat across chains is reported as samples arrive. Each chain uses n_threads kernel threads
+			n_chains = 1, \
+			# number of temperatures for replica exchange (parallel tempering), each run in its own process. The log-likelihood of 
+			# replica k is divided by temp_ladder[k], and states of adjacent temperatures are swapped after every thinned sample. 
+			# Replica k is saved in a temp<k> subdirectory of the run directory, temp0 being the untempered posterior
+			n_temps = 1, \
+			# temperatures of the replicas, starting at 1. If None, temperatures are spaced geometrically by sqrt(2)
+			temp_ladder = None, \
+			# number of threads used for point source proposals. If larger than one, the rows of active (same parity) regions are 
+			# split across a thread pool and each thread proposes, evaluates and accepts moves within its regions, with the catalog 
+			# updated once all threads are done. Requires 2*margin <= region size. Each thread calls kernels using n_threads threads
+			n_region_threads = 1):
 
 
 		for attr, valu in locals().items():
 			if '__' not in attr and attr != 'gdat' and attr != 'map_object':
 				setattr(self.gdat, attr, valu)
 
+		# set by multichain.run_chain() in the worker processes of multi-chain and replica exchange runs
+		self.gdat.chain_idx = None
+		self.gdat.chain_queue = None
+		self.gdat.temperature = 1.
+		self.gdat.exchange_queues = None
+
+		if self.gdat.n_chains > 1 and self.gdat.n_temps > 1:
+			raise ValueError('n_chains and n_temps cannot both be larger than one')
+		if self.gdat.resume:
+			if self.gdat.load_state_timestr is None:
+				raise ValueError('resume requires load_state_timestr, the time string of the run to continue')
+			if self.gdat.n_temps > 1:
+				raise ValueError('resume is not supported for replica exchange runs')
+		if self.gdat.chain_format not in ['npz', 'stream']:
+			raise ValueError("chain_format should be 'npz' or 'stream'")
+		if self.gdat.n_temps > 1:
+			if self.gdat.temp_ladder is None:
+				self.gdat.temp_ladder = list(np.sqrt(2)**np.arange(self.gdat.n_temps))
+			elif len(self.gdat.temp_ladder) != self.gdat.n_temps:
+				raise ValueError('temp_ladder should have n_temps = '+str(self.gdat.n_temps)+' entries, got '+str(len(self.gdat.temp_ladder)))
+
 		#if specified, use seed for random initialization
 		if self.gdat.init_seed is not None:
 			np.random.seed(self.gdat.init_seed)
@@ -2053,6 +2926,8 @@ class lion():
 		self.gdat.lam_dict = dict({'S':250, 'M':350, 'L':500})
 		self.gdat.pixsize_dict = dict({'S':6., 'M':8., 'L':12.})
 		self.gdat.timestr = time.strftime("%Y%m%d-%H%M%S")
+		if self.gdat.resume:
+			self.gdat.timestr = self.gdat.load_state_timestr
 		
 		self.gdat.bands = [b for b in np.array([self.gdat.band0, self.gdat.band1, self.gdat.band2]) if b is not None]
 		self.gdat.nbands = len(self.gdat.bands)
@@ -2161,7 +3036,12 @@ class lion():
 
 		if self.gdat.save:
 			#create directory for results, save config file from run
-			frame_dir, newdir, timestr = create_directories(self.gdat)
+			if self.gdat.resume:
+				newdir = self.gdat.result_path+'/'+self.gdat.timestr
+				frame_dir = add_directory(newdir+'/frames')
+				timestr = self.gdat.timestr
+			else:
+				frame_dir, newdir, timestr = create_directories(self.gdat)
 			self.gdat.timestr = timestr
 			self.gdat.frame_dir = frame_dir
 			self.gdat.newdir = newdir
@@ -2170,35 +3050,48 @@ class lion():
 
 	def initialize_libmmult(self):
 
-		if self.gdat.cblas:
-			print('Using CBLAS routines for Intel processors.. :-) ', file=self.gdat.flog)
+		''' Loads the kernel library for the chosen backend through the backend registry in backends.py. If gdat.backend is None it is 
+		set from the cblas/openblas flags, or to 'blas' if neither is set. With backend='auto', the fastest available backend on the pivot 
+		band image is used, as benchmarked on the first run with this setup. The chosen backend and benchmark timings are stored in gdat, 
+		and so recorded in params.txt. '''
 
-			if sys.version_info[0] == 2:
-				libmmult = npct.load_library('pcat-lion', '.')
+		if self.gdat.backend is None:
+			if self.gdat.cblas:
+				self.gdat.backend = 'mkl'
+			elif self.gdat.openblas:
+				self.gdat.backend = 'openblas'
 			else:
-				libmmult = npct.load_library('pcat-lion', '.')
-				#libmmult = npct.load_library('pcat-lion.so', '.')
-
-		elif self.gdat.openblas:
-			print('Using OpenBLAS routines... :-/ ', file=self.gdat.flog)
-			# libmmult = ctypes.cdll['pcat-lion-openblas.so']
-			# libmmult = npct.load_library('pcat-lion-openblas', '.')
-			if sys.version_info[0] == 2:
-				libmmult = npct.load_library('blas-open', '.')
-			else:
-				libmmult = npct.load_library('blas-open.so', '.')
+				self.gdat.backend = 'blas'
+
+		self.gdat.backend_timings = None
 
+		if self.gdat.backend == 'auto':
+			self.gdat.backend, libmmult, self.gdat.backend_timings = select_backend(self.gdat.imszs[0], self.data.ncs[0], self.data.cfs[0], regsize=int(self.gdat.regsizes[0]), \
+																					n_threads=self.gdat.n_threads, deterministic=self.gdat.deterministic_kernels, \
+																					budget=self.gdat.backend_benchmark_time)
+			print('Backend timings per model evaluation (ms): '+str(dict({name:np.round(dt, 3) for name, dt in self.gdat.backend_timings.items()})), file=self.gdat.flog)
 		else:
-			print('Using slower BLAS routines.. :-( ', file=self.gdat.flog)
-			libmmult = ctypes.cdll['./blas.so'] # not sure how stable this is, trying to find a good Python 3 fix to deal with path configuration
-			# libmmult = npct.load_library('blas', '.')
+			libmmult = load_backend(self.gdat.backend)
+
+			if libmmult is None:
+				fallback = 'numba' if load_backend('numba', build=False) is not None else 'numpy'
+				warnings.warn('backend '+self.gdat.backend+' is not available, falling back to the '+fallback+' backend', Warning)
+				self.gdat.backend = fallback
+				libmmult = load_backend(fallback)
+
+		# the mkl library uses the pcat_* kernel names, the others use clib_*
+		self.gdat.cblas = uses_pcat_names(self.gdat.backend)
+		self.gdat.openblas = (self.gdat.backend == 'openblas')
+		self.gdat.backend_library = getattr(libmmult, '_name', self.gdat.backend)
+
+		print('Using the '+self.gdat.backend+' backend ('+str(self.gdat.backend_library)+')', file=self.gdat.flog)
 
 		return libmmult
 
 
 	def initialize_print_log(self):
 		if self.gdat.print_log:
-			self.gdat.flog = open(self.gdat.result_path+'/'+self.gdat.timestr+'/print_log.txt','w')
+			self.gdat.flog = open(self.gdat.result_path+'/'+self.gdat.timestr+'/print_log.txt', 'a' if self.gdat.resume else 'w')
 		else:
 			self.gdat.flog = None		
 
@@ -2207,7 +3100,14 @@ class lion():
 
 		''' Here is where we initialize the C libraries and instantiate the arrays that will store our 
 		thinned samples and other stats. We want the MKL routine if possible, then OpenBLAS, then regular C,
-		with that order in priority.'''
+		with that order in priority. If n_chains > 1, the chains are run in parallel with multichain.run_chains(), 
+		which returns the output of main() for each chain and the final R-hat of the chain summaries. If n_temps > 1,
+		multichain.run_tempered() runs the replicas and returns the output of main() for each and the swap acceptance fractions.'''
+
+		if self.gdat.n_chains > 1 and self.gdat.chain_idx is None:
+			return run_chains(self)
+		if self.gdat.n_temps > 1 and self.gdat.chain_idx is None:
+			return run_tempered(self)
 
 		self.initialize_print_log()
 		
@@ -2215,8 +3115,15 @@ class lion():
 
 		initialize_c(self.gdat, libmmult, cblas=self.gdat.cblas)
 
+		if self.gdat.save:
+			# record the backend chosen at startup
+			save_params(self.gdat.newdir, self.gdat)
+
 		start_time = time.time()
-		samps = Samples(self.gdat)
+		if self.gdat.chain_format == 'stream':
+			samps = StreamedSamples(self.gdat)
+		else:
+			samps = Samples(self.gdat)
 
 		verbprint(self.gdat.verbtype, 'Initializing model..', verbthresh=1)
 
@@ -2225,7 +3132,24 @@ class lion():
 		verbprint(self.gdat.verbtype, 'Done initializing model..', verbthresh=1)
 
 		trueminf_schedule_counter = 0
-		for j in range(self.gdat.nsamp): # run sampler for gdat.nsamp thinned states
+		j0 = 0
+		run_dir = self.gdat.result_path+'/'+self.gdat.timestr
+
+		if self.gdat.resume:
+			checkpoint = load_checkpoint(run_dir)
+			if checkpoint is None:
+				print('No checkpoint found in '+run_dir+', starting from the first sample', file=self.gdat.flog)
+			else:
+				j0 = checkpoint['sample_idx']
+				model.set_checkpoint_state(checkpoint['model'])
+				samps.set_checkpoint_state(checkpoint['samples'])
+				self.gdat.trueminf = checkpoint['trueminf']
+				trueminf_schedule_counter = checkpoint['trueminf_schedule_counter']
+				np.random.set_state(checkpoint['rng_state'])
+				print('Resuming from checkpoint at sample '+str(j0), file=self.gdat.flog)
+
+		checkpoint_time = time.time()
+		for j in range(j0, self.gdat.nsamp): # run sampler for gdat.nsamp thinned states
 			print('Sample', j, file=self.gdat.flog)
 
 			if self.gdat.schedule_trueminf:
@@ -2243,6 +3167,21 @@ class lion():
 			_, chi2_all, statarrays,  accept_fracs, diff2_list, rtype_array, accepts, resids, model_images = model.run_sampler(j)
 			samps.add_sample(j, model, diff2_list, accepts, rtype_array, accept_fracs, chi2_all, statarrays, resids, model_images)
 
+			if self.gdat.chain_queue is not None:
+				self.gdat.chain_queue.put((self.gdat.chain_idx, j, chain_summary(self.gdat, model)))
+
+			if self.gdat.exchange_queues is not None:
+				samps.set_swap_accept(j, exchange_replica_state(self.gdat, j, model, chi2_all))
+
+			if self.gdat.save and j < self.gdat.nsamp-1:
+				period_due = self.gdat.checkpoint_period is not None and (j+1) % self.gdat.checkpoint_period == 0
+				interval_due = self.gdat.checkpoint_interval is not None and time.time() - checkpoint_time >= self.gdat.checkpoint_interval
+				if period_due or interval_due:
+					save_checkpoint(run_dir, dict({'sample_idx':j+1, 'model':model.get_checkpoint_state(), 'samples':samps.get_checkpoint_state(), \
+												'trueminf':self.gdat.trueminf, 'trueminf_schedule_counter':trueminf_schedule_counter, 'rng_state':np.random.get_state()}))
+					checkpoint_time = time.time()
+					print('Saved checkpoint after sample '+str(j), file=self.gdat.flog)
+
 
 		if self.gdat.save:
 			print('Saving...', file=self.gdat.flog)
@@ -2251,7 +3190,7 @@ class lion():
 			samps.save_samples(self.gdat.result_path, self.gdat.timestr)
 
 			# save final catalog state
-			np.savez(self.gdat.result_path + '/'+str(self.gdat.timestr)+'/final_state.npz', cat=model.stars, bkg=model.bkg, templates=model.template_amplitudes, fourier_coeffs=model.fourier_coeffs)
+			np.savez(self.gdat.result_path + '/'+str(self.gdat.timestr)+'/final_state.npz', cat=model.stars[:, :model.n], source_ids=model.source_ids[:model.n], bkg=model.bkg, templates=model.template_amplitudes, fourier_coeffs=model.fourier_coeffs)
 
 		if self.gdat.timestr_list_file is not None:
 			if path.exists(self.gdat.timestr_list_file):
@@ -165,13 +165,9 @@ process while characterizing it in this way. the question then becomes, how do I
 
 # 	result_plots(timestr=timestring,cattype=None, burn_in_frac=0.75, boolplotsave=True, boolplotshow=False, plttype='png', gdat=None)
 
-# # from multiprocessing import Pool
-
-# def multithreaded_pcat(n_process=2):
-# 	p = Pool(processes=n_process)
-# 	p.map(run_pcat, [0. for x in range(n_process)])
-
-# multithreaded_pcat()
+# independent chains are run in parallel with the n_chains option, which shares the data between processes and reports R-hat as samples arrive
+# ob = lion(band0=0, band1=1, band2=2, base_path=base_path, result_path=result_path, n_chains=4, nsamp=500, float_background=True)
+# chain_outputs, rhats = ob.main()
 
 # ob = lion(band0=0, band1=1, band2=2, base_path=base_path, result_path=result_path, round_up_or_down='down', bolocam_mask=True, float_background=True, burn_in_frac=0.8, bkg_sig_fac=5.0, bkg_sample_delay=0,\
 # 			 cblas=False, openblas=True, visual=False, float_templates=True, template_names=['sze'], template_amplitudes=[[0.0], [0.0], [0.0]], tail_name='rxj1347_PSW_sim0302',\
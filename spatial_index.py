@@ -0,0 +1,288 @@
+import numpy as np
+
+''' Neighbour searches over catalog positions for the merge/split proposals. The Gaussian adjacency exp(-d^2/(2 kickrange^2))
+used by neighbours() underflows to exactly zero beyond neighbour_cutoff(dtype)*kickrange, where the exponent passes the smallest
+positive number of the precision of the positions (about exp(-103) for float32 catalogs), so sums and draws over the sources in
+the surrounding cells of a grid with that cell size are the same as over the whole catalog. '''
+
+
+def neighbour_cutoff(dtype):
+	''' Distance in units of kickrange beyond which the adjacency of positions of the given dtype is exactly zero, with one unit of margin in the exponent. '''
+	return np.sqrt(2.*(1.-np.log(float(np.finfo(dtype).smallest_subnormal))))
+
+
+def neighbours(x,y,neigh,i,generate=False,rng=np.random):
+	''' Neighbours function is used in merge proposal, where you have some source and you want to choose a nearby
+		source with some probability to merge. rng is the random state used to draw the neighbour if generate is True. '''
+
+	neighx = np.abs(x - x[i])
+	neighy = np.abs(y - y[i])
+	adjacency = np.exp(-(neighx*neighx + neighy*neighy)/(2.*neigh*neigh))
+	adjacency[i] = 0.
+	neighbours = np.sum(adjacency)
+	if generate:
+		if neighbours:
+			j = rng.choice(adjacency.size, p=adjacency.flatten()/float(neighbours))
+		else:
+			j = -1
+		return neighbours, j
+	else:
+		return neighbours
+
+
+def neighbour_pairs(x, y, xq, yq, cutoff):
+	'''
+	Candidate neighbours of a set of query points among sources, i.e. every source in the 3x3 grid cells of side cutoff
+	around each query point, which includes all sources within cutoff.
+
+	Parameters
+	----------
+
+	x, y : '~numpy.ndarray' of shape (n,)
+		Source positions.
+
+	xq, yq : '~numpy.ndarray' of shape (nq,)
+		Query positions.
+
+	cutoff : float
+		Cell size.
+
+	Returns
+	-------
+
+	q, j : '~numpy.ndarray' of type int64
+		Query and source index of each candidate pair, sorted by query and then by source index.
+
+	'''
+	if len(x) == 0 or len(xq) == 0:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+	cx, cy = np.floor(x/cutoff).astype(np.int64), np.floor(y/cutoff).astype(np.int64)
+	cqx, cqy = np.floor(xq/cutoff).astype(np.int64), np.floor(yq/cutoff).astype(np.int64)
+	# cell keys with a one cell border, so that the keys of neighbouring cells of the query points do not wrap around
+	x0, y0 = min(cx.min(), cqx.min())-1, min(cy.min(), cqy.min())-1
+	width = max(cy.max(), cqy.max())-y0+2
+	key = (cx-x0)*width + (cy-y0)
+	order = np.argsort(key, kind='stable')
+	sorted_key = key[order]
+
+	qs, lows, counts = [], [], []
+	for dx in [-1, 0, 1]:
+		for dy in [-1, 0, 1]:
+			qkey = (cqx+dx-x0)*width + (cqy+dy-y0)
+			low = np.searchsorted(sorted_key, qkey, side='left')
+			counts.append(np.searchsorted(sorted_key, qkey, side='right') - low)
+			lows.append(low)
+			qs.append(np.arange(len(xq)))
+	qs, lows, counts = np.concatenate(qs), np.concatenate(lows), np.concatenate(counts)
+
+	npair = counts.sum()
+	starts = np.cumsum(counts) - counts
+	q = np.repeat(qs, counts)
+	j = order[np.repeat(lows, counts) + np.arange(npair) - np.repeat(starts, counts)]
+	pair_order = np.lexsort((j, q))
+
+	return q[pair_order], j[pair_order]
+
+
+def gaussian_adjacency(x, y, xq, yq, q, j, neigh):
+	''' Adjacency of each candidate pair (q, j), evaluated in the precision of the positions as in neighbours(). '''
+	neighx = np.abs(x[j] - xq[q])
+	neighy = np.abs(y[j] - yq[q])
+	return np.exp(-(neighx*neighx + neighy*neighy)/(2.*neigh*neigh))
+
+
+class SourceGrid():
+	'''
+	Cell list of the catalog positions, maintained across proposals so that region, radius and pair queries only visit the
+	sources in the cells they overlap. Cells are squares of side cell_size in image pixels and each holds the catalog indices
+	of its sources in a row of members, padded with -1, whose capacity doubles when a cell overflows. The index keeps its own
+	copy of the positions, so it must be updated with move(), insert(), remove() and relabel() whenever the catalog changes, 
+	or rebuilt with build().
+
+	Parameters
+	----------
+
+	imsz : list of two ints
+		Image size (x, y) of the band the positions refer to.
+
+	cell_size : float
+		Cell side length in pixels.
+
+	max_nsrc : int
+		Catalog capacity.
+
+	'''
+	def __init__(self, imsz, cell_size, max_nsrc, min_capacity=8):
+		self.cell_size = float(cell_size)
+		self.ncx = int(np.ceil(imsz[0]/self.cell_size))+1
+		self.ncy = int(np.ceil(imsz[1]/self.cell_size))+1
+		self.max_nsrc = max_nsrc
+		self.min_capacity = min_capacity
+		self.build(np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32))
+
+	def cell_index(self, x, y):
+		cx = np.clip(np.floor(x/self.cell_size).astype(np.int64), 0, self.ncx-1)
+		cy = np.clip(np.floor(y/self.cell_size).astype(np.int64), 0, self.ncy-1)
+		return cx*self.ncy + cy
+
+	def build(self, x, y):
+		''' Resets the index to the sources 0 <= i < len(x) at positions (x, y). '''
+		self.members = np.full((self.ncx*self.ncy, self.min_capacity), -1, dtype=np.int64)
+		self.count = np.zeros(self.ncx*self.ncy, dtype=np.int64)
+		self.cell = np.full(self.max_nsrc, -1, dtype=np.int64)
+		self.slot = np.full(self.max_nsrc, -1, dtype=np.int64)
+		self.x = np.zeros(self.max_nsrc, dtype=np.float32)
+		self.y = np.zeros(self.max_nsrc, dtype=np.float32)
+		self.insert(np.arange(len(x)), x, y)
+
+	def insert(self, idx, x, y):
+		''' Adds sources with catalog indices idx at positions (x, y). '''
+		idx = np.asarray(idx, dtype=np.int64)
+		if idx.size == 0:
+			return
+		self.x[idx], self.y[idx] = x, y
+		cells = self.cell_index(self.x[idx], self.y[idx])
+		order = np.argsort(cells, kind='stable')
+		idx, cells = idx[order], cells[order]
+		# sources going to the same cell take consecutive slots after the current members
+		slots = self.count[cells] + np.arange(cells.size) - np.searchsorted(cells, cells, side='left')
+		if slots.max() >= self.members.shape[1]:
+			capacity = self.members.shape[1]
+			while capacity <= slots.max():
+				capacity *= 2
+			members = np.full((self.members.shape[0], capacity), -1, dtype=np.int64)
+			members[:, :self.members.shape[1]] = self.members
+			self.members = members
+		self.members[cells, slots] = idx
+		self.cell[idx], self.slot[idx] = cells, slots
+		self.count += np.bincount(cells, minlength=self.count.size)
+
+	def remove(self, idx):
+		''' Removes sources with catalog indices idx, keeping the remaining members of each cell in order. '''
+		idx = np.asarray(idx, dtype=np.int64)
+		if idx.size == 0:
+			return
+		cells = self.cell[idx]
+		self.members[cells, self.slot[idx]] = -1
+		self.cell[idx], self.slot[idx] = -1, -1
+		cells = np.unique(cells)
+		rows = self.members[cells]
+		rows = np.take_along_axis(rows, np.argsort(rows < 0, axis=1, kind='stable'), axis=1)
+		self.members[cells] = rows
+		self.count[cells] = np.count_nonzero(rows >= 0, axis=1)
+		r, s = np.nonzero(rows >= 0)
+		self.slot[rows[r, s]] = s
+
+	def move(self, idx, x, y):
+		''' Updates the positions of sources idx, moving those that change cell. '''
+		idx = np.asarray(idx, dtype=np.int64)
+		if idx.size == 0:
+			return
+		self.x[idx], self.y[idx] = x, y
+		changed = idx[self.cell_index(self.x[idx], self.y[idx]) != self.cell[idx]]
+		self.remove(changed)
+		self.insert(changed, self.x[changed], self.y[changed])
+
+	def relabel(self, old, new):
+		''' Gives sources old the catalog indices new, e.g. when the last sources of the catalog are moved into the entries of removed ones. '''
+		old, new = np.asarray(old, dtype=np.int64), np.asarray(new, dtype=np.int64)
+		if old.size == 0:
+			return
+		self.members[self.cell[old], self.slot[old]] = new
+		for arr, fill in [(self.cell, -1), (self.slot, -1), (self.x, 0), (self.y, 0)]:
+			arr[new] = arr[old]
+			arr[old] = fill
+
+	def cell_members(self, cells):
+		''' Catalog indices of the sources in cells, and the position in cells of the cell of each. '''
+		cells = np.asarray(cells, dtype=np.int64)
+		counts = self.count[cells]
+		starts = np.cumsum(counts) - counts
+		which = np.repeat(np.arange(cells.size), counts)
+		return self.members[cells[which], np.arange(which.size) - starts[which]], which
+
+	def cell_range(self, lo, hi, ncell):
+		''' Cells along one axis overlapping the pixel interval [lo, hi]. '''
+		return np.arange(max(int(np.floor(lo/self.cell_size)), 0), min(int(np.floor(hi/self.cell_size)), ncell-1)+1)
+
+	def sources_in_regions(self, offsetx, offsety, regsize, regx, regy):
+		'''
+		Sources in a set of regions of a region grid, i.e. with region indices ((floor(x)+offsetx)//regsize, (floor(y)+offsety)//regsize) 
+		such that regx and regy are True. Only the cells overlapping the selected region columns and rows are visited.
+
+		Parameters
+		----------
+
+		offsetx, offsety : ints
+			Region grid offsets.
+
+		regsize : int
+			Region size in pixels.
+
+		regx, regy : '~numpy.ndarray's of type bool
+			Selected region columns and rows. Regions beyond the end of the masks are not selected.
+
+		Returns
+		-------
+
+		idx : '~numpy.ndarray' of type int64
+			Sorted catalog indices.
+
+		'''
+		selected = []
+		for mask, offset, ncell in [(regx, offsetx, self.ncx), (regy, offsety, self.ncy)]:
+			# region of the first and last pixel of each cell, a cell is selected if any region between them is
+			first = (np.floor(np.arange(ncell)*self.cell_size).astype(np.int64) + offset)//regsize
+			last = (np.ceil(np.arange(1, ncell+1)*self.cell_size).astype(np.int64) - 1 + offset)//regsize
+			nsel = np.concatenate([[0], np.cumsum(mask)])
+			selected.append(np.flatnonzero(nsel[np.minimum(last+1, mask.size)] > nsel[np.minimum(first, mask.size)]))
+		idx, _ = self.cell_members((selected[0][:,None]*self.ncy + selected[1][None,:]).ravel())
+		rx = (np.floor(self.x[idx]).astype(np.int64) + offsetx)//regsize
+		ry = (np.floor(self.y[idx]).astype(np.int64) + offsety)//regsize
+		keep = (rx >= 0)*(rx < regx.size)*(ry >= 0)*(ry < regy.size)
+		keep[keep] = np.logical_and(regx[rx[keep]], regy[ry[keep]])
+		return np.sort(idx[keep])
+
+	def sources_within(self, x0, y0, r):
+		''' Sorted catalog indices of the sources within distance r of (x0, y0). '''
+		cells = (self.cell_range(x0-r, x0+r, self.ncx)[:,None]*self.ncy + self.cell_range(y0-r, y0+r, self.ncy)[None,:]).ravel()
+		idx, _ = self.cell_members(cells)
+		dx, dy = self.x[idx]-x0, self.y[idx]-y0
+		return np.sort(idx[dx*dx + dy*dy <= r*r])
+
+	def count_within(self, x0, y0, r):
+		''' Number of sources within distance r of (x0, y0), e.g. within kickrange of a merge/split candidate. '''
+		return self.sources_within(x0, y0, r).size
+
+	def pairs(self, xq, yq, r):
+		'''
+		Candidate neighbours of a set of query points, i.e. the sources in every cell overlapping the square of half side r around 
+		each query point, which includes all sources within r. Same output as neighbour_pairs(), without sorting the catalog.
+
+		Returns
+		-------
+
+		q, j : '~numpy.ndarray' of type int64
+			Query and source index of each candidate pair, sorted by query and then by source index.
+
+		'''
+		if len(xq) == 0:
+			return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+		span = int(np.ceil(r/self.cell_size))
+		# sources outside of the grid are kept in its edge cells, so query points are clipped in the same way
+		cqx = np.clip(np.floor(xq/self.cell_size).astype(np.int64), 0, self.ncx-1)
+		cqy = np.clip(np.floor(yq/self.cell_size).astype(np.int64), 0, self.ncy-1)
+		qs, cells = [], []
+		for dx in range(-span, span+1):
+			for dy in range(-span, span+1):
+				valid = np.flatnonzero((cqx+dx >= 0)*(cqx+dx < self.ncx)*(cqy+dy >= 0)*(cqy+dy < self.ncy))
+				qs.append(valid)
+				cells.append((cqx[valid]+dx)*self.ncy + cqy[valid]+dy)
+		qs = np.concatenate(qs)
+		j, which = self.cell_members(np.concatenate(cells))
+		q = qs[which]
+		# pairs are unique, so a single key sorts them by query and then source index (much faster than lexsort)
+		pair_order = np.argsort(q*self.max_nsrc + j)
+
+		return q[pair_order], j[pair_order]
@@ -67,6 +67,50 @@ def get_gaussian_psf_template(pixel_fwhm=3., nbin=5, normalization='max'):
 	return psfnew, cf, nc, nbin
 
 
+class psf_model():
+	''' 
+	Frozen PSF model consumed by the model evaluation kernels. The coefficient matrix is validated and converted to a 
+	read-only, C-contiguous float32 array once, so that it can be passed to the kernels on every proposal without copies.
+
+	Parameters
+	----------
+
+	cf : '~numpy.ndarray' of shape (10, nc*nc)
+		Coefficients of polynomial fit to upsampled PSF, as returned by psf_poly_fit().
+
+	nc : int
+		Side length of PSF postage stamp in pixels.
+
+	fwhm : float
+		Full width at half-maximum (FWHM) of the Gaussian PSF in units of pixels.
+
+	psf : '~numpy.ndarray', optional
+		Upsampled PSF template the coefficients were fit to. Default is 'None'.
+
+	nbin : int, optional
+		Upsampling factor of psf. Default is 'None'.
+
+	'''
+	def __init__(self, cf, nc, fwhm, psf=None, nbin=None):
+
+		cf = np.ascontiguousarray(cf, dtype=np.float32)
+
+		if cf.ndim != 2 or cf.shape[0] != 10:
+			raise ValueError('PSF coefficient matrix should have shape (10, nc*nc), got '+str(cf.shape))
+		if cf.shape[1] != nc*nc:
+			raise ValueError('PSF coefficient matrix has '+str(cf.shape[1])+' columns, expected nc*nc = '+str(nc*nc))
+		if not np.all(np.isfinite(cf)):
+			raise ValueError('PSF coefficient matrix has non-finite entries')
+
+		cf.flags.writeable = False
+
+		self.cf = cf
+		self.nc = int(nc)
+		self.fwhm = fwhm
+		self.psf = psf
+		self.nbin = nbin
+
+
 def load_in_map(gdat, band=0, astrom=None, show_input_maps=False, image_extnames=['SIGNAL']):
 
 	''' 
@@ -355,7 +399,7 @@ class pcat_data():
 
 	def __init__(self, auto_resize=False, nregion=1):
 		self.ncs, self.nbins, self.psfs, self.cfs, self.biases, self.data_array, self.weights, self.masks, self.errors, \
-			self.widths, self.heights, self.fracs, self.template_array, self.injected_diffuse_comp = [[] for x in range(14)]
+			self.widths, self.heights, self.fracs, self.template_array, self.injected_diffuse_comp, self.psf_models = [[] for x in range(15)]
 		self.fast_astrom = wcs_astrometry(auto_resize, nregion=nregion)
 
 	def load_in_data(self, gdat, map_object=None, tail_name=None, show_input_maps=False, \
@@ -749,10 +793,13 @@ class pcat_data():
 
 			verbprint(gdat.verbtype, 'Image maximum is '+str(np.max(self.data_array[0]))+', gdat.frac = '+str(gdat.frac)+', sum of PSF is '+str(np.sum(psf)), verbthresh=1)
 
-			self.psfs.append(psf)
-			self.cfs.append(cf)
-			self.ncs.append(nc)
-			self.nbins.append(nbin)
+			# cfs, ncs, psfs and nbins are kept for compatibility and point to the frozen PSF model
+			psfmod = psf_model(cf, nc, gdat.psf_fwhms[i], psf=psf, nbin=nbin)
+			self.psf_models.append(psfmod)
+			self.psfs.append(psfmod.psf)
+			self.cfs.append(psfmod.cf)
+			self.ncs.append(psfmod.nc)
+			self.nbins.append(psfmod.nbin)
 			# self.biases.append(gdat.bias)
 			self.fracs.append(gdat.frac)
 
@@ -16,6 +16,7 @@ if sys.version_info[0] == 3:
 	from celluloid import Camera
 
 from fourier_bkg_modl import *
+from chain_io import ChainReader
 
 def add_directory(dirpath):
 	if not os.path.isdir(dirpath):
@@ -361,11 +362,10 @@ def scotts_rule_bins(samples):
 def make_pcat_sample_gif(timestr, im_path, image_extension='SIGNAL', gif_path=None, cat_xy=True, resids=True, color_color=True, number_cts=True, result_path='/Users/luminatech/Documents/multiband_pcat/spire_results/', \
 						gif_fpr = 5):
 
-	chain = np.load('spire_results/'+timestr+'/chain.npz')
+	chain = ChainReader('spire_results/'+timestr)
 	residz = chain['residuals0']
-	if number_cts:
-		fsrcs = chain['f']
-		nsrcs = chain['n']
+	# per-sample (x, y, fluxes) records
+	catalog = chain['catalog']
 
 	# gdat, filepath, result_path = load_param_dict(timestr, result_path='spire_results/')
 
@@ -395,12 +395,13 @@ def make_pcat_sample_gif(timestr, im_path, image_extension='SIGNAL', gif_path=No
 
 	for k in np.arange(0, len(residz), 10):
 		tick = 1
+		srcs = catalog[-nresid+k]
 
 		if cat_xy:
 			ax1 = plt.subplot(1,n_panels, tick)
 			plt.imshow(im-np.median(im), vmin=-0.007, vmax=0.01, cmap='Greys')
-			plt.scatter(chain['x'][-nresid+k,:], chain['y'][-nresid+k,:], s=4e3*chain['f'][0,-nresid+k,:], marker='+', color='r')
-			plt.text(25, -2, 'Nsamp = '+str(chain['x'].shape[0]-nresid+k)+', Nsrc='+str(chain['n'][-nresid+k]), fontsize=20)
+			plt.scatter(srcs[:,0], srcs[:,1], s=4e3*srcs[:,2], marker='+', color='r')
+			plt.text(25, -2, 'Nsamp = '+str(len(catalog)-nresid+k)+', Nsrc='+str(len(srcs)), fontsize=20)
 			# ax1.set_title('Nsamp = '+str(chain['x'].shape[0]-300+k)+', Nsrc='+str(chain['n'][-300+k]), fontsize=20)
 
 			# plt.xlim(0, min(im.shape[0], im.shape[1]))
@@ -418,7 +419,7 @@ def make_pcat_sample_gif(timestr, im_path, image_extension='SIGNAL', gif_path=No
 			ax3 = plt.subplot(1,n_panels, tick)
 			asp = np.diff(ax3.get_xlim())[0] / np.diff(ax3.get_ylim())[0]
 			ax3.set_aspect(asp)
-			plt.scatter(chain['f'][1,-nresid+k,:]/chain['f'][0,-nresid+k,:], chain['f'][2,-nresid+k,:]/chain['f'][1,-nresid+k,:], s=1.5e4*chain['f'][0,-nresid+k,:], marker='x', c='k')
+			plt.scatter(srcs[:,3]/srcs[:,2], srcs[:,4]/srcs[:,3], s=1.5e4*srcs[:,2], marker='x', c='k')
 			plt.ylim(-0.5, 10.5)
 			plt.xlim(-0.5, 10.5)
 
@@ -429,7 +430,7 @@ def make_pcat_sample_gif(timestr, im_path, image_extension='SIGNAL', gif_path=No
 			nbins = 20
 			binz = np.linspace(np.log10(0.005)+3.-1., 3., nbins)
 
-			fsrcs_in_fov = np.array([fsrcs[0][-nresid+k][i] for i in range(nsrcs[-nresid+k])])
+			fsrcs_in_fov = srcs[:,2]
 
 			hist = np.histogram(np.log10(fsrcs_in_fov)+3, bins=binz)
 			logSv = 0.5*(hist[1][1:]+hist[1][:-1])-3
@@ -589,7 +590,7 @@ def plot_template_median_std(template, template_samples, band='250 micron', temp
 
 # fourier comps
 
-def plot_fc_median_std(fourier_coeffs, imsz, ref_img=None, bkg_samples=None, fourier_templates=None, title=True, show=False, convert_to_MJy_sr_fac=None, psf_fwhm=None):
+def plot_fc_median_std(fourier_coeffs, imsz, ref_img=None, bkg_samples=None, fourier_templates=None, title=True, show=False, convert_to_MJy_sr_fac=None, psf_fwhm=None, chunk_size=64):
 	
 	if convert_to_MJy_sr_fac is None:
 		convert_to_MJy_sr_fac = 1.
@@ -599,17 +600,13 @@ def plot_fc_median_std(fourier_coeffs, imsz, ref_img=None, bkg_samples=None, fou
 
 	n_terms = fourier_coeffs.shape[-2]
 
-	all_temps = np.zeros((fourier_coeffs.shape[0], imsz[0], imsz[1]))
 	if fourier_templates is None:
-		fourier_templates = make_fourier_templates(imsz[0], imsz[1], n_terms, psf_fwhm=psf_fwhm)
+		fourier_templates = FourierBasis(imsz[0], imsz[1], n_terms, psf_fwhm=psf_fwhm)
 
-	for i, fourier_coeff_state in enumerate(fourier_coeffs):
-		all_temps[i] = generate_template(fourier_coeff_state, n_terms, fourier_templates=fourier_templates, N=imsz[0], M=imsz[1])
-		if bkg_samples is not None:
-			all_temps[i] += bkg_samples[i]
-
-	mean_fc_temp = np.median(all_temps, axis=0)
-	std_fc_temp = np.std(all_temps, axis=0)
+	# the median is a P^2 estimate, so the background maps of all samples are never held in memory at once
+	fc_stats = posterior_background_stats(fourier_coeffs, fourier_templates, bkg_samples=bkg_samples, quantiles=[0.5], chunk_size=chunk_size)
+	mean_fc_temp = fc_stats.quantile(0.5)
+	std_fc_temp = fc_stats.std()
 
 	if ref_img is not None:
 		f = plt.figure(figsize=(15, 5))
@@ -658,11 +655,11 @@ def plot_last_fc_map(fourier_coeffs, imsz, ref_img=None, fourier_templates=None,
 
 
 	if fourier_templates is None:
-		fourier_templates = make_fourier_templates(imsz[0], imsz[1], n_terms, psf_fwhm=3.)
+		fourier_templates = FourierBasis(imsz[0], imsz[1], n_terms, psf_fwhm=3.)
 	last_temp_bc = generate_template(fourier_coeffs, n_terms, fourier_templates=fourier_templates, N=imsz[0], M=imsz[1])
 
 
-	fourier_templates_unconv = make_fourier_templates(imsz[0], imsz[1], n_terms, psf_fwhm=None)
+	fourier_templates_unconv = FourierBasis(imsz[0], imsz[1], n_terms, psf_fwhm=None)
 	last_temp = generate_template(fourier_coeffs, n_terms, fourier_templates=fourier_templates_unconv, N=imsz[0], M=imsz[1])	
 
 	if ref_img is not None:
@@ -832,20 +829,13 @@ def plot_posterior_fc_power_spectrum(fourier_coeffs, N, pixsize=6., show=False):
 	kmags = np.sqrt(mesha**2+meshb**2)
 	ps_bins = np.logspace(0, np.log10(n_terms+2), 6)
 
-	twod_power_spectrum_realiz = []
-	oned_ps_realiz = []
 	kbin_masks = []
 	for i in range(len(ps_bins)-1):
 		kbinmask = (kmags >= ps_bins[i])*(kmags < ps_bins[i+1])
 		kbin_masks.append(kbinmask)
 
-	for i, fourier_coeff_state in enumerate(fourier_coeffs):
-		av_2d_ps = np.mean(fourier_coeff_state**2, axis=2)
-		oned_ps_realiz.append(np.array([np.mean(av_2d_ps[mask]) for mask in kbin_masks]))
-		twod_power_spectrum_realiz.append(av_2d_ps)
-
-	power_spectrum_realiz = np.array(twod_power_spectrum_realiz)
-	oned_ps_realiz = np.array(oned_ps_realiz)
+	power_spectrum_realiz = np.mean(np.asarray(fourier_coeffs)**2, axis=3)
+	oned_ps_realiz = np.array([np.mean(power_spectrum_realiz[:,mask], axis=1) for mask in kbin_masks]).T
 
 
 	f = plt.figure(figsize=(10, 5))
@@ -1567,6 +1557,12 @@ def grab_atcr(timestr, paramstr='template_amplitudes', band=0, result_dir=None,
 	if return_fig:
 		return f
 
+def in_fov_mask(srcs, weights):
+	''' Mask of the sources of one catalog sample (records of x, y, fluxes) that fall on observed pixels of weights. '''
+	mask = (srcs[:,0] < weights.shape[0])*(srcs[:,1] < weights.shape[1])
+	mask[mask] = weights[srcs[mask,1].astype(int), srcs[mask,0].astype(int)] != 0.
+	return mask
+
 def result_plots(timestr=None, burn_in_frac=0.8, boolplotsave=True, boolplotshow=False, \
 				plttype='png', gdat=None, cattype='SIDES', min_flux_refcat=1e-4, dpi=150, flux_density_unit='MJy/sr', \
 				accept_fraction_plots=True, chi2_plots=True, dc_background_plots=True, fourier_comp_plots=True, \
@@ -1625,7 +1621,7 @@ def result_plots(timestr=None, burn_in_frac=0.8, boolplotsave=True, boolplotshow
 			print('mask_hwhm = '+str(mask_hwhm))
 
 			xmatch_roc = cross_match_roc(timestr=gdat.timestr, nsamp=gdat.n_condensed_samp)
-			xmatch_roc.load_chain(gdat.result_path+'/'+gdat.timestr+'/chain.npz')
+			xmatch_roc.load_chain(gdat.result_path+'/'+gdat.timestr)
 			xmatch_roc.load_gdat_params(gdat=gdat)
 			condensed_cat, seed_cat, column_names = xmatch_roc.condense_catalogs(prevalence_cut=gdat.prevalence_cut, save_cats=True, make_seed_bool=True, \
 																				mask_hwhm=gdat.mask_hwhm, search_radius=gdat.search_radius)
@@ -1671,15 +1667,14 @@ def result_plots(timestr=None, burn_in_frac=0.8, boolplotsave=True, boolplotshow
 	dat = pcat_data(gdat.auto_resize, nregion=gdat.nregion)
 	dat.load_in_data(gdat)
 
-	chain = np.load(gdat.filepath+'/chain.npz')
+	chain = ChainReader(gdat.filepath)
 
 	flux_density_conversion_dict = dict({'S': 86.29e-4, 'M':16.65e-3, 'L':34.52e-3})
 
 	fd_conv_fac = None # if units are MJy/sr this changes to a number, otherwise default flux density units are mJy/beam
 	nsrcs = chain['n']
-	xsrcs = chain['x']
-	ysrcs = chain['y']
-	fsrcs = chain['f']
+	# per-sample (x, y, fluxes) records
+	catalog = chain['catalog']
 	chi2 = chain['chi2']
 	timestats = chain['times']
 	accept_stats = chain['accept']
@@ -1996,8 +1991,8 @@ def result_plots(timestr=None, burn_in_frac=0.8, boolplotsave=True, boolplotshow
 		if flux_dist_plots:
 			for i, j in enumerate(np.arange(burn_in, gdat.nsamp)):
 		
-				# fsrcs_in_fov = np.array([fsrcs[b][j][k] for k in range(nsrcs[j]) if dat.weights[0][int(ysrcs[j][k]),int(xsrcs[j][k])] != 0. and xsrcs[j][k] < dat.weights[0].shape[0]-10. and ysrcs[j][k] < dat.weights[0].shape[1]-10.])
-				fsrcs_in_fov = np.array([fsrcs[b][j][k] for k in range(nsrcs[j]) if dat.weights[0][int(ysrcs[j][k]),int(xsrcs[j][k])] != 0. and xsrcs[j][k] < dat.weights[0].shape[0] and ysrcs[j][k] < dat.weights[0].shape[1]])
+				srcs = catalog[j]
+				fsrcs_in_fov = srcs[in_fov_mask(srcs, dat.weights[0]), 2+b]
 
 				fov_sources[b].extend(fsrcs_in_fov)
 
@@ -2039,7 +2034,7 @@ def result_plots(timestr=None, burn_in_frac=0.8, boolplotsave=True, boolplotshow
 
 				print('fov srclengths are', len(fov_sources[sub_b]), len(fov_sources[b]))
 
-				color_lin_post.append(fsrcs[sub_b].ravel()/fsrcs[b].ravel())
+				color_lin_post.append(catalog.records[:,2+sub_b]/catalog.records[:,2+b])
 
 				if sub_b==1 and b==2:
 					ymax = 0.4
@@ -2297,9 +2292,7 @@ def result_plots(timestr=None, burn_in_frac=0.8, boolplotsave=True, boolplotshow
 		nsrc_full = []
 		for i, j in enumerate(np.arange(0, gdat.nsamp)):
 		
-			fsrcs_full = np.array([fsrcs[0][j][k] for k in range(nsrcs[j]) if dat.weights[0][int(ysrcs[j][k]),int(xsrcs[j][k])] != 0.])
-
-			nsrc_full.append(len(fsrcs_full))
+			nsrc_full.append(np.count_nonzero(in_fov_mask(catalog[j], dat.weights[0])))
 
 		f_nsrc_trace_full = plot_src_number_trace(nsrc_full)
 		f_nsrc_trace_full.savefig(gdat.filepath +'/nstar_traceplot_full.'+plttype, bbox_inches='tight', dpi=dpi)
@@ -16,6 +16,7 @@ from astropy import wcs
 from scipy import interpolate
 import networkx as nx
 import os
+import chain_io
 
 
 def mag_from_fluxes(fluxes):
@@ -65,40 +66,32 @@ def associate(a, mags_a, b, mags_b, dr, dmag, confs_b = None, sigfs_b = None, fr
             return goodmatch
 
 
-def clusterize_spire(seed_cat, cat_x, cat_y, cat_n, cat_fs, max_num_sources, nsamp, search_radius, band_names=None):
+def clusterize_spire(seed_cat, cat_x, cat_y, cat_n, cat_fs, max_num_sources, nsamp, search_radius, band_names=None, catalog=None):
+    ''' 
+    Groups the sources of the first nsamp catalog samples around the positions in seed_cat. The samples are either the zero-padded 
+    arrays cat_x, cat_y (nsamp, max_num_sources) and cat_fs (nbands, nsamp, max_num_sources), or a chain_io.RaggedCatalog passed as 
+    catalog, in which case the padded arrays are ignored and can be None.
+    '''
+    if catalog is None:
+        catalog = chain_io.RaggedCatalog.from_padded(cat_n, cat_x, cat_y, cat_fs)
+    catalog = catalog[:nsamp]
 
+    print("are there any nans in the catalog? ", np.isnan(catalog.records).any())
 
-    print("are there any nans in cat_x? ", np.isnan(cat_x).any())
-    print("are there any nans in cat_y? ", np.isnan(cat_y).any())
-
-    nbands = cat_fs.shape[0]
-    sorted_posterior_sample = np.zeros((nsamp, max_num_sources, 2+nbands))
-    print(cat_x.shape, cat_y.shape)
-    print(cat_fs.shape)
+    nbands = catalog.records.shape[1]-2
     print('nbands=', nbands)
-    print 
-    for i in xrange(nsamp):
-
-        cat = np.zeros((max_num_sources, 2+nbands))
-        cat[:,0] = cat_x[i,:]
-        cat[:,1] = cat_y[i,:]
-        for b in xrange(nbands):
-            cat[:,2+b] = cat_fs[b,i,:]
 
-        cat = np.flipud(cat[cat[:,2].argsort()])
-        sorted_posterior_sample[i] = cat
+    # sources of each sample sorted from brightest to faintest in the first band, stacked over samples
+    sorted_posterior_sample = np.zeros((catalog.offsets[-1], 2+nbands))
+    for i in range(nsamp):
+        cat = catalog[i]
+        sorted_posterior_sample[catalog.offsets[i]:catalog.offsets[i+1]] = cat[cat[:,2].argsort()[::-1]]
 
-    PCx = sorted_posterior_sample[:,:,0]
-    PCy = sorted_posterior_sample[:,:,1]
-    PCf = sorted_posterior_sample[:,:,2:]
+    PCx = sorted_posterior_sample[:,0]
+    PCy = sorted_posterior_sample[:,1]
+    PCf = sorted_posterior_sample[:,2:]
 
-    stack = np.zeros((np.sum(cat_n), 2))
-    j = 0
-    for i in xrange(cat_n.size): # don't have to for loop to stack but oh well
-        n = cat_n[i]
-        stack[j:j+n, 0] = PCx[i, 0:n]
-        stack[j:j+n, 1] = PCy[i, 0:n]
-        j += n
+    stack = sorted_posterior_sample[:,:2]
 
     #creates tree, where tree is Pcc_stack
     tree = scipy.spatial.KDTree(stack)
@@ -119,8 +112,8 @@ def clusterize_spire(seed_cat, cat_x, cat_y, cat_n, cat_fs, max_num_sources, nsa
         ##this for loop should naturally populate original seed catalog as well! (b/c all distances 0)
         for i in range(0, nsamp):
             #for specific catalog, find indices of start and end within large tree
-            cat_lo_ndx = np.sum(cat_n[:i])
-            cat_hi_ndx = np.sum(cat_n[:i+1])
+            cat_lo_ndx = catalog.offsets[i]
+            cat_hi_ndx = catalog.offsets[i+1]
             #want in the form of a numpy array so we can use array slicing/masking  
             matches = np.array(matches)
 
@@ -139,15 +132,15 @@ def clusterize_spire(seed_cat, cat_x, cat_y, cat_n, cat_fs, max_num_sources, nsa
                     mask[match] += 1
 
                     #find x, y, flux of match
-                    x = PCx[i,match-cat_lo_ndx]
-                    y = PCy[i,match-cat_lo_ndx]
+                    x = PCx[match]
+                    y = PCy[match]
 
                     #add information to cluster array
                     clusters[i][ct] = x
                     clusters[i][len(seed_cat)+ct] = y
 
                     for b in xrange(nbands):
-                        clusters[i][(2+b)*len(seed_cat)+ct] = PCf[i,match-cat_lo_ndx, b]
+                        clusters[i][(2+b)*len(seed_cat)+ct] = PCf[match, b]
 
     #we now generate a CLASSICAL CATALOG from clusters
     cat_len = len(seed_cat)
@@ -372,9 +365,11 @@ def generate_seed_catalog(kd, cat_all, cat_f0_all, PCi, matching_dist, verbose=F
 
 def completeness_basic_pcat(truth_catalog, pcat_xs, pcat_ys, pcat_fluxes, fluxbins, residual_samples=None, \
                            frac_flux_thresh=0.5, pos_thresh=1.0, imdim=None, mask_hwhm=0.):
+    ''' pcat_xs, pcat_ys and pcat_fluxes are indexed by sample, either zero-padded (nsamp, max_nsrc) arrays or lists of per-sample 
+    arrays such as RaggedCatalog.column(). The last residual_samples samples are used. '''
     
     if residual_samples is None:
-        residual_samples = pcat_xs.shape[0]
+        residual_samples = len(pcat_xs)
         
     if imdim is not None:
         
@@ -425,9 +420,10 @@ def completeness_basic_pcat(truth_catalog, pcat_xs, pcat_ys, pcat_fluxes, fluxbi
 
 def false_discovery_rate_basic_pcat(truth_catalog, pcat_xs, pcat_ys, pcat_fluxes, fluxbins, residual_samples=None, \
                            frac_flux_thresh=0.5, pos_thresh=1.0, imdim=None, mask_hwhm=0.):
+    ''' Takes the catalog samples in the same forms as completeness_basic_pcat(). '''
     
     if residual_samples is None:
-        residual_samples = pcat_xs.shape[0]
+        residual_samples = len(pcat_xs)
         
     if imdim is not None:
         edge_mask = np.where((truth_catalog[:,0] > mask_hwhm)*(truth_catalog[:,0] < imdim[0]-mask_hwhm)*(truth_catalog[:,1] > mask_hwhm)*(truth_catalog[:,1] < imdim[1]-mask_hwhm))[0]
@@ -584,9 +580,10 @@ class cross_match_roc():
             
             
     def load_chain(self, path):
-        lion = np.load(path, allow_pickle=True)
+        ''' Loads the last nsamp catalog samples from a chain.npz file, or from the run directory path of a run with either chain format. '''
+        lion = chain_io.ChainReader(path)
         self.lion_cat = dict({'n':lion['n'][-self.nsamp:].astype(np.int), 'x':lion['x'][-self.nsamp:,:], 'y':lion['y'][-self.nsamp:,:], \
-            'f0':lion['f'][0,-self.nsamp:], 'fs':lion['f'][:,-self.nsamp:]})
+            'f0':lion['f'][0,-self.nsamp:], 'fs':lion['f'][:,-self.nsamp:], 'catalog':lion['catalog'][-self.nsamp:]})
       
         self.nbands = lion['f'].shape[0]
         print('self.nbands:', self.nbands)
@@ -790,7 +787,8 @@ class cross_match_roc():
         cat_len = x.size
 
         # condensed_cat = clusterize_spire(seed_cat, self.lion_cat['x'], self.lion_cat['y'], self.lion_cat['n'], lion_fs, self.gdat.max_nsrc, self.nsamp, self.search_radius)
-        condensed_cat, column_names = clusterize_spire(seed_cat, self.lion_cat['x'], self.lion_cat['y'], self.lion_cat['n'], lion_fs, self.gdat.max_nsrc, self.nsamp, self.search_radius, band_names=None)
+        condensed_cat, column_names = clusterize_spire(seed_cat, self.lion_cat['x'], self.lion_cat['y'], self.lion_cat['n'], lion_fs, self.gdat.max_nsrc, self.nsamp, self.search_radius, band_names=None, \
+                                                    catalog=self.lion_cat['catalog'])
 
         print('column names are ', column_names)
         condensed_x = condensed_cat[:,0]
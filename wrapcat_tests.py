@@ -334,10 +334,7 @@ class pcat_test_suite():
 
 			initialize_c(ob.gdat, libmmult, cblas=ob.gdat.cblas)
 
-			if ob.gdat.cblas:
-				lib = libmmult.pcat_model_eval
-			else:
-				lib = libmmult.clib_eval_modl
+			lib = get_model_kernel(libmmult, ob.gdat.cblas)
 
 			model = Model(ob.gdat, ob.data, libmmult)
 
@@ -409,11 +406,13 @@ class pcat_test_suite():
 			_, filepath, _ = load_param_dict(ob.gdat.timestr, result_path=self.result_path)
 			timestr = ob.gdat.timestr
 
-		chain = np.load(filepath+'/chain.npz')
+		chain = ChainReader(filepath)
 
-		xsrcs = chain['x']
-		ysrcs = chain['y']
-		fsrcs = chain['f']
+		# per-sample views of the catalog records
+		catalog = chain['catalog']
+		xsrcs = catalog.column(0)
+		ysrcs = catalog.column(1)
+		fsrcs = [catalog.column(2+b) for b in range(nbands)]
 
 		completeness_ensemble = np.zeros((residual_samples, nbands, catalog_inject.shape[0]))
 		fluxerror_ensemble = np.zeros((residual_samples, nbands, catalog_inject.shape[0]))
@@ -583,9 +582,9 @@ class pcat_test_suite():
 
 	
 		# completeness_vs_flux = None
-		xstack = xsrcs[-20:,:].ravel()
-		ystack = ysrcs[-20:,:].ravel()
-		fstack = fsrcs[0][-20:,:].ravel()
+		xstack = catalog[-20:].records[:,0]
+		ystack = catalog[-20:].records[:,1]
+		fstack = catalog[-20:].records[:,2]
 
 		lamstrs = ['250', '350', '500']
 
@@ -691,7 +690,7 @@ class pcat_test_suite():
 
 
 			# use filepath from the last iteration to load estiamte of median background estimate
-			chain = np.load(filepath+'/chain.npz')
+			chain = ChainReader(filepath)
 			init_fourier_coeffs = np.median(chain['fourier_coeffs'][10:], axis=0)
 			last_bkg_sample_250 = chain['bkg'][-1,0]
 
@@ -752,7 +751,7 @@ class pcat_test_suite():
 
 
 			# use filepath from the last iteration to load estiamte of median background estimate
-			chain = np.load(filepath+'/chain.npz')
+			chain = ChainReader(filepath)
 			init_fourier_coeffs = np.median(chain['fourier_coeffs'][10:], axis=0)
 			last_bkg_sample_250 = chain['bkg'][-1,0]
 
@@ -862,7 +861,7 @@ class pcat_test_suite():
 			timestr = ob.gdat.timestr
 
 		# use filepath from the last iteration to load estiamte of median background estimate
-		chain = np.load(filepath+'/chain.npz')
+		chain = ChainReader(filepath)
 		median_fc = np.median(chain['fourier_coeffs'][-nlast_fc:], axis=0)
 		last_bkg_sample_250 = chain['bkg'][-1,0]
 